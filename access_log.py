@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import gzip
+import heapq
+import io
+import math
+import re
+import zipfile
+from optparse import OptionParser
+
+# '"GET /path HTTP/1.1" 200 ' of nginx and httpd access logs (common and combined formats)
+_request_line = re.compile(r'"([A-Z]+) (\S+) [^"]*" (\d{3}) ')
+_number = re.compile(r'^\d+(\.\d+)?$')
+_id_segment = re.compile(r'/(\d+|[0-9a-fA-F-]{16,})(?=/|$)')
+
+_access_log_name = re.compile(r'(^|/)(access\.log|access_log)[^/]*$')
+
+
+class QuantileSketch:
+    # log-bucketed histogram: every quantile is within 'relative_accuracy' of the exact value and
+    # the memory depends on the range of the values, not on the number of the values
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bucket = dict()
+        self.zero_count = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.max = max(self.max, value)
+        if value <= 1e-9:
+            self.zero_count += 1
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.bucket[key] = self.bucket.get(key, 0) + 1
+
+    def quantile(self, qq):
+        if self.count == 0:
+            return 0.0
+        rank = qq * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bucket):
+            seen += self.bucket[key]
+            if rank < seen:
+                return min(2 * self.gamma ** key / (self.gamma + 1), self.max)
+        return self.max
+
+    def merge(self, other):
+        for key in other.bucket:
+            self.bucket[key] = self.bucket.get(key, 0) + other.bucket[key]
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+
+def get_endpoint(method, path):
+    # query strings and id-like path segments are dropped to bound the number of endpoints
+    return '%s %s' % (method, _id_segment.sub('/{id}', path.split('?')[0]))
+
+
+def _latency(line, m):
+    # the request time appended to the log format: seconds ('$request_time' of nginx, with a dot)
+    # or microseconds ('%D' of httpd, an integer); the field right after the status is the size
+    rest = line[m.end():].split()
+    if len(rest) < 2:
+        return None
+    tt = rest[-1]
+    if not _number.match(tt):
+        return None
+    if '.' in tt:
+        return float(tt)
+    return int(tt) / 1000000.0
+
+
+class AccessLogStat:
+    def __init__(self, max_endpoints=1000, slowest_count=20):
+        self.max_endpoints = max_endpoints
+        self.slowest_count = slowest_count
+        self.endpoint = dict()
+        self.slowest = list()
+        self.line_count = 0
+        self.no_latency_count = 0
+
+    def add_line(self, line, source=''):
+        m = _request_line.search(line)
+        if not m:
+            return
+        self.line_count += 1
+
+        key = get_endpoint(m.group(1), m.group(2))
+        if key not in self.endpoint and len(self.endpoint) >= self.max_endpoints:
+            key = '(other)'
+        if key not in self.endpoint:
+            ee = dict()
+            ee['count'] = 0
+            ee['5xx'] = 0
+            ee['sketch'] = QuantileSketch()
+            self.endpoint[key] = ee
+
+        ee = self.endpoint[key]
+        ee['count'] += 1
+        if m.group(3).startswith('5'):
+            ee['5xx'] += 1
+
+        latency = _latency(line, m)
+        if latency is None:
+            self.no_latency_count += 1
+            return
+        ee['sketch'].add(latency)
+
+        item = (latency, source, line.strip())
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def merge(self, other):
+        # the busiest endpoints of the other stat are merged first; the rest beyond the cap go to '(other)'
+        for key_other in sorted(other.endpoint, key=lambda x: -other.endpoint[x]['count']):
+            key = key_other
+            if key not in self.endpoint and len(self.endpoint) >= self.max_endpoints:
+                key = '(other)'
+            if key not in self.endpoint:
+                self.endpoint[key] = other.endpoint[key_other]
+                continue
+            ee = self.endpoint[key]
+            ee['count'] += other.endpoint[key_other]['count']
+            ee['5xx'] += other.endpoint[key_other]['5xx']
+            ee['sketch'].merge(other.endpoint[key_other]['sketch'])
+        self.slowest = heapq.nlargest(self.slowest_count, self.slowest + other.slowest)
+        heapq.heapify(self.slowest)
+        self.line_count += other.line_count
+        self.no_latency_count += other.no_latency_count
+
+    def add_file(self, file_object, source=''):
+        for line in io.TextIOWrapper(file_object, encoding='utf-8', errors='replace'):
+            self.add_line(line, source)
+
+    def add_path(self, file_path):
+        # a plain or gzipped access log, or a log bundle (zip) of elastic beanstalk
+        if zipfile.is_zipfile(file_path):
+            with zipfile.ZipFile(file_path) as zz:
+                for name in zz.namelist():
+                    if not _access_log_name.search(name.replace('.gz', '')):
+                        continue
+                    with zz.open(name) as f:
+                        if name.endswith('.gz'):
+                            with gzip.GzipFile(fileobj=f) as gf:
+                                self.add_file(gf, '%s:%s' % (file_path, name))
+                        else:
+                            self.add_file(f, '%s:%s' % (file_path, name))
+        elif file_path.endswith('.gz'):
+            with gzip.open(file_path) as f:
+                self.add_file(f, file_path)
+        else:
+            with open(file_path, 'rb') as f:
+                self.add_file(f, file_path)
+
+    def print_report(self, top=30):
+        print('%d requests, %d endpoints' % (self.line_count, len(self.endpoint)))
+        if self.no_latency_count:
+            print('%d requests have no request time (add \'$request_time\' (nginx) or \'%%D\' (httpd) '
+                  'at the end of the log format)' % self.no_latency_count)
+
+        print('')
+        print('%8s %6s %8s %8s %8s %8s %8s  %s' % ('COUNT', '5XX', 'P50', 'P90', 'P99', 'P99.9', 'MAX', 'ENDPOINT'))
+        endpoint_list = sorted(self.endpoint.items(), key=lambda x: -x[1]['count'])
+        for key, ee in endpoint_list[:top]:
+            ss = ee['sketch']
+            print('%8d %6d %8.3f %8.3f %8.3f %8.3f %8.3f  %s' %
+                  (ee['count'], ee['5xx'], ss.quantile(0.5), ss.quantile(0.9), ss.quantile(0.99),
+                   ss.quantile(0.999), ss.max, key))
+
+        print('')
+        print('slowest requests')
+        for latency, source, line in sorted(self.slowest, reverse=True):
+            print('%8.3f  %s' % (latency, line))
+            print('          (%s)' % source)
+
+
+def read_access_log(file_path, slowest_count=20):
+    stat = AccessLogStat(slowest_count=slowest_count)
+    stat.add_path(file_path)
+    return stat
+
+
+if __name__ == "__main__":
+    # ./access_log.py access.log access.log.1.gz log/nova-1600000000/i-0123.zip
+    parser = OptionParser(usage='%prog [options] file ...')
+    parser.add_option('--top', dest='top', default='30')
+    parser.add_option('--slowest', dest='slowest', default='20')
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        raise SystemExit(1)
+
+    stat = AccessLogStat(slowest_count=int(options.slowest))
+    for aa in args:
+        stat.merge(read_access_log(aa, int(options.slowest)))
+    stat.print_report(int(options.top))
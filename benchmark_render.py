@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import timeit
+
+from run_common import re_sub_lines
+from run_common import render_lines
+
+key_count = 100
+line_count = 500
+
+lines = list()
+for ii in range(line_count):
+    lines.append('KEY_%d = None\n' % (ii % (key_count * 2)))
+
+option_list = list()
+for ii in range(key_count):
+    option_list.append(['KEY_%d' % ii, 'value_%d' % ii])
+
+
+def _re_sub_lines():
+    new_lines = lines
+    for oo in option_list:
+        new_lines = re_sub_lines(new_lines, '^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
+    return new_lines
+
+
+def _render_lines():
+    rule_list = list()
+    for oo in option_list:
+        rule_list.append(['^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+    return render_lines(lines, rule_list)[0]
+
+
+def _check_one_pass():
+    # the replacement of the first rule is not matched again by the second rule (one pass per line)
+    rule_list = [['^(A) .*', '\\1 = \'B x\''], ['B x', 'B z']]
+    chain_lines = ['A q\n']
+    for rr in rule_list:
+        chain_lines = re_sub_lines(chain_lines, rr[0], rr[1])
+    if chain_lines != ['A = \'B z\'\n'] or render_lines(['A q\n'], rule_list)[0] != ['A = \'B x\'\n']:
+        print('ERROR!!! render_lines is not one pass')
+        raise Exception()
+
+
+if __name__ == "__main__":
+    if _re_sub_lines() != _render_lines():
+        print('ERROR!!! results are different')
+        raise Exception()
+    _check_one_pass()
+
+    print('%d keys, %d lines' % (key_count, line_count))
+    for func in (_re_sub_lines, _render_lines):
+        elapsed = min(timeit.repeat(func, number=10, repeat=3)) / 10
+        print('%-15s %8.2f ms' % (func.__name__, elapsed * 1000))
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import json
+import os
+import shutil
+import stat
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from run_common import run_subprocess
+
+_wheelhouse_lock = threading.Lock()
+_lambda_layer_lock = threading.Lock()
+_lambda_layer_lock_list = dict()
+_lambda_layer_arn_list = dict()
+
+# cached objects which no build has used for this many seconds are removed
+_object_max_age = 14 * 24 * 60 * 60
+
+# 1980-01-01 00:00:00 in MS-DOS format (the earliest date which a zip entry can have)
+_DOS_TIME = 0
+_DOS_DATE = (1 << 5) | 1
+
+
+def _temp_suffix():
+    # unique across the threads and the forked processes which share the cache
+    return '%d.%d' % (os.getpid(), threading.get_ident())
+
+
+def _sha256(file_path):
+    hh = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hh.update(chunk)
+    return hh.hexdigest()
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        print('ERROR!!! broken symbolic link: %s' % path)
+        raise Exception()
+
+
+def _normalize_mode(mode):
+    if stat.S_ISDIR(mode):
+        return stat.S_IFDIR | 0o755
+    if mode & 0o111:
+        return stat.S_IFREG | 0o755
+    return stat.S_IFREG | 0o644
+
+
+def _read_manifest(manifest_path):
+    # noinspection PyBroadException
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except Exception:
+        return dict()
+
+
+def _write_manifest(manifest_path, manifest):
+    temp_path = '%s.%s.tmp' % (manifest_path, _temp_suffix())
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+class Bundle:
+    def __init__(self, root_path, cache_path='cache/bundle', exclude_list=None):
+        self.root_path = root_path
+        self.cache_path = cache_path
+        self.exclude_list = exclude_list or list()
+        self.entry_list = list()
+        self.digest = None
+
+        os.makedirs('%s/objects' % cache_path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        root_hash = hashlib.sha1(os.path.abspath(self.root_path).encode('utf-8')).hexdigest()
+        manifest_path = '%s/manifest-%s.json' % (self.cache_path, root_hash)
+        manifest = _read_manifest(manifest_path)
+        manifest_new = dict()
+
+        # symbolic links are bundled as the files and directories they point to
+        for dir_path, dir_list, file_list in os.walk(self.root_path, followlinks=True):
+            rel_dir = os.path.relpath(dir_path, self.root_path)
+            rel_dir = '' if rel_dir == '.' else rel_dir.replace(os.sep, '/') + '/'
+            real_dir = os.path.realpath(dir_path)
+
+            dir_list[:] = [dd for dd in dir_list if rel_dir + dd + '/' not in self.exclude_list]
+            for dd in dir_list:
+                arcname = rel_dir + dd + '/'
+                real_path = os.path.realpath('%s/%s' % (dir_path, dd))
+                if real_path == real_dir or real_dir.startswith(real_path + os.sep):
+                    print('ERROR!!! symbolic link loop: %s/%s' % (dir_path, dd))
+                    raise Exception()
+                mode = _normalize_mode(_stat('%s/%s' % (dir_path, dd)).st_mode)
+                self.entry_list.append([arcname, mode, 0, None, None])
+
+            for ff in sorted(file_list):
+                arcname = rel_dir + ff
+                if arcname in self.exclude_list:
+                    continue
+                file_path = os.path.abspath('%s/%s' % (dir_path, ff))
+                st = _stat(file_path)
+
+                # reuse the content hash while the size and the modification time are unchanged
+                cached = manifest.get(file_path)
+                if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                    sha = cached[2]
+                else:
+                    sha = _sha256(file_path)
+                manifest_new[file_path] = [st.st_size, st.st_mtime_ns, sha]
+
+                self.entry_list.append([arcname, _normalize_mode(st.st_mode), st.st_size, sha, file_path])
+
+        self.entry_list.sort(key=lambda x: x[0])
+
+        _write_manifest(manifest_path, manifest_new)
+
+        hh = hashlib.sha256()
+        for arcname, mode, size, sha, file_path in self.entry_list:
+            hh.update(('%o %s %s\n' % (mode, arcname, sha)).encode('utf-8'))
+        self.digest = hh.hexdigest()
+
+    def _deflate(self, sha, file_path):
+        # compressed entries are cached by content hash and reused by the next build;
+        # the file is compressed in chunks into the cache object, so it is never held in memory as a whole
+        object_path = '%s/objects/%s' % (self.cache_path, sha)
+        # the modification time of an object is its last use, see prune()
+        try:
+            with open(object_path, 'rb') as f:
+                crc, size = struct.unpack('<II', f.read(8))
+            os.utime(object_path)
+            return crc, size, os.path.getsize(object_path) - 8, object_path
+        except FileNotFoundError:
+            pass
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+
+        temp_path = '%s.%s.tmp' % (object_path, _temp_suffix())
+        with open(file_path, 'rb') as f, open(temp_path, 'wb') as ff:
+            ff.write(b'\0' * 8)
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                compressed = compressor.compress(chunk)
+                compressed_size += len(compressed)
+                ff.write(compressed)
+            compressed = compressor.flush()
+            compressed_size += len(compressed)
+            ff.write(compressed)
+
+            crc &= 0xffffffff
+            ff.seek(0)
+            ff.write(struct.pack('<II', crc, size))
+        os.replace(temp_path, object_path)
+
+        return crc, size, compressed_size, object_path
+
+    def _compressed_entries(self):
+        # files are compressed in parallel (zlib releases the GIL) but yielded in order;
+        # the compressed data stays in the cache objects until it is written
+        max_workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_list = deque()
+            for arcname, mode, size, sha, file_path in self.entry_list:
+                future = None
+                if sha is not None:
+                    future = executor.submit(self._deflate, sha, file_path)
+                future_list.append([arcname, mode, future])
+
+                while len(future_list) > max_workers * 2:
+                    yield self._compressed_entry(*future_list.popleft())
+
+            while future_list:
+                yield self._compressed_entry(*future_list.popleft())
+
+    @staticmethod
+    def _compressed_entry(arcname, mode, future):
+        if future is None:
+            return arcname, mode, 0, 0, 0, 0, None
+        crc, size, compressed_size, object_path = future.result()
+        return arcname, mode, 8, crc, size, compressed_size, object_path
+
+    def write(self, stream):
+        # zip64 is not supported: at most 65535 entries and 4 GiB
+        if len(self.entry_list) > 0xffff:
+            print('ERROR!!! zip64 is not supported: %d entries in %s' % (len(self.entry_list), self.root_path))
+            raise Exception()
+        for arcname, mode, size, sha, file_path in self.entry_list:
+            if size > 0xffffffff:
+                print('ERROR!!! zip64 is not supported:', arcname)
+                raise Exception()
+
+        offset = 0
+        central_directory = list()
+
+        for arcname, mode, method, crc, size, compressed_size, object_path in self._compressed_entries():
+            name = arcname.encode('utf-8')
+            if offset > 0xffffffff:
+                print('ERROR!!! zip64 is not supported:', arcname)
+                raise Exception()
+
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x800, method, _DOS_TIME, _DOS_DATE,
+                                 crc, compressed_size, size, len(name), 0)
+            stream.write(header + name)
+            if object_path:
+                with open(object_path, 'rb') as f:
+                    f.seek(8)
+                    shutil.copyfileobj(f, stream, 1024 * 1024)
+
+            central_directory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, 0x800,
+                                                 method, _DOS_TIME, _DOS_DATE, crc, compressed_size, size,
+                                                 len(name), 0, 0, 0, 0, mode << 16, offset) + name)
+            offset += len(header) + len(name) + compressed_size
+
+        central_directory = b''.join(central_directory)
+        if offset > 0xffffffff or offset + len(central_directory) > 0xffffffff:
+            print('ERROR!!! zip64 is not supported: %d bytes in %s' % (offset, self.root_path))
+            raise Exception()
+
+        stream.write(central_directory)
+        stream.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entry_list), len(self.entry_list),
+                                 len(central_directory), offset, 0))
+
+        self.prune()
+
+    def prune(self):
+        # remove the objects which are not in this bundle and have not been used by any build for a while
+        sha_list = set([sha for arcname, mode, size, sha, file_path in self.entry_list])
+        object_dir = '%s/objects' % self.cache_path
+        expire = time.time() - _object_max_age
+        for ff in os.listdir(object_dir):
+            if ff in sha_list:
+                continue
+            object_path = '%s/%s' % (object_dir, ff)
+            # noinspection PyBroadException
+            try:
+                if os.stat(object_path).st_mtime < expire:
+                    os.remove(object_path)
+            except Exception:
+                pass
+
+    def upload(self, aws_cli, s3_uri):
+        # the zip is streamed to 'aws s3 cp -' which uploads it with concurrent multipart requests,
+        # so the upload overlaps the compression and no temporary file is written
+        args = ['aws', 's3', 'cp', '-', s3_uri]
+        print('\n>> command: [%s]' % aws_cli.env['AWS_DEFAULT_REGION'], end=" ")
+        print(' '.join(args))
+        returncode = run_subprocess(args, env=aws_cli.env, writer=self.write)
+
+        if returncode != 0:
+            print('command returns: %s' % returncode)
+            raise Exception()
+
+
+def _run_pip(args):
+    args = ['pip3'] + args
+    print('\n>> command:', ' '.join(args))
+    return run_subprocess(args) == 0
+
+
+def _requirement_list(requirements_path):
+    requirement_list = list()
+    with open(requirements_path) as f:
+        for ll in f:
+            ll = ll.split(' #')[0].strip()
+            if not ll or ll.startswith('#') or ll.startswith('-'):
+                continue
+            requirement_list.append(ll)
+    return requirement_list
+
+
+def _is_target_wheel(file_name, platform, python_version):
+    # name-version(-build)-python-abi-platform.whl
+    python_tag, abi_tag, platform_tag = file_name[:-len('.whl')].split('-')[-3:]
+    python_list = ('py3', 'py%s' % python_version, 'cp%s' % python_version)
+    if not [tt for tt in python_tag.split('.') if tt in python_list]:
+        return False
+    if abi_tag != 'none':
+        return False
+    return 'any' in platform_tag.split('.') or platform in platform_tag.split('.')
+
+
+def _pip_download_args(platform, python_version, download_path):
+    args = ['download', '--only-binary=:all:']
+    args += ['--platform', platform]
+    args += ['--python-version', python_version]
+    args += ['--implementation', 'cp']
+    args += ['-d', download_path]
+    return args
+
+
+def _build_wheelhouse(requirements_path, wheelhouse_path, platform, python_version):
+    # binary wheels for the target platform are downloaded first;
+    # only the requirements which have no such wheel are built on this machine, and they must be pure python
+    temp_path = '%s.%s.tmp' % (wheelhouse_path, _temp_suffix())
+    build_path = '%s.%s.build' % (wheelhouse_path, _temp_suffix())
+    shutil.rmtree(temp_path, ignore_errors=True)
+    shutil.rmtree(build_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    os.makedirs(build_path)
+
+    try:
+        args = _pip_download_args(platform, python_version, temp_path)
+        args += ['-r', requirements_path]
+        if not _run_pip(args):
+            print('some requirements have no \'%s\' wheel, build them on this machine' % platform)
+
+            for rr in _requirement_list(requirements_path):
+                args = _pip_download_args(platform, python_version, temp_path)
+                args += ['--no-deps', rr]
+                if _run_pip(args):
+                    continue
+
+                args = ['wheel', '--no-deps', '--no-binary=:all:']
+                args += ['-w', build_path]
+                args += [rr]
+                if not _run_pip(args):
+                    print('ERROR!!! failed to build the wheel of', rr)
+                    raise Exception()
+
+            for ff in sorted(os.listdir(build_path)):
+                if not _is_target_wheel(ff, platform, python_version):
+                    print('ERROR!!! %s is not a pure python wheel for %s (python %s)' %
+                          (ff, platform, python_version))
+                    raise Exception()
+                os.replace('%s/%s' % (build_path, ff), '%s/%s' % (temp_path, ff))
+
+            # the dependencies are resolved again with the wheels built above
+            args = _pip_download_args(platform, python_version, temp_path)
+            args += ['--find-links', temp_path]
+            args += ['-r', requirements_path]
+            if not _run_pip(args):
+                print('ERROR!!! failed to build the wheelhouse of', requirements_path)
+                raise Exception()
+
+        os.replace(temp_path, wheelhouse_path)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        shutil.rmtree(build_path, ignore_errors=True)
+
+
+def _get_wheelhouse(requirements_path, platform, python_version, cache_path='cache/wheelhouse'):
+    # the wheelhouse is built once per requirements hash
+    hh = hashlib.sha256()
+    hh.update(('%s %s\n' % (platform, python_version)).encode('utf-8'))
+    with open(requirements_path, 'rb') as f:
+        hh.update(f.read())
+    wheelhouse_path = '%s/%s' % (cache_path, hh.hexdigest())
+
+    with _wheelhouse_lock:
+        if os.path.exists(wheelhouse_path):
+            print('reuse wheelhouse: %s' % wheelhouse_path)
+        else:
+            os.makedirs(cache_path, exist_ok=True)
+            _build_wheelhouse(requirements_path, wheelhouse_path, platform, python_version)
+
+    return wheelhouse_path
+
+
+def add_wheelhouse(environment_path, settings, cache_path='cache/wheelhouse'):
+    # wheels of 'requirements.txt' are built once per requirements hash and shipped in the bundle,
+    # and pip on the instances installs them from the bundle instead of PyPI
+    requirements_path = '%s/%s' % (environment_path, settings.get('REQUIREMENTS', 'requirements.txt'))
+    if not os.path.exists(requirements_path):
+        return
+
+    platform = settings.get('WHEELHOUSE_PLATFORM', 'manylinux1_x86_64')
+    python_version = settings.get('WHEELHOUSE_PYTHON_VERSION', '36')
+    wheelhouse_path = _get_wheelhouse(requirements_path, platform, python_version, cache_path)
+
+    target_path = '%s/wheelhouse' % environment_path
+    shutil.rmtree(target_path, ignore_errors=True)
+    os.makedirs(target_path)
+    for ff in sorted(os.listdir(wheelhouse_path)):
+        # hard links keep the modification time, so the bundle manifest reuses the content hashes
+        try:
+            os.link('%s/%s' % (wheelhouse_path, ff), '%s/%s' % (target_path, ff))
+        except OSError:
+            shutil.copy2('%s/%s' % (wheelhouse_path, ff), '%s/%s' % (target_path, ff))
+
+    # only the pip install of the application is pointed at the wheelhouse (options of the requirements file
+    # apply to that install alone), and the other pip commands on the instance keep their index
+    find_links = os.path.relpath(target_path, os.path.dirname(requirements_path))
+    header = '--no-index\n--find-links %s\n' % find_links
+    with open(requirements_path) as f:
+        requirements = f.read()
+    if not requirements.startswith(header):
+        with open(requirements_path, 'w') as f:
+            f.write(header + requirements)
+
+
+def write_lambda_zip(deploy_folder, zip_name='deploy.zip'):
+    # the zip is reproducible (sorted entries, fixed timestamps and permissions), so the returned hash
+    # is the same as 'CodeSha256' of the function while the code is not changed
+    bundle = Bundle(deploy_folder, exclude_list=[zip_name])
+    zip_path = '%s/%s' % (deploy_folder, zip_name)
+    with open(zip_path, 'wb') as f:
+        bundle.write(f)
+
+    hh = hashlib.sha256()
+    with open(zip_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hh.update(chunk)
+    return base64.b64encode(hh.digest()).decode('utf-8')
+
+
+def publish_lambda_layer(aws_cli, requirements_path, layer_name, runtime='python3.6', architecture='x86_64',
+                         cache_path='cache/lambda_layer'):
+    # the requirements are installed once per requirements hash and published as a layer version
+    # which is shared by the functions with the same requirements; returns the layer version arn
+    hh = hashlib.sha256()
+    hh.update(('%s %s\n' % (runtime, architecture)).encode('utf-8'))
+    with open(requirements_path, 'rb') as f:
+        hh.update(f.read())
+    requirements_hash = hh.hexdigest()
+    description = 'requirements sha256 %s' % requirements_hash
+
+    # functions with the same requirements are deployed concurrently but the layer version is published once
+    with _lambda_layer_lock:
+        if requirements_hash not in _lambda_layer_lock_list:
+            _lambda_layer_lock_list[requirements_hash] = threading.Lock()
+        lock = _lambda_layer_lock_list[requirements_hash]
+
+    with lock:
+        if requirements_hash not in _lambda_layer_arn_list:
+            _lambda_layer_arn_list[requirements_hash] = _publish_lambda_layer(
+                aws_cli, requirements_path, layer_name, runtime, architecture, requirements_hash, description,
+                cache_path)
+        return _lambda_layer_arn_list[requirements_hash]
+
+
+def _publish_lambda_layer(aws_cli, requirements_path, layer_name, runtime, architecture, requirements_hash,
+                          description, cache_path):
+    cmd = ['lambda', 'list-layer-versions']
+    cmd += ['--layer-name', layer_name]
+    result = aws_cli.run(cmd, ignore_error=True)
+
+    for ll in (result or dict()).get('LayerVersions', list()):
+        if ll.get('Description') == description:
+            print('reuse layer version: %s' % ll['LayerVersionArn'])
+            return ll['LayerVersionArn']
+
+    # the packages are imported from '/opt/python' of the layer
+    layer_path = '%s/%s' % (cache_path, requirements_hash)
+    if os.path.exists(layer_path):
+        print('reuse layer: %s' % layer_path)
+    else:
+        temp_path = '%s.%s.tmp' % (layer_path, _temp_suffix())
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs('%s/python' % temp_path)
+        os.makedirs(cache_path, exist_ok=True)
+
+        # wheels for the lambda runtime, not for this machine; a requirement which has no such wheel
+        # is built here when it is pure python (see _build_wheelhouse)
+        platform = 'manylinux2014_aarch64' if architecture == 'arm64' else 'manylinux2014_x86_64'
+        python_version = runtime.replace('python', '').replace('.', '')
+        wheelhouse_path = _get_wheelhouse(requirements_path, platform, python_version)
+
+        args = ['install', '-r', requirements_path, '-t', '%s/python' % temp_path]
+        args += ['--no-index', '--find-links', wheelhouse_path]
+        # the byte code of this machine's python is useless for the runtime
+        args += ['--no-compile']
+        args += ['--only-binary=:all:']
+        args += ['--platform', platform]
+        args += ['--implementation', 'cp']
+        args += ['--python-version', python_version]
+        if not _run_pip(args):
+            print('ERROR!!! failed to install', requirements_path)
+            raise Exception()
+
+        os.replace(temp_path, layer_path)
+
+    zip_path = '%s.%s.zip' % (layer_path, _temp_suffix())
+    with open(zip_path, 'wb') as f:
+        Bundle(layer_path).write(f)
+
+    try:
+        cmd = ['lambda', 'publish-layer-version']
+        cmd += ['--layer-name', layer_name]
+        cmd += ['--description', description]
+        cmd += ['--zip-file', 'fileb://%s' % os.path.abspath(zip_path)]
+        cmd += ['--compatible-runtimes', runtime]
+        cmd += ['--compatible-architectures', architecture]
+        result = aws_cli.run(cmd)
+    finally:
+        os.remove(zip_path)
+
+    return result['LayerVersionArn']
+
+
+def create_eb_application_version(aws_cli, eb_application_name, name, environment_path, version_label):
+    cmd = ['elasticbeanstalk', 'create-storage-location']
+    result = aws_cli.run(cmd)
+
+    s3_bucket = result['S3Bucket']
+
+    bundle = Bundle(environment_path)
+    s3_key = '%s/%s-%s.zip' % (eb_application_name, name, bundle.digest)
+
+    cmd = ['elasticbeanstalk', 'describe-application-versions']
+    cmd += ['--application-name', eb_application_name]
+    result = aws_cli.run(cmd)
+
+    for r in result['ApplicationVersions']:
+        source_bundle = r.get('SourceBundle', dict())
+        if source_bundle.get('S3Bucket') == s3_bucket and source_bundle.get('S3Key') == s3_key:
+            print('reuse application version: %s (bundle: %s)' % (r['VersionLabel'], bundle.digest))
+            return r['VersionLabel']
+
+    cmd = ['s3api', 'head-object']
+    cmd += ['--bucket', s3_bucket]
+    cmd += ['--key', s3_key]
+    result = aws_cli.run(cmd, ignore_error=True)
+
+    if result:
+        print('skip upload: s3://%s/%s already exists' % (s3_bucket, s3_key))
+    else:
+        bundle.upload(aws_cli, 's3://%s/%s' % (s3_bucket, s3_key))
+
+    cmd = ['elasticbeanstalk', 'create-application-version']
+    cmd += ['--application-name', eb_application_name]
+    cmd += ['--source-bundle', 'S3Bucket="%s",S3Key="%s"' % (s3_bucket, s3_key)]
+    cmd += ['--version-label', version_label]
+    aws_cli.run(cmd, cwd=environment_path)
+
+    return version_label
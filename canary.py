@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import json
+import time
+
+from run_common import print_message
+
+
+def _get_record_set(aws_cli, hosted_zone_id, host):
+    cmd = ['route53', 'list-resource-record-sets']
+    cmd += ['--hosted-zone-id', hosted_zone_id]
+    cmd += ['--start-record-name', host]
+    cmd += ['--max-items', '10']
+    result = aws_cli.run(cmd)
+
+    for rr in result['ResourceRecordSets']:
+        if rr['Name'].rstrip('.') == host.rstrip('.') and rr['Type'] == 'CNAME' and 'SetIdentifier' not in rr:
+            return rr
+
+    print('ERROR!!! simple CNAME record of %s is not found in %s' % (host, hosted_zone_id))
+    raise Exception()
+
+
+def _weighted_record_set(host, set_identifier, weight, value, ttl):
+    rr = dict()
+    rr['Name'] = host
+    rr['Type'] = 'CNAME'
+    rr['SetIdentifier'] = set_identifier
+    rr['Weight'] = weight
+    rr['TTL'] = ttl
+    resource_record = dict()
+    resource_record['Value'] = value
+    rr['ResourceRecords'] = [resource_record]
+    return rr
+
+
+def _change_record_sets(aws_cli, hosted_zone_id, change_list):
+    # all changes of a batch are applied atomically
+    change_batch = dict()
+    change_batch['Changes'] = list()
+    for action, rr in change_list:
+        cc = dict()
+        cc['Action'] = action
+        cc['ResourceRecordSet'] = rr
+        change_batch['Changes'].append(cc)
+
+    cmd = ['route53', 'change-resource-record-sets']
+    cmd += ['--hosted-zone-id', hosted_zone_id]
+    cmd += ['--change-batch', json.dumps(change_batch)]
+    result = aws_cli.run(cmd)
+
+    cmd = ['route53', 'wait', 'resource-record-sets-changed']
+    cmd += ['--id', result['ChangeInfo']['Id']]
+    aws_cli.run(cmd)
+
+
+def _get_endpoint_url(aws_cli, eb_environment_name):
+    # the load balancer of the environment, which does not change when the environment CNAMEs are swapped
+    cmd = ['elasticbeanstalk', 'describe-environments']
+    cmd += ['--environment-names', eb_environment_name]
+    result = aws_cli.run(cmd)
+
+    for ee in result['Environments']:
+        if ee['EnvironmentName'] == eb_environment_name and ee.get('EndpointURL'):
+            return ee['EndpointURL']
+
+    print('ERROR!!! load balancer of %s is not found' % eb_environment_name)
+    raise Exception()
+
+
+def _get_load_balancer_metric(aws_cli, eb_environment_name):
+    # returns [namespace, dimension, latency metric, 5xx metric] of the load balancer of the environment
+    cmd = ['elasticbeanstalk', 'describe-environment-resources']
+    cmd += ['--environment-name', eb_environment_name]
+    result = aws_cli.run(cmd)
+
+    load_balancer_name = result['EnvironmentResources']['LoadBalancers'][0]['Name']
+    if load_balancer_name.startswith('arn:'):
+        dimension = 'Name=LoadBalancer,Value=%s' % load_balancer_name.split(':loadbalancer/')[-1]
+        return ['AWS/ApplicationELB', dimension, 'TargetResponseTime', 'HTTPCode_Target_5XX_Count']
+
+    dimension = 'Name=LoadBalancerName,Value=%s' % load_balancer_name
+    return ['AWS/ELB', dimension, 'Latency', 'HTTPCode_Backend_5XX']
+
+
+def _get_metric_sum(aws_cli, metric, metric_name, statistic, start_time, end_time):
+    namespace, dimension = metric[0], metric[1]
+    period = max(60, (int(end_time - start_time) + 59) // 60 * 60)
+
+    cmd = ['cloudwatch', 'get-metric-statistics']
+    cmd += ['--namespace', namespace]
+    cmd += ['--metric-name', metric_name]
+    cmd += ['--dimensions', dimension]
+    cmd += ['--start-time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start_time))]
+    cmd += ['--end-time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(end_time))]
+    cmd += ['--period', str(period)]
+    cmd += ['--statistics', statistic, 'SampleCount']
+    result = aws_cli.run(cmd)
+
+    value = 0.0
+    sample_count = 0.0
+    for dd in result['Datapoints']:
+        if statistic == 'Average':
+            value += dd['Average'] * dd['SampleCount']
+        else:
+            value += dd[statistic]
+        sample_count += dd['SampleCount']
+    return value, sample_count
+
+
+def _get_load_balancer_stat(aws_cli, metric, start_time, end_time):
+    latency_sum, request_count = _get_metric_sum(aws_cli, metric, metric[2], 'Average', start_time, end_time)
+    error_count = _get_metric_sum(aws_cli, metric, metric[3], 'Sum', start_time, end_time)[0]
+
+    stat = dict()
+    stat['requests'] = request_count
+    stat['latency'] = latency_sum / request_count if request_count else 0.0
+    stat['error_rate'] = error_count / request_count if request_count else 0.0
+    return stat
+
+
+def _is_regressed(stat_old, stat_new, canary):
+    regressed = False
+    max_latency = stat_old['latency'] * float(canary.get('MAX_LATENCY_RATIO', 1.2)) + \
+        float(canary.get('LATENCY_TOLERANCE_SECONDS', 0.05))
+    if stat_new['latency'] > max_latency:
+        print('latency %.3f seconds exceeds %.3f seconds' % (stat_new['latency'], max_latency))
+        regressed = True
+
+    max_error_rate = stat_old['error_rate'] + float(canary.get('MAX_5XX_RATE_INCREASE', 0.01))
+    if stat_new['error_rate'] > max_error_rate:
+        print('5xx rate %.4f exceeds %.4f' % (stat_new['error_rate'], max_error_rate))
+        regressed = True
+
+    return regressed
+
+
+def _restore_simple_record(aws_cli, hosted_zone_id, record_set, record_old, record_new):
+    change_list = list()
+    change_list.append(['DELETE', record_old])
+    change_list.append(['DELETE', record_new])
+    change_list.append(['CREATE', record_set])
+    _change_record_sets(aws_cli, hosted_zone_id, change_list)
+
+
+def shift_traffic(aws_cli, eb_environment_name_old, eb_environment_name, cname_old, host, canary):
+    # canary: the 'CANARY' dict of an environment in config.json
+    #
+    # the simple CNAME record of 'host' (-> cname_old) is replaced by two weighted records
+    # (cname_old, the load balancer of the new environment) and the weight of the new environment is raised
+    # step by step; the caller swaps the environment CNAMEs when this returns
+    hosted_zone_id = canary['HOSTED_ZONE_ID']
+    step_list = [int(ss) for ss in canary.get('STEPS', [5, 25, 100])]
+    step_seconds = int(canary.get('STEP_SECONDS', 300))
+    min_request_count = int(canary.get('MIN_REQUEST_COUNT', 10))
+    max_step_extension = int(canary.get('MAX_STEP_EXTENSION', 3))
+
+    record_set = _get_record_set(aws_cli, hosted_zone_id, host)
+    ttl = min(int(record_set['TTL']), int(canary.get('TTL', 60)))
+
+    # the new environment is addressed by its load balancer rather than its CNAME,
+    # so the weighted record keeps pointing at it while the CNAMEs are swapped
+    endpoint_new = _get_endpoint_url(aws_cli, eb_environment_name)
+
+    metric_old = _get_load_balancer_metric(aws_cli, eb_environment_name_old)
+    metric_new = _get_load_balancer_metric(aws_cli, eb_environment_name)
+
+    record_old = None
+    record_new = None
+    for weight in step_list:
+        print_message('shift %d%% of %s to %s' % (weight, host, eb_environment_name))
+
+        change_list = list()
+        if not record_old:
+            change_list.append(['DELETE', record_set])
+        record_old = _weighted_record_set(host, eb_environment_name_old, 100 - weight, cname_old, ttl)
+        record_new = _weighted_record_set(host, eb_environment_name, weight, endpoint_new, ttl)
+        change_list.append(['UPSERT', record_old])
+        change_list.append(['UPSERT', record_new])
+        _change_record_sets(aws_cli, hosted_zone_id, change_list)
+
+        if weight >= 100:
+            break
+
+        # the step is extended until the new environment has served enough requests to compare
+        start_time = int(time.time())
+        for ii in range(max_step_extension + 1):
+            time.sleep(step_seconds)
+            end_time = int(time.time())
+
+            stat_old = _get_load_balancer_stat(aws_cli, metric_old, start_time, end_time)
+            stat_new = _get_load_balancer_stat(aws_cli, metric_new, start_time, end_time)
+            for ee, ss in ((eb_environment_name_old, stat_old), (eb_environment_name, stat_new)):
+                print('%s: requests %d, latency %.3f seconds, 5xx rate %.4f' %
+                      (ee, ss['requests'], ss['latency'], ss['error_rate']))
+
+            if stat_new['requests'] >= min_request_count:
+                break
+            print('not enough requests to compare (%d < %d)' % (stat_new['requests'], min_request_count))
+
+        if stat_new['requests'] < min_request_count:
+            print_message('roll back %s to %s' % (host, eb_environment_name_old))
+            _restore_simple_record(aws_cli, hosted_zone_id, record_set, record_old, record_new)
+
+            print('ERROR!!! %s served too few requests to compare, traffic is rolled back to %s' %
+                  (eb_environment_name, eb_environment_name_old))
+            raise Exception()
+
+        if _is_regressed(stat_old, stat_new, canary):
+            print_message('roll back %s to %s' % (host, eb_environment_name_old))
+            _restore_simple_record(aws_cli, hosted_zone_id, record_set, record_old, record_new)
+
+            print('ERROR!!! %s regressed, traffic is rolled back to %s' %
+                  (eb_environment_name, eb_environment_name_old))
+            raise Exception()
+
+    return [hosted_zone_id, record_set, record_old, record_new]
+
+
+def restore_record_set(aws_cli, shift_result):
+    # called after the environment CNAMEs are swapped (cname_old points to the new environment);
+    # until then the weighted record of the load balancer keeps the traffic on the new environment
+    hosted_zone_id, record_set, record_old, record_new = shift_result
+
+    _restore_simple_record(aws_cli, hosted_zone_id, record_set, record_old, record_new)
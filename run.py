@@ -18,6 +18,8 @@ command_list.append('create_sns')
 command_list.append('create_sqs')
 command_list.append('create_vpc')
 
+command_list.append('update_eb_scaling')
+
 command_list.append('terminate')
 command_list.append('terminate_cloudwatch_alarm')
 command_list.append('terminate_cloudwatch_dashboard')
@@ -38,13 +40,18 @@ command_list.append('describe_vpc')
 command_list.append('describe_lambda')
 command_list.append('describe_cloudwatch')
 command_list.append('describe_sns')
+command_list.append('top_eb')
 
 command_list.append('alter_database')
+command_list.append('bake_ami')
 command_list.append('export_cloudwatch_dashboard')
+command_list.append('fetch_eb_logs')
+command_list.append('logs')
 command_list.append('mysqldump_data')
 command_list.append('mysqldump_schema')
 command_list.append('reset_database')
 command_list.append('reset_template')
+command_list.append('trace_report')
 
 
 def print_usage():
@@ -65,6 +72,15 @@ def print_usage():
     print('`--force` or `-f`')
     print('\tAttempt to execute the commend without prompting for phase confirmation.')
     print('')
+    print('`--dry-run`')
+    print('\tShow what would be terminated without terminating it. (terminate_eb, terminate_eb_old_environment)')
+    print('')
+    print('`--follow`, `--since MINUTES`, `--filter-pattern PATTERN`')
+    print('\tOptions of logs. (ex: \'./run_logs.py --follow --filter-pattern ERROR nova\')')
+    print('')
+    print('`--since MINUTES`, `--filter-expression EXPRESSION`')
+    print('\tOptions of trace_report. (ex: \'./run_trace_report.py --since 60 nova\')')
+    print('')
     print('#' * 80)
 
 
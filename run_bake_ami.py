@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import os
+import time
+
+from env import env
+from run_common import AWSCli
+from run_common import check_template_availability
+from run_common import eb_solution_stack_name
+from run_common import get_git_hash
+from run_common import get_network_context
+from run_common import print_message
+from run_common import print_session
+
+args = []
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    args = parse_args()
+
+
+def _get_solution_stack_image_id(aws_cli):
+    cmd = ['elasticbeanstalk', 'describe-configuration-options']
+    cmd += ['--solution-stack-name', eb_solution_stack_name]
+    cmd += ['--options', 'Namespace=aws:autoscaling:launchconfiguration,OptionName=ImageId']
+    result = aws_cli.run(cmd)
+
+    for oo in result['Options']:
+        if oo['Name'] == 'ImageId':
+            return oo['DefaultValue']
+
+    print('ERROR!!! AMI of \'%s\' is not found' % eb_solution_stack_name)
+    raise Exception()
+
+
+def _wait_instance_stopped(aws_cli, instance_id):
+    # the provisioning script shuts the builder down when it succeeds
+    elapsed_time = 0
+    while True:
+        cmd = ['ec2', 'describe-instances']
+        cmd += ['--instance-ids', instance_id]
+        cmd += ['--query', 'Reservations[0].Instances[0].State.Name']
+        state = aws_cli.run(cmd)
+
+        if state == 'stopped':
+            return
+
+        if state in ('shutting-down', 'terminated'):
+            print('ERROR!!! builder instance is %s' % state)
+            raise Exception()
+
+        print('provisioning... (state: %s, elapsed time: \'%d\' seconds)' % (state, elapsed_time))
+        time.sleep(15)
+        elapsed_time += 15
+
+        if elapsed_time > 60 * 30:
+            print('ERROR!!! provisioning timed out (see ec2 get-console-output --instance-id %s)' % instance_id)
+            raise Exception()
+
+
+def _deregister_old_images(aws_cli, name, keep_count):
+    # the newest 'keep_count' images are kept for the environments which may still launch instances from them
+    cmd = ['ec2', 'describe-images']
+    cmd += ['--owners', 'self']
+    cmd += ['--filters', 'Name=tag:johanna_bake_ami,Values=%s' % name]
+    result = aws_cli.run(cmd)
+
+    image_list = sorted(result['Images'], key=lambda x: x['CreationDate'], reverse=True)
+    for ii in image_list[keep_count:]:
+        print('deregister %s (%s)' % (ii['ImageId'], ii['CreationDate']))
+
+        cmd = ['ec2', 'deregister-image']
+        cmd += ['--image-id', ii['ImageId']]
+        aws_cli.run(cmd)
+
+        for bb in ii.get('BlockDeviceMappings', list()):
+            snapshot_id = bb.get('Ebs', dict()).get('SnapshotId')
+            if not snapshot_id:
+                continue
+            cmd = ['ec2', 'delete-snapshot']
+            cmd += ['--snapshot-id', snapshot_id]
+            aws_cli.run(cmd, ignore_error=True)
+
+
+def run_bake_ami(name, settings):
+    aws_default_region = settings.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])
+    aws_cli = AWSCli(aws_default_region)
+
+    key_pair_name = env['common']['AWS_KEY_PAIR_NAME']
+    template_name = env['template']['NAME']
+
+    template_path = 'template/%s' % template_name
+    environment_path = '%s/elasticbeanstalk/%s' % (template_path, name)
+    script_path = '%s/%s' % (environment_path, settings.get('BAKE_AMI_SCRIPT', 'configuration/bake_ami.sh'))
+
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
+
+    ################################################################################
+    print_session('bake ami %s' % name)
+
+    if not os.path.exists(script_path):
+        print('skip: %s does not exist' % script_path)
+        return
+
+    image_id = aws_cli.get_baked_image_id(name, git_hash_template)
+    if image_id:
+        print('skip: %s is already baked for template %s' % (image_id, git_hash_template))
+        return
+
+    ################################################################################
+    print_message('get network context')
+
+    network_context = get_network_context(aws_default_region)
+    if not network_context.eb_vpc_id:
+        print('ERROR!!! No VPC found')
+        raise Exception()
+
+    subnet_id = network_context.get_eb_subnet_id_list('private')[0]
+    security_group_id = network_context.get_eb_security_group_id('private')
+
+    ################################################################################
+    print_message('launch builder instance')
+
+    base_image_id = _get_solution_stack_image_id(aws_cli)
+
+    # the static provisioning runs once as user data; the builder stops itself only when it succeeds
+    user_data_path = '%s/bake_ami_user_data.sh' % environment_path
+    with open(script_path) as f:
+        script = f.read()
+    with open(user_data_path, 'w') as f:
+        f.write('#!/bin/bash\n')
+        f.write('cat > /tmp/bake_ami.sh <<\'JOHANNA_BAKE_AMI\'\n')
+        f.write(script.rstrip('\n') + '\n')
+        f.write('JOHANNA_BAKE_AMI\n')
+        f.write('bash -ex /tmp/bake_ami.sh && rm -f /tmp/bake_ami.sh && shutdown -h now\n')
+
+    cmd = ['ec2', 'run-instances']
+    cmd += ['--image-id', base_image_id]
+    cmd += ['--instance-type', settings.get('BAKE_AMI_INSTANCE_TYPE', 't2.small')]
+    cmd += ['--key-name', key_pair_name]
+    cmd += ['--subnet-id', subnet_id]
+    cmd += ['--security-group-ids', security_group_id]
+    cmd += ['--iam-instance-profile', 'Name=aws-elasticbeanstalk-ec2-role']
+    cmd += ['--instance-initiated-shutdown-behavior', 'stop']
+    cmd += ['--user-data', 'file://%s' % os.path.abspath(user_data_path)]
+    cmd += ['--tag-specifications', 'ResourceType=instance,Tags=[{Key=Name,Value=bake_ami_%s}]' % name]
+    result = aws_cli.run(cmd)
+
+    os.remove(user_data_path)
+
+    instance_id = result['Instances'][0]['InstanceId']
+
+    try:
+        _wait_instance_stopped(aws_cli, instance_id)
+
+        ################################################################################
+        print_message('create image')
+
+        # the image and its snapshots are tagged on creation, so a failed wait does not leave an untagged AMI
+        tags = 'Tags=[{Key=johanna_bake_ami,Value=%s},{Key=git_hash_johanna,Value=%s},' \
+               '{Key=git_hash_template,Value=%s}]' % (name, git_hash_johanna, git_hash_template)
+
+        cmd = ['ec2', 'create-image']
+        cmd += ['--instance-id', instance_id]
+        cmd += ['--name', '%s-%s-%s' % (name, git_hash_template[:12], int(time.time()))]
+        cmd += ['--description', 'baked from %s for %s' % (eb_solution_stack_name, name)]
+        cmd += ['--tag-specifications', 'ResourceType=image,%s' % tags, 'ResourceType=snapshot,%s' % tags]
+        result = aws_cli.run(cmd)
+
+        image_id = result['ImageId']
+
+        cmd = ['ec2', 'wait', 'image-available']
+        cmd += ['--image-ids', image_id]
+        aws_cli.run(cmd)
+
+        print('baked AMI: %s' % image_id)
+
+        ################################################################################
+        print_message('deregister old images')
+
+        _deregister_old_images(aws_cli, name, int(settings.get('BAKE_AMI_KEEP', 3)))
+    finally:
+        ################################################################################
+        print_message('terminate builder instance')
+
+        cmd = ['ec2', 'terminate-instances']
+        cmd += ['--instance-ids', instance_id]
+        aws_cli.run(cmd, ignore_error=True)
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('bake ami')
+
+check_template_availability()
+
+eb = env['elasticbeanstalk']
+target_eb_name = None
+
+if len(args) > 1:
+    target_eb_name = args[1]
+
+for eb_env in eb['ENVIRONMENTS']:
+    if target_eb_name and eb_env['NAME'] != target_eb_name:
+        continue
+
+    run_bake_ami(eb_env['NAME'], eb_env)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
+import hashlib
+import ipaddress
 import json
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
 
 from env import env
@@ -40,20 +45,255 @@ def _confirm_phase():
         sys.exit(0)
 
 
+def get_availability_zones(settings):
+    if settings.get('AWS_AVAILABILITY_ZONES'):
+        return list(settings['AWS_AVAILABILITY_ZONES'])
+
+    return [settings['AWS_AVAILABILITY_ZONE_1'], settings['AWS_AVAILABILITY_ZONE_2']]
+
+
+def carve_cidr_subnet(cidr_vpc, tier_index, az_index):
+    # The VPC block is split into 16 subnets (/20 for a /16 VPC).
+    # Tier 0 (private) uses the lower half and tier 1 (public) uses the upper half, one subnet per AZ.
+    network = ipaddress.ip_network(cidr_vpc)
+    subnet_list = list(network.subnets(new_prefix=network.prefixlen + 4))
+    half = len(subnet_list) // 2
+    if az_index >= half:
+        print('ERROR!!! Too many availability zones for', cidr_vpc)
+        raise Exception()
+
+    return str(subnet_list[tier_index * half + az_index])
+
+
+def _cidr_subnet():
+    az_count = 2
+    for vpc_env in env.get('vpc', list()):
+        az_count = max(az_count, len(get_availability_zones(vpc_env)))
+
+    tier_list = list()
+    tier_list.append(['rds', 'private', 0])
+    tier_list.append(['eb', 'private', 0])
+    tier_list.append(['eb', 'public', 1])
+
+    cidr_subnet = dict()
+    for vpc_type, subnet_type, tier_index in tier_list:
+        cidr_subnet.setdefault(vpc_type, dict())
+        for ii in range(az_count):
+            key = '%s_%d' % (subnet_type, ii + 1)
+            config_key = 'AWS_SUBNET_%s_%s' % (vpc_type.upper(), key.upper())
+            cidr = env['common'].get(config_key)
+            if not cidr:
+                cidr = carve_cidr_subnet(env['common']['AWS_VPC_%s' % vpc_type.upper()], tier_index, ii)
+            cidr_subnet[vpc_type][key] = cidr
+
+    return cidr_subnet
+
+
+eb_solution_stack_name = '64bit Amazon Linux 2017.09 v2.6.5 running Python 3.6'
+
+
+def get_xray_sampling_rule_name(name):
+    # one sampling rule per environment of the application; a name longer than 32 characters is
+    # shortened with its hash, so the names of the environments do not collide
+    rule_name = re.sub(r'[^a-zA-Z0-9_-]', '-', '%s-%s' % (env['elasticbeanstalk']['APPLICATION_NAME'], name))
+    if len(rule_name) > 32:
+        rule_name = '%s-%s' % (rule_name[:23], hashlib.sha1(rule_name.encode('utf-8')).hexdigest()[:8])
+    return rule_name
+
+
+def get_lambda_layer_name():
+    # the dependencies of the lambda functions of the template are published as the versions of one layer
+    return '%s-dependencies' % re.sub(r'[^a-zA-Z0-9_-]', '-', env['template']['NAME'])
+
+
+def get_lambda_configuration_args(settings, layer_arn, function_configuration=None):
+    # options of create-function and update-function-configuration;
+    # for an existing function, only the options which differ from 'function_configuration'
+    fc = function_configuration or dict()
+
+    # segments of the function are sent to x-ray when 'XRAY' of the function is set
+    tracing_mode = 'Active' if settings.get('XRAY') else 'PassThrough'
+
+    option_list = list()
+    option_list.append(['--runtime', settings.get('RUNTIME', 'python3.6'), fc.get('Runtime')])
+    option_list.append(['--timeout', str(settings.get('TIMEOUT', 120)), str(fc.get('Timeout'))])
+    option_list.append(['--memory-size', str(settings.get('MEMORY_SIZE', 128)), str(fc.get('MemorySize'))])
+    option_list.append(['--tracing-config', 'Mode=%s' % tracing_mode,
+                        'Mode=%s' % fc.get('TracingConfig', dict()).get('Mode')])
+    if layer_arn:
+        option_list.append(['--layers', layer_arn, ','.join([ll['Arn'] for ll in fc.get('Layers', list())])])
+
+    args = list()
+    for option, value, current_value in option_list:
+        if function_configuration is None or value != current_value:
+            args += [option, value]
+    return args
+
+
+_eb_deployment_policy = dict()
+_eb_deployment_policy['rolling'] = 'Rolling'
+_eb_deployment_policy['immutable'] = 'Immutable'
+_eb_deployment_policy['rolling_with_additional_batch'] = 'RollingWithAdditionalBatch'
+
+# named scaling presets; 'SCALING_TRIGGER' and 'ROLLING_UPDATE' of an environment override each option
+_eb_scaling_preset = dict()
+_eb_scaling_preset['burst'] = dict(
+    INSTANCE_TYPE='t3.small',
+    SCALING_TRIGGER=dict(MeasureName='CPUUtilization', Statistic='Average', Unit='Percent', Period='1',
+                         BreachDuration='1', UpperThreshold='60', UpperBreachScaleIncrement='2',
+                         LowerThreshold='20', LowerBreachScaleIncrement='-1'),
+    ROLLING_UPDATE=dict(RollingUpdateEnabled='true', RollingUpdateType='Health', MaxBatchSize='2'))
+_eb_scaling_preset['steady'] = dict(
+    INSTANCE_TYPE='t3.small',
+    SCALING_TRIGGER=dict(MeasureName='CPUUtilization', Statistic='Average', Unit='Percent', Period='5',
+                         BreachDuration='10', UpperThreshold='75', UpperBreachScaleIncrement='1',
+                         LowerThreshold='30', LowerBreachScaleIncrement='-1'),
+    ROLLING_UPDATE=dict(RollingUpdateEnabled='true', RollingUpdateType='Health', MaxBatchSize='1'))
+_eb_scaling_preset['cpu-bound'] = dict(
+    INSTANCE_TYPE='c5.large',
+    SCALING_TRIGGER=dict(MeasureName='CPUUtilization', Statistic='Maximum', Unit='Percent', Period='1',
+                         BreachDuration='2', UpperThreshold='70', UpperBreachScaleIncrement='1',
+                         LowerThreshold='25', LowerBreachScaleIncrement='-1'),
+    ROLLING_UPDATE=dict(RollingUpdateEnabled='true', RollingUpdateType='Health', MaxBatchSize='1',
+                        MinInstancesInService='1'))
+
+
+def _option_setting(namespace, option_name, value, resource_name=None):
+    oo = dict()
+    oo['Namespace'] = namespace
+    if resource_name:
+        oo['ResourceName'] = resource_name
+    oo['OptionName'] = option_name
+    oo['Value'] = str(value)
+    return oo
+
+
+def get_eb_scaling_option_settings(settings, default_instance_type='t2.nano'):
+    # instance type(s), autoscaling trigger, scheduled actions and rolling update policy of an environment
+    preset = dict()
+    if settings.get('SCALING_PRESET'):
+        if settings['SCALING_PRESET'] not in _eb_scaling_preset:
+            print('ERROR!!! unknown SCALING_PRESET: %s' % settings['SCALING_PRESET'])
+            raise Exception()
+        preset = _eb_scaling_preset[settings['SCALING_PRESET']]
+
+    option_settings = list()
+
+    instance_type = settings.get('INSTANCE_TYPE') or preset.get('INSTANCE_TYPE', default_instance_type)
+    if isinstance(instance_type, list):
+        # several instance types need a platform which supports the 'aws:ec2:instances' namespace
+        option_settings.append(_option_setting('aws:ec2:instances', 'InstanceTypes', ','.join(instance_type)))
+    else:
+        option_settings.append(_option_setting('aws:autoscaling:launchconfiguration', 'InstanceType',
+                                               instance_type))
+
+    trigger = dict(preset.get('SCALING_TRIGGER', dict()))
+    trigger.update(settings.get('SCALING_TRIGGER', dict()))
+    for key in sorted(trigger):
+        option_settings.append(_option_setting('aws:autoscaling:trigger', key, trigger[key]))
+
+    for ss in settings.get('SCALING_SCHEDULE', list()):
+        for key in sorted(ss):
+            if key == 'NAME':
+                continue
+            option_settings.append(_option_setting('aws:autoscaling:scheduledaction', key, ss[key], ss['NAME']))
+
+    rolling_update = dict(preset.get('ROLLING_UPDATE', dict()))
+    rolling_update.update(settings.get('ROLLING_UPDATE', dict()))
+    for key in sorted(rolling_update):
+        option_settings.append(_option_setting('aws:autoscaling:updatepolicy:rollingupdate', key,
+                                               rolling_update[key]))
+
+    return option_settings
+
+
+def get_eb_cloudwatch_logs_option_settings(settings):
+    # instance logs and enhanced health events streamed to cloudwatch logs ('CLOUDWATCH_LOGS' of an environment)
+    logs = settings.get('CLOUDWATCH_LOGS')
+    if not logs:
+        return list()
+
+    option_settings = list()
+
+    namespace = 'aws:elasticbeanstalk:cloudwatch:logs'
+    option_settings.append(_option_setting(namespace, 'StreamLogs', str(logs.get('STREAM_LOGS', True)).lower()))
+    option_settings.append(_option_setting(namespace, 'DeleteOnTerminate',
+                                           str(logs.get('DELETE_ON_TERMINATE', False)).lower()))
+    option_settings.append(_option_setting(namespace, 'RetentionInDays', logs.get('RETENTION_IN_DAYS', 7)))
+
+    namespace = 'aws:elasticbeanstalk:cloudwatch:logs:health'
+    option_settings.append(_option_setting(namespace, 'HealthStreamingEnabled',
+                                           str(logs.get('HEALTH_STREAMING', False)).lower()))
+    option_settings.append(_option_setting(namespace, 'DeleteOnTerminate',
+                                           str(logs.get('DELETE_ON_TERMINATE', False)).lower()))
+    option_settings.append(_option_setting(namespace, 'RetentionInDays',
+                                           logs.get('HEALTH_RETENTION_IN_DAYS', logs.get('RETENTION_IN_DAYS', 7))))
+
+    return option_settings
+
+
+def get_eb_xray_option_settings(settings):
+    # the x-ray daemon on the instances ('XRAY' of an environment)
+    if not settings.get('XRAY'):
+        return list()
+
+    return [_option_setting('aws:elasticbeanstalk:xray', 'XRayEnabled', 'true')]
+
+
+def get_eb_load_balancer_option_settings(settings, ssl_certificate_id):
+    # application load balancer (HTTP/2 is negotiated on the HTTPS listener) with the processes and
+    # the path based listener rules of 'LOAD_BALANCER' of an environment;
+    # the classic load balancer is kept when 'LOAD_BALANCER' is not configured
+    lb = settings.get('LOAD_BALANCER')
+    if not lb or lb.get('TYPE', 'application') != 'application':
+        return list()
+
+    option_settings = list()
+    option_settings.append(_option_setting('aws:elasticbeanstalk:environment', 'LoadBalancerType', 'application'))
+    option_settings.append(_option_setting('aws:elbv2:loadbalancer', 'IdleTimeout', lb.get('IDLE_TIMEOUT', 60)))
+
+    option_settings.append(_option_setting('aws:elbv2:listener:443', 'Protocol', 'HTTPS'))
+    option_settings.append(_option_setting('aws:elbv2:listener:443', 'SSLCertificateArns', ssl_certificate_id))
+    option_settings.append(_option_setting('aws:elbv2:listener:443', 'SSLPolicy',
+                                           lb.get('SSL_POLICY', 'ELBSecurityPolicy-TLS-1-2-2017-01')))
+
+    process_list = dict()
+    # the health check path is left to the environment (.ebextensions or 'PROCESS')
+    process_list['default'] = dict(DeregistrationTimeout='20', HealthCheckInterval='15', HealthCheckTimeout='5',
+                                   HealthyThresholdCount='3', UnhealthyThresholdCount='5', StickinessEnabled='false')
+    for name in lb.get('PROCESS', dict()):
+        process_list.setdefault(name, dict())
+        process_list[name].update(lb['PROCESS'][name])
+
+    for name in sorted(process_list):
+        namespace = 'aws:elasticbeanstalk:environment:process:%s' % name
+        for key in sorted(process_list[name]):
+            option_settings.append(_option_setting(namespace, key, process_list[name][key]))
+
+    rule_list = lb.get('RULES', list())
+    if rule_list:
+        for ll in ('80', '443'):
+            option_settings.append(_option_setting('aws:elbv2:listener:%s' % ll, 'Rules',
+                                                   ','.join([rr['NAME'] for rr in rule_list])))
+
+    for rr in rule_list:
+        namespace = 'aws:elbv2:listenerrule:%s' % rr['NAME']
+        path_patterns = rr['PATH_PATTERNS']
+        if isinstance(path_patterns, list):
+            path_patterns = ','.join(path_patterns)
+        option_settings.append(_option_setting(namespace, 'PathPatterns', path_patterns))
+        option_settings.append(_option_setting(namespace, 'Process', rr['PROCESS']))
+        option_settings.append(_option_setting(namespace, 'Priority', rr['PRIORITY']))
+
+    return option_settings
+
+
 class AWSCli:
     cidr_vpc = dict()
     cidr_vpc['rds'] = env['common']['AWS_VPC_RDS']
     cidr_vpc['eb'] = env['common']['AWS_VPC_EB']
 
-    cidr_subnet = dict()
-    cidr_subnet['rds'] = dict()
-    cidr_subnet['rds']['private_1'] = env['common']['AWS_SUBNET_RDS_PRIVATE_1']
-    cidr_subnet['rds']['private_2'] = env['common']['AWS_SUBNET_RDS_PRIVATE_2']
-    cidr_subnet['eb'] = dict()
-    cidr_subnet['eb']['private_1'] = env['common']['AWS_SUBNET_EB_PRIVATE_1']
-    cidr_subnet['eb']['private_2'] = env['common']['AWS_SUBNET_EB_PRIVATE_2']
-    cidr_subnet['eb']['public_1'] = env['common']['AWS_SUBNET_EB_PUBLIC_1']
-    cidr_subnet['eb']['public_2'] = env['common']['AWS_SUBNET_EB_PUBLIC_2']
+    cidr_subnet = _cidr_subnet()
 
     def __init__(self, aws_default_region=None):
         if not env['aws'].get('AWS_ACCESS_KEY_ID') or \
@@ -68,13 +308,16 @@ class AWSCli:
             if not aws_default_region \
             else aws_default_region
 
-    def run(self, args, cwd=None, ignore_error=None):
+    def run(self, args, cwd=None, ignore_error=None, quiet=None):
         args = ['aws'] + args
-        if ignore_error:
+        if quiet:
+            pass
+        elif ignore_error:
             print('\n>> command(ignore error): [%s]' % self.env['AWS_DEFAULT_REGION'], end=" ")
+            print(' '.join(args))
         else:
             print('\n>> command: [%s]' % self.env['AWS_DEFAULT_REGION'], end=" ")
-        print(' '.join(args))
+            print(' '.join(args))
         _p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                               cwd=cwd, env=self.env)
         result, error = _p.communicate()
@@ -103,19 +346,26 @@ class AWSCli:
         return dict()
 
     def get_vpc_id(self):
-        rds_vpc_id = None
         cmd = ['ec2', 'describe-vpcs']
-        cmd += ['--filters=Name=cidr,Values=%s' % self.cidr_vpc['rds']]
+        cmd += ['--filters=Name=cidr,Values=%s,%s' % (self.cidr_vpc['rds'], self.cidr_vpc['eb'])]
         result = self.run(cmd)
-        if len(result['Vpcs']) == 1:
-            rds_vpc_id = dict(result['Vpcs'][0])['VpcId']
+
+        vpc_id_list = dict()
+        vpc_id_list['rds'] = list()
+        vpc_id_list['eb'] = list()
+        for r in result['Vpcs']:
+            if r['CidrBlock'] == self.cidr_vpc['rds']:
+                vpc_id_list['rds'].append(r['VpcId'])
+            if r['CidrBlock'] == self.cidr_vpc['eb']:
+                vpc_id_list['eb'].append(r['VpcId'])
+
+        rds_vpc_id = None
+        if len(vpc_id_list['rds']) == 1:
+            rds_vpc_id = vpc_id_list['rds'][0]
 
         eb_vpc_id = None
-        cmd = ['ec2', 'describe-vpcs']
-        cmd += ['--filters=Name=cidr,Values=%s' % self.cidr_vpc['eb']]
-        result = self.run(cmd)
-        if len(result['Vpcs']) == 1:
-            eb_vpc_id = dict(result['Vpcs'][0])['VpcId']
+        if len(vpc_id_list['eb']) == 1:
+            eb_vpc_id = vpc_id_list['eb'][0]
 
         return rds_vpc_id, eb_vpc_id
 
@@ -289,6 +539,85 @@ class AWSCli:
         cmd += ['--tags', 'Key=Name,Value=%s' % name]
         self.run(cmd)
 
+    def get_lambda_function_list(self):
+        # {function name: configuration} of all functions of the region
+        function_list = dict()
+        marker = None
+        while True:
+            cmd = ['lambda', 'list-functions']
+            cmd += ['--no-paginate']
+            if marker:
+                cmd += ['--marker', marker]
+            result = self.run(cmd)
+
+            for ff in result['Functions']:
+                function_list[ff['FunctionName']] = ff
+
+            marker = result.get('NextMarker')
+            if not marker:
+                return function_list
+
+    def update_lambda_concurrency(self, function_name, settings, function_exists):
+        # reserved concurrency of the function and provisioned concurrency on the alias ('ALIAS') of the
+        # published version; returns the arn of the alias which the invokers use, or None
+        if settings.get('RESERVED_CONCURRENCY') is not None:
+            cmd = ['lambda', 'put-function-concurrency']
+            cmd += ['--function-name', function_name]
+            cmd += ['--reserved-concurrent-executions', str(settings['RESERVED_CONCURRENCY'])]
+            self.run(cmd)
+        elif function_exists:
+            cmd = ['lambda', 'delete-function-concurrency']
+            cmd += ['--function-name', function_name]
+            self.run(cmd)
+
+        alias_name = settings.get('ALIAS', 'live')
+        alias = None
+        if function_exists:
+            cmd = ['lambda', 'get-alias']
+            cmd += ['--function-name', function_name]
+            cmd += ['--name', alias_name]
+            alias = self.run(cmd, ignore_error=True, quiet=True)
+
+        if not settings.get('PROVISIONED_CONCURRENCY'):
+            if alias:
+                # the invokers of the alias get the latest code without provisioned concurrency
+                cmd = ['lambda', 'delete-provisioned-concurrency-config']
+                cmd += ['--function-name', function_name]
+                cmd += ['--qualifier', alias_name]
+                self.run(cmd, ignore_error=True)
+
+                cmd = ['lambda', 'update-alias']
+                cmd += ['--function-name', function_name]
+                cmd += ['--name', alias_name]
+                cmd += ['--function-version', '$LATEST']
+                self.run(cmd)
+                return alias['AliasArn']
+            return None
+
+        # a version can be published only after the code and the configuration are updated
+        for waiter in ('function-active', 'function-updated'):
+            cmd = ['lambda', 'wait', waiter]
+            cmd += ['--function-name', function_name]
+            self.run(cmd, ignore_error=True)
+
+        cmd = ['lambda', 'publish-version']
+        cmd += ['--function-name', function_name]
+        version = self.run(cmd)['Version']
+
+        cmd = ['lambda', 'update-alias' if alias else 'create-alias']
+        cmd += ['--function-name', function_name]
+        cmd += ['--name', alias_name]
+        cmd += ['--function-version', version]
+        alias_arn = self.run(cmd)['AliasArn']
+
+        cmd = ['lambda', 'put-provisioned-concurrency-config']
+        cmd += ['--function-name', function_name]
+        cmd += ['--qualifier', alias_name]
+        cmd += ['--provisioned-concurrent-executions', str(settings['PROVISIONED_CONCURRENCY'])]
+        self.run(cmd)
+
+        return alias_arn
+
     def wait_terminate_lambda(self):
         cmd = ['lambda', 'list-functions']
 
@@ -358,6 +687,179 @@ class AWSCli:
             time.sleep(5)
             elapsed_time += 5
 
+    def wait_eb_environment_ready(self, eb_application_name, eb_environment_name, start_timestamp):
+        # only new events are fetched and printed; the status probe backs off while nothing happens
+        start_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(start_timestamp)))
+        event_seen = set()
+        interval = 5
+
+        elapsed_time = 0
+        while True:
+            cmd = ['elasticbeanstalk', 'describe-events']
+            cmd += ['--application-name', eb_application_name]
+            cmd += ['--environment-name', eb_environment_name]
+            cmd += ['--start-time', start_time]
+            result = self.run(cmd)
+
+            new_event = False
+            for ee in sorted(result['Events'], key=lambda x: x['EventDate']):
+                key = (ee['EventDate'], ee['Message'])
+                if key in event_seen:
+                    continue
+                event_seen.add(key)
+                new_event = True
+                start_time = ee['EventDate']
+
+                print('%s %-5s %s' % (ee['EventDate'], ee['Severity'], ee['Message']))
+                if ee['Severity'] in ('ERROR', 'FATAL'):
+                    print('ERROR!!! %s' % eb_environment_name)
+                    raise Exception()
+
+            cmd = ['elasticbeanstalk', 'describe-environments']
+            cmd += ['--application-name', eb_application_name]
+            cmd += ['--environment-names', eb_environment_name]
+            cmd += ['--query', 'Environments[0].{Status:Status,Health:Health}']
+            ee = self.run(cmd) or dict()
+
+            if ee.get('Health', '') == 'Green' and ee.get('Status', '') == 'Ready':
+                break
+
+            if new_event:
+                interval = 5
+            else:
+                interval = min(interval * 2, 30)
+
+            print('creating... (status: %s, health: %s, elapsed time: \'%d\' seconds)' %
+                  (ee.get('Status'), ee.get('Health'), elapsed_time))
+            time.sleep(interval)
+            elapsed_time += interval
+
+            if elapsed_time > 60 * 30:
+                raise Exception()
+
+    def update_eb_environment_version(self, eb_application_name, eb_environment_name, version_label, settings,
+                                      tag_list=None):
+        deploy_mode = settings.get('DEPLOY_MODE', 'bluegreen')
+        if deploy_mode not in _eb_deployment_policy:
+            print('ERROR!!! unknown DEPLOY_MODE: %s' % deploy_mode)
+            raise Exception()
+
+        option_settings = get_eb_scaling_option_settings(settings)
+        option_settings += get_eb_cloudwatch_logs_option_settings(settings)
+        option_settings += get_eb_xray_option_settings(settings)
+
+        oo = dict()
+        oo['Namespace'] = 'aws:elasticbeanstalk:command'
+        oo['OptionName'] = 'DeploymentPolicy'
+        oo['Value'] = _eb_deployment_policy[deploy_mode]
+        option_settings.append(oo)
+
+        if deploy_mode != 'immutable':
+            oo = dict()
+            oo['Namespace'] = 'aws:elasticbeanstalk:command'
+            oo['OptionName'] = 'BatchSizeType'
+            oo['Value'] = settings.get('DEPLOY_BATCH_SIZE_TYPE', 'Percentage')
+            option_settings.append(oo)
+
+            oo = dict()
+            oo['Namespace'] = 'aws:elasticbeanstalk:command'
+            oo['OptionName'] = 'BatchSize'
+            oo['Value'] = str(settings.get('DEPLOY_BATCH_SIZE', '30'))
+            option_settings.append(oo)
+
+        str_timestamp = str(int(time.time()))
+
+        cmd = ['elasticbeanstalk', 'update-environment']
+        cmd += ['--application-name', eb_application_name]
+        cmd += ['--environment-name', eb_environment_name]
+        cmd += ['--option-settings', json.dumps(option_settings)]
+        cmd += ['--version-label', version_label]
+        self.run(cmd)
+
+        self.wait_eb_environment_ready(eb_application_name, eb_environment_name, str_timestamp)
+
+        if not tag_list:
+            return
+
+        cmd = ['elasticbeanstalk', 'describe-environments']
+        cmd += ['--application-name', eb_application_name]
+        cmd += ['--environment-names', eb_environment_name]
+        result = self.run(cmd)
+
+        cmd = ['elasticbeanstalk', 'update-tags-for-resource']
+        cmd += ['--resource-arn', result['Environments'][0]['EnvironmentArn']]
+        cmd += ['--tags-to-add'] + tag_list
+        self.run(cmd)
+
+    def get_baked_image_id(self, name, git_hash_template):
+        # the newest AMI baked by 'bake_ami' for the environment and the current template
+        cmd = ['ec2', 'describe-images']
+        cmd += ['--owners', 'self']
+        cmd += ['--filters',
+                'Name=tag:johanna_bake_ami,Values=%s' % name,
+                'Name=tag:git_hash_template,Values=%s' % git_hash_template,
+                'Name=state,Values=available']
+        result = self.run(cmd)
+
+        image_list = sorted(result['Images'], key=lambda x: x['CreationDate'])
+        if not image_list:
+            return None
+
+        return image_list[-1]['ImageId']
+
+    def set_log_retention(self, log_group_name, retention_in_days):
+        cmd = ['logs', 'create-log-group']
+        cmd += ['--log-group-name', log_group_name]
+        self.run(cmd, ignore_error=True)
+
+        cmd = ['logs', 'put-retention-policy']
+        cmd += ['--log-group-name', log_group_name]
+        cmd += ['--retention-in-days', str(retention_in_days)]
+        self.run(cmd)
+
+    def put_xray_sampling_rule(self, rule_name, xray, host='*'):
+        # the centralized sampling rule of the x-ray sdk in the application ('XRAY' of an environment)
+        if not isinstance(xray, dict):
+            xray = dict()
+
+        rule = dict()
+        rule['RuleName'] = rule_name
+        rule['ResourceARN'] = '*'
+        rule['Priority'] = int(xray.get('PRIORITY', 1000))
+        rule['FixedRate'] = float(xray.get('SAMPLING_RATE', 0.05))
+        rule['ReservoirSize'] = int(xray.get('RESERVOIR_SIZE', 1))
+        rule['ServiceName'] = xray.get('SERVICE_NAME', '*')
+        rule['ServiceType'] = '*'
+        rule['Host'] = host
+        rule['HTTPMethod'] = xray.get('HTTP_METHOD', '*')
+        rule['URLPath'] = xray.get('URL_PATH', '*')
+
+        cmd = ['xray', 'get-sampling-rules']
+        result = self.run(cmd, quiet=True)
+
+        for rr in result['SamplingRuleRecords']:
+            if rr['SamplingRule']['RuleName'] == rule['RuleName']:
+                cmd = ['xray', 'update-sampling-rule']
+                cmd += ['--sampling-rule-update', json.dumps(rule)]
+                self.run(cmd)
+                return
+
+        rule['Version'] = 1
+        cmd = ['xray', 'create-sampling-rule']
+        cmd += ['--sampling-rule', json.dumps(rule)]
+        self.run(cmd)
+
+    def delete_xray_sampling_rule(self, rule_name):
+        cmd = ['xray', 'get-sampling-rules']
+        result = self.run(cmd, quiet=True)
+
+        for rr in result['SamplingRuleRecords']:
+            if rr['SamplingRule']['RuleName'] == rule_name:
+                cmd = ['xray', 'delete-sampling-rule']
+                cmd += ['--rule-name', rule_name]
+                self.run(cmd)
+                return
+
     def wait_create_nat_gateway(self, eb_vpc_id=None):
         cmd = ['ec2', 'describe-nat-gateways']
 
@@ -399,6 +901,420 @@ class AWSCli:
             elapsed_time += 5
 
 
+class NetworkContext:
+    def __init__(self, aws_cli):
+        self.aws_cli = aws_cli
+
+        service_name = env['common'].get('SERVICE_NAME', '')
+        name_prefix = '%s_' % service_name if service_name else ''
+
+        self.rds_vpc_id, self.eb_vpc_id = aws_cli.get_vpc_id()
+        self.eb_subnet_id = dict()
+        self.eb_security_group_id = dict()
+        self._db_address = dict()
+        self._cache_address = None
+        self._lock = threading.Lock()
+
+        if not self.eb_vpc_id:
+            return
+
+        cidr_key = dict()
+        for key in aws_cli.cidr_subnet['eb']:
+            cidr_key[aws_cli.cidr_subnet['eb'][key]] = key
+
+        cmd = ['ec2', 'describe-subnets']
+        cmd += ['--filters=Name=vpc-id,Values=%s' % self.eb_vpc_id]
+        result = aws_cli.run(cmd)
+        for r in result['Subnets']:
+            if r['CidrBlock'] in cidr_key:
+                self.eb_subnet_id[cidr_key[r['CidrBlock']]] = r['SubnetId']
+
+        cmd = ['ec2', 'describe-security-groups']
+        cmd += ['--filters=Name=vpc-id,Values=%s' % self.eb_vpc_id]
+        result = aws_cli.run(cmd)
+        for r in result['SecurityGroups']:
+            if r['GroupName'] == '%seb_public' % name_prefix:
+                self.eb_security_group_id['public'] = r['GroupId']
+            if r['GroupName'] == '%seb_private' % name_prefix:
+                self.eb_security_group_id['private'] = r['GroupId']
+
+    @staticmethod
+    def _check_subnet_type(subnet_type):
+        if subnet_type not in ('public', 'private'):
+            print('ERROR!!! Unknown subnet type:', subnet_type)
+            raise Exception()
+
+    def get_eb_subnet_id_list(self, subnet_type):
+        self._check_subnet_type(subnet_type)
+
+        subnet_list = list()
+        for key in self.eb_subnet_id:
+            if key.startswith('%s_' % subnet_type):
+                subnet_list.append([int(key.split('_')[-1]), self.eb_subnet_id[key]])
+
+        return [ss[1] for ss in sorted(subnet_list)]
+
+    def get_eb_security_group_id(self, subnet_type):
+        self._check_subnet_type(subnet_type)
+
+        return self.eb_security_group_id.get(subnet_type)
+
+    def get_db_address(self, read_replica=None):
+        key = 'read_replica' if read_replica else 'master'
+        with self._lock:
+            if key not in self._db_address:
+                self._db_address[key] = self.aws_cli.get_rds_address(read_replica=read_replica)
+
+        return self._db_address[key]
+
+    def get_cache_address(self):
+        with self._lock:
+            if not self._cache_address:
+                self._cache_address = self.aws_cli.get_elasticache_address()
+
+        return self._cache_address
+
+
+_network_context = dict()
+
+
+def get_network_context(aws_default_region=None):
+    if not aws_default_region:
+        aws_default_region = env['aws']['AWS_DEFAULT_REGION']
+
+    if aws_default_region not in _network_context:
+        print_message('resolve network context (%s)' % aws_default_region)
+        _network_context[aws_default_region] = NetworkContext(AWSCli(aws_default_region))
+
+    return _network_context[aws_default_region]
+
+
+class _PrefixedStdout:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        prefix = getattr(self.local, 'prefix', None)
+        if not prefix:
+            return self.stream.write(text)
+
+        lines = (getattr(self.local, 'buffer', '') + text).split('\n')
+        self.local.buffer = lines.pop()
+        with self.lock:
+            for ll in lines:
+                self.stream.write('[%s] %s\n' % (prefix, ll))
+        return len(text)
+
+    def flush(self):
+        prefix = getattr(self.local, 'prefix', None)
+        buffer = getattr(self.local, 'buffer', '')
+        if prefix and buffer:
+            self.local.buffer = ''
+            with self.lock:
+                self.stream.write('[%s] %s\n' % (prefix, buffer))
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _prefixed_stdout():
+    # the wrapper is installed once and never removed; each thread keeps its own prefix
+    if not isinstance(sys.stdout, _PrefixedStdout):
+        sys.stdout = _PrefixedStdout(sys.stdout)
+    return sys.stdout
+
+
+def _job_prefix(prefix):
+    # a job of a nested run_parallel() is prefixed with the prefix of its parent job
+    parent_prefix = getattr(_prefixed_stdout().local, 'prefix', None)
+    if parent_prefix:
+        return '%s/%s' % (parent_prefix, prefix)
+    return prefix
+
+
+def _run_job(prefix, func, args):
+    stdout = _prefixed_stdout()
+    parent_prefix = getattr(stdout.local, 'prefix', None)
+    stdout.local.prefix = prefix
+    try:
+        return func(*args)
+    finally:
+        stdout.flush()
+        stdout.local.prefix = parent_prefix
+
+
+def _forward_output(stream, prefix):
+    stdout = _prefixed_stdout()
+    stdout.local.prefix = prefix
+    for line in iter(stream.readline, b''):
+        stdout.write(line.decode('utf-8', errors='replace'))
+    stdout.flush()
+
+
+def run_subprocess(args, cwd=None, env=None, writer=None):
+    # the output of the subprocess goes through sys.stdout, so it keeps the prefix of run_parallel();
+    # 'writer' writes the standard input of the subprocess
+    prefix = getattr(_prefixed_stdout().local, 'prefix', None)
+    _p = subprocess.Popen(args, stdin=subprocess.PIPE if writer else None, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, cwd=cwd, env=env)
+    thread = threading.Thread(target=_forward_output, args=(_p.stdout, prefix))
+    thread.start()
+    try:
+        if writer:
+            writer(_p.stdin)
+    finally:
+        if writer:
+            # noinspection PyBroadException
+            try:
+                _p.stdin.close()
+            except Exception:
+                pass
+        _p.wait()
+        thread.join()
+
+    return _p.returncode
+
+
+def run_parallel(job_list, max_workers):
+    # job_list: list of [prefix of the log output, function, arguments]
+    if max_workers < 2 or len(job_list) < 2:
+        return [func(*args) for prefix, func, args in job_list]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_list = list()
+        for prefix, func, args in job_list:
+            future_list.append([prefix, executor.submit(_run_job, _job_prefix(prefix), func, args)])
+
+        result_list = list()
+        failed_list = list()
+        for prefix, ff in future_list:
+            # noinspection PyBroadException
+            try:
+                result_list.append(ff.result())
+            except Exception:
+                result_list.append(None)
+                failed_list.append(prefix)
+                traceback.print_exc()
+
+    if failed_list:
+        print('ERROR!!! failed:', ', '.join(failed_list))
+        raise Exception()
+
+    return result_list
+
+
+def _describe_eb_environments(aws_default_region, environment_name_list=None):
+    aws_cli = AWSCli(aws_default_region)
+
+    cmd = ['elasticbeanstalk', 'describe-environments']
+    cmd += ['--application-name', env['elasticbeanstalk']['APPLICATION_NAME']]
+    if environment_name_list:
+        cmd += ['--environment-names'] + environment_name_list
+    return aws_cli.run(cmd)['Environments']
+
+
+def describe_eb_environments(region_list, environment_name_list=None):
+    # describe-environments of every region at once; returns {region: environments}
+    # environment_name_list: {region: names} (None for every environment)
+    job_list = list()
+    for rr in region_list:
+        name_list = environment_name_list[rr] if environment_name_list else None
+        job_list.append([rr, _describe_eb_environments, (rr, name_list)])
+
+    result_list = run_parallel(job_list, len(job_list))
+    return dict(zip(region_list, result_list))
+
+
+def get_live_eb_environment_list():
+    # [region, environment name] of the environments which own the CNAMEs in config.json
+    region_list = list()
+    cname_list = dict()
+    for eb_env in env['elasticbeanstalk']['ENVIRONMENTS']:
+        region = eb_env.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])
+        cname_list['%s.%s.elasticbeanstalk.com' % (eb_env['CNAME'], region)] = region
+        if region not in region_list:
+            region_list.append(region)
+
+    live_environment_list = list()
+    environment_list = describe_eb_environments(region_list)
+    for region in region_list:
+        for r in environment_list[region]:
+            if r['Status'] == 'Terminated' or cname_list.get(r.get('CNAME')) != region:
+                continue
+            live_environment_list.append([region, r['EnvironmentName']])
+    return live_environment_list
+
+
+def _terminate_eb_environment(aws_default_region, environment_name):
+    aws_cli = AWSCli(aws_default_region)
+
+    cmd = ['elasticbeanstalk', 'terminate-environment']
+    cmd += ['--environment-name', environment_name]
+    aws_cli.run(cmd, ignore_error=True)
+
+
+def reap_eb_environments(candidate_list, dry_run=False):
+    # candidate_list: list of [region, environment name, reason]
+    # every 'Ready' candidate is terminated at once and all of them are waited for with one poll per round
+    print('%-16s %-40s %s' % ('REGION', 'ENVIRONMENT', 'REASON'))
+    for region, environment_name, reason in candidate_list:
+        print('%-16s %-40s %s' % (region, environment_name, reason))
+
+    if dry_run or not candidate_list:
+        if dry_run:
+            print('dry run: nothing is terminated')
+        return
+
+    pending = dict()
+    for region, environment_name, reason in candidate_list:
+        pending.setdefault(region, list())
+        pending[region].append(environment_name)
+
+    requested = set()
+    elapsed_time = 0
+    while pending:
+        environment_list = describe_eb_environments(sorted(pending), pending)
+
+        job_list = list()
+        status_list = list()
+        for region in sorted(environment_list):
+            status = dict()
+            for r in environment_list[region]:
+                status[r['EnvironmentName']] = r['Status']
+
+            for environment_name in list(pending[region]):
+                ss = status.get(environment_name, 'Terminated')
+                if ss == 'Terminated':
+                    pending[region].remove(environment_name)
+                    continue
+
+                status_list.append('%s(%s)' % (environment_name, ss))
+                if ss == 'Ready' and (region, environment_name) not in requested:
+                    requested.add((region, environment_name))
+                    job_list.append(['%s %s' % (region, environment_name), _terminate_eb_environment,
+                                     (region, environment_name)])
+
+            if not pending[region]:
+                del pending[region]
+
+        if job_list:
+            run_parallel(job_list, len(job_list))
+
+        if not pending:
+            break
+
+        print('deleting the environments... %s (elapsed time: \'%d\' seconds)' %
+              (', '.join(status_list), elapsed_time))
+        time.sleep(10)
+        elapsed_time += 10
+
+        if elapsed_time > 60 * 30:
+            print('ERROR!!! timed out: %s' % ', '.join(status_list))
+            raise Exception()
+
+
+_git_lock = threading.Lock()
+_git_url_lock = dict()
+_git_hash = dict()
+
+
+def _run_git(args, cwd=None, stdout=None):
+    args = ['git'] + args
+    print('\n>> command:', ' '.join(args))
+    if stdout:
+        _p = subprocess.Popen(args, stdout=stdout, cwd=cwd)
+        result = _p.communicate()[0]
+        returncode = _p.returncode
+    else:
+        result = None
+        returncode = run_subprocess(args, cwd=cwd)
+
+    if returncode != 0:
+        print('command returns: %s' % returncode)
+        raise Exception()
+
+    return result
+
+
+def _git_mirror(git_url, branch=None):
+    # a bare mirror per repository is kept under 'cache/git' and only new objects are fetched
+    mirror_name = '%s-%s.git' % (os.path.basename(git_url.rstrip('/')).replace('.git', ''),
+                                 hashlib.sha1(git_url.encode('utf-8')).hexdigest()[:12])
+    mirror_path = os.path.abspath('cache/git/%s' % mirror_name)
+
+    with _git_lock:
+        if git_url not in _git_url_lock:
+            _git_url_lock[git_url] = threading.Lock()
+        url_lock = _git_url_lock[git_url]
+
+    with url_lock:
+        if not os.path.exists(mirror_path):
+            os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+            _run_git(['clone', '--mirror', git_url, mirror_path])
+        else:
+            _run_git(['fetch', '--prune', 'origin'], cwd=mirror_path)
+
+        ref = '%s^{commit}' % (branch if branch else 'HEAD')
+        git_hash = _run_git(['rev-parse', ref], cwd=mirror_path, stdout=subprocess.PIPE)
+
+    return mirror_path, git_hash.decode('utf-8').strip()
+
+
+def git_export(git_url, branch, target_path):
+    mirror_path, git_hash = _git_mirror(git_url, branch)
+
+    subprocess.Popen(['rm', '-rf', target_path]).communicate()
+    os.makedirs(target_path)
+
+    print('\n>> command: git archive %s | tar -x -C %s' % (git_hash, target_path))
+    _archive = subprocess.Popen(['git', 'archive', git_hash], stdout=subprocess.PIPE, cwd=mirror_path)
+    _tar = subprocess.Popen(['tar', '-x', '-C', target_path], stdin=_archive.stdout)
+    _archive.stdout.close()
+    _tar.communicate()
+    _archive.wait()
+
+    if _archive.returncode != 0 or _tar.returncode != 0:
+        raise Exception()
+
+    _git_hash[os.path.abspath(target_path)] = git_hash
+    return git_hash
+
+
+def git_worktree(git_url, branch, target_path):
+    mirror_path, git_hash = _git_mirror(git_url, branch)
+
+    subprocess.Popen(['rm', '-rf', target_path]).communicate()
+    _run_git(['worktree', 'prune'], cwd=mirror_path)
+    _run_git(['worktree', 'add', '--detach', os.path.abspath(target_path), git_hash], cwd=mirror_path)
+
+    _git_hash[os.path.abspath(target_path)] = git_hash
+    return git_hash
+
+
+def get_git_hash(path='.'):
+    # commit hashes are resolved once per run
+    path = os.path.abspath(path)
+    if path not in _git_hash:
+        git_hash = _run_git(['rev-parse', 'HEAD'], cwd=path, stdout=subprocess.PIPE)
+        _git_hash[path] = git_hash.decode('utf-8').strip()
+
+    return _git_hash[path]
+
+
+_options = dict()
+
+
+def get_option(name):
+    return _options.get(name)
+
+
+def is_dry_run():
+    return bool(get_option('dry_run'))
+
+
 def parse_args(require_arg=False):
     if require_arg:
         usage = 'usage: %prog [options] arg'
@@ -407,8 +1323,15 @@ def parse_args(require_arg=False):
 
     parser = OptionParser(usage=usage)
     parser.add_option("-f", "--force", action="store_true", help='skip the phase confirm')
+    parser.add_option("--dry-run", action="store_true", help='show what would be done without doing it')
+    parser.add_option("--follow", action="store_true", help='keep printing new log events (logs)')
+    parser.add_option("--since", default='10', help='minutes of log events or traces to read (logs, trace_report)')
+    parser.add_option("--filter-pattern", help='cloudwatch logs filter pattern (logs)')
+    parser.add_option("--filter-expression", help='x-ray filter expression (trace_report)')
     (options, args) = parser.parse_args(sys.argv)
 
+    _options.update(vars(options))
+
     if not options.force:
         _confirm_phase()
 
@@ -451,6 +1374,71 @@ def re_sub_lines(lines, pattern, repl):
     return new_lines
 
 
+_template_lines = dict()
+_compiled_rules = dict()
+
+
+def _compile_rules(pattern_list):
+    # all patterns are compiled into one alternation; each rule is wrapped in its own group and
+    # rules are tried in reverse order, so the last rule wins where several rules match at the same position;
+    # a line is scanned once, so unlike a chain of 're_sub_lines' the output of a rule is not matched again
+    if pattern_list not in _compiled_rules:
+        group_index = dict()
+        alternation = list()
+        index = 1
+        for ii in reversed(range(len(pattern_list))):
+            alternation.append('(%s)' % pattern_list[ii])
+            group_index[index] = ii
+            index += re.compile(pattern_list[ii]).groups + 1
+        _compiled_rules[pattern_list] = [re.compile('|'.join(alternation)), group_index]
+
+    return _compiled_rules[pattern_list]
+
+
+def _shift_group_reference(repl, offset):
+    def _shift(m):
+        if m.group(1) or m.group(2):
+            return '\\g<%d>' % (int(m.group(1) or m.group(2)) + offset)
+        return m.group(0)
+
+    return re.sub(r'\\(?:(\d{1,2})|g<(\d+)>|.)', _shift, repl)
+
+
+def render_lines(lines, rule_list):
+    # rule_list: list of [pattern, repl] (the same arguments as 're_sub_lines')
+    pattern_list = tuple([rr[0] for rr in rule_list])
+    regex, group_index = _compile_rules(pattern_list)
+
+    repl_list = dict()
+    for index in group_index:
+        repl_list[index] = _shift_group_reference(rule_list[group_index[index]][1], index)
+
+    matched = set()
+
+    def _repl(m):
+        matched.add(pattern_list[group_index[m.lastindex]])
+        return m.expand(repl_list[m.lastindex])
+
+    new_lines = list()
+    for ll in lines:
+        new_lines.append(regex.sub(_repl, ll))
+
+    unmatched = [pp for pp in pattern_list if pp not in matched]
+    return new_lines, sorted(set(unmatched))
+
+
+def render_file(source_path, target_path, rule_list):
+    mtime = os.stat(source_path).st_mtime_ns
+    if _template_lines.get(source_path, [None])[0] != mtime:
+        _template_lines[source_path] = [mtime, read_file(source_path)]
+
+    lines, unmatched = render_lines(_template_lines[source_path][1], rule_list)
+    write_file(target_path, lines)
+
+    if unmatched:
+        print('not matched in %s: %s' % (source_path, ', '.join(unmatched)))
+
+
 def check_template_availability():
     if 'template' not in env:
         print('template is not defined in config.json')
@@ -2,13 +2,21 @@
 
 from env import env
 from run_common import check_template_availability
+from run_common import get_network_context
 from run_common import print_session
+from run_common import run_parallel
 from run_create_eb_cron_job import run_create_eb_cron_job
 from run_create_eb_django import run_create_eb_django
 from run_create_eb_openvpn import run_create_eb_openvpn
 
 args = []
 
+
+def _run_jobs(job_list):
+    for func, func_args in job_list:
+        func(*func_args)
+
+
 if __name__ == "__main__":
     from run_common import parse_args
 
@@ -35,6 +43,9 @@ if len(args) > 1:
 if len(args) > 2:
     region = args[2]
 
+job_list = list()
+job_index = dict()
+
 for eb_env in eb['ENVIRONMENTS']:
     if target_eb_name and eb_env['NAME'] != target_eb_name:
         continue
@@ -45,16 +56,29 @@ for eb_env in eb['ENVIRONMENTS']:
     if target_eb_name:
         check_exists = True
 
+    # network context is resolved once per region and shared by every environment in the region
     if eb_env['TYPE'] == 'cron job':
-        run_create_eb_cron_job(eb_env['NAME'], eb_env)
+        network_context = get_network_context(eb_env['AWS_DEFAULT_REGION'])
+        job = [run_create_eb_cron_job, (eb_env['NAME'], eb_env, network_context)]
     elif eb_env['TYPE'] == 'django':
-        run_create_eb_django(eb_env['NAME'], eb_env)
+        network_context = get_network_context()
+        job = [run_create_eb_django, (eb_env['NAME'], eb_env, network_context)]
     elif eb_env['TYPE'] == 'openvpn':
-        run_create_eb_openvpn(eb_env['NAME'], eb_env)
+        network_context = get_network_context(eb_env['AWS_DEFAULT_REGION'])
+        job = [run_create_eb_openvpn, (eb_env['NAME'], eb_env, network_context)]
     else:
         print('"%s" is not supported' % eb_env['TYPE'])
         raise Exception()
 
+    # environments which have the same name share the working directory 'elasticbeanstalk/<name>',
+    # so they are deployed one after another in the same job
+    if eb_env['NAME'] not in job_index:
+        job_index[eb_env['NAME']] = list()
+        job_list.append([eb_env['NAME'], _run_jobs, (job_index[eb_env['NAME']],)])
+    job_index[eb_env['NAME']].append(job)
+
+run_parallel(job_list, int(eb.get('MAX_CONCURRENT_DEPLOYS', 4)))
+
 if not check_exists and target_eb_name and not region:
     print('"%s" is not exists in config.json' % target_eb_name)
 
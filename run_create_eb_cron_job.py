@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 import json
-import os
 import subprocess
 import time
 
+from bundle import add_wheelhouse
+from bundle import create_eb_application_version
 from env import env
 from run_common import AWSCli
+from run_common import eb_solution_stack_name
+from run_common import get_eb_cloudwatch_logs_option_settings
+from run_common import get_eb_scaling_option_settings
+from run_common import get_eb_xray_option_settings
+from run_common import get_git_hash
+from run_common import get_network_context
+from run_common import get_xray_sampling_rule_name
+from run_common import git_export
 from run_common import print_message
 from run_common import print_session
-from run_common import re_sub_lines
 from run_common import read_file
+from run_common import render_file
 from run_common import write_file
 
 
-def run_create_eb_cron_job(name, settings):
+def run_create_eb_cron_job(name, settings, network_context=None):
     aws_cli = AWSCli(settings['AWS_DEFAULT_REGION'])
 
     aws_asg_max_value = settings['AWS_ASG_MAX_VALUE']
@@ -28,19 +37,13 @@ def run_create_eb_cron_job(name, settings):
     phase = env['common']['PHASE']
     subnet_type = settings['SUBNET_TYPE']
     template_name = env['template']['NAME']
-    service_name = env['common'].get('SERVICE_NAME', '')
-    name_prefix = '%s_' % service_name if service_name else ''
     if hasattr(settings, 'PRIVATE_IP'):
         private_ip = settings['PRIVATE_IP']
     else:
         private_ip = None
 
-    cidr_subnet = aws_cli.cidr_subnet
-
     str_timestamp = str(int(time.time()))
 
-    zip_filename = '%s-%s.zip' % (name, str_timestamp)
-
     eb_environment_name = '%s-%s' % (name, str_timestamp)
     eb_environment_name_old = None
 
@@ -48,66 +51,25 @@ def run_create_eb_cron_job(name, settings):
     environment_path = '%s/elasticbeanstalk/%s' % (template_path, name)
     etc_config_path = '%s/configuration/etc' % environment_path
 
-    git_rev = ['git', 'rev-parse', 'HEAD']
-    git_hash_johanna = subprocess.Popen(git_rev, stdout=subprocess.PIPE).communicate()[0]
-    git_hash_template = subprocess.Popen(git_rev, stdout=subprocess.PIPE, cwd=template_path).communicate()[0]
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
 
     ################################################################################
     print_session('create %s' % name)
 
     ################################################################################
-    print_message('get vpc id')
+    print_message('get network context')
 
-    rds_vpc_id, eb_vpc_id = aws_cli.get_vpc_id()
+    if not network_context:
+        network_context = get_network_context(aws_default_region)
 
-    if not eb_vpc_id:
+    if not network_context.eb_vpc_id:
         print('ERROR!!! No VPC found')
         raise Exception()
 
-    ################################################################################
-    print_message('get subnet id')
-
-    subnet_id_1 = None
-    subnet_id_2 = None
-    cmd = ['ec2', 'describe-subnets']
-    result = aws_cli.run(cmd)
-    for r in result['Subnets']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if 'public' == subnet_type:
-            if r['CidrBlock'] == cidr_subnet['eb']['public_1']:
-                subnet_id_1 = r['SubnetId']
-            if r['CidrBlock'] == cidr_subnet['eb']['public_2']:
-                subnet_id_2 = r['SubnetId']
-        elif 'private' == subnet_type:
-            if r['CidrBlock'] == cidr_subnet['eb']['private_1']:
-                subnet_id_1 = r['SubnetId']
-            if r['CidrBlock'] == cidr_subnet['eb']['private_2']:
-                subnet_id_2 = r['SubnetId']
-        else:
-            print('ERROR!!! Unknown subnet type:', subnet_type)
-            raise Exception()
-
-    ################################################################################
-    print_message('get security group id')
-
-    security_group_id = None
-    cmd = ['ec2', 'describe-security-groups']
-    result = aws_cli.run(cmd)
-    for r in result['SecurityGroups']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if 'public' == subnet_type:
-            if r['GroupName'] == '%seb_public' % name_prefix:
-                security_group_id = r['GroupId']
-                break
-        elif 'private' == subnet_type:
-            if r['GroupName'] == '%seb_private' % name_prefix:
-                security_group_id = r['GroupId']
-                break
-        else:
-            print('ERROR!!! Unknown subnet type:', subnet_type)
-            raise Exception()
+    eb_vpc_id = network_context.eb_vpc_id
+    subnet_id_list = network_context.get_eb_subnet_id_list(subnet_type)
+    security_group_id = network_context.get_eb_security_group_id(subnet_type)
 
     ################################################################################
     print_message('configuration %s' % name)
@@ -116,11 +78,12 @@ def run_create_eb_cron_job(name, settings):
         f.write(phase)
         f.close()
 
-    lines = read_file('%s/.ebextensions/%s.config.sample' % (environment_path, name))
-    lines = re_sub_lines(lines, 'AWS_ASG_MIN_VALUE', aws_asg_min_value)
-    lines = re_sub_lines(lines, 'AWS_ASG_MAX_VALUE', aws_asg_max_value)
-    lines = re_sub_lines(lines, 'AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email)
-    write_file('%s/.ebextensions/%s.config' % (environment_path, name), lines)
+    rule_list = list()
+    rule_list.append(['AWS_ASG_MIN_VALUE', aws_asg_min_value])
+    rule_list.append(['AWS_ASG_MAX_VALUE', aws_asg_max_value])
+    rule_list.append(['AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email])
+    render_file('%s/.ebextensions/%s.config.sample' % (environment_path, name),
+                '%s/.ebextensions/%s.config' % (environment_path, name), rule_list)
 
     lines = read_file('%s/collectd_sample.conf' % etc_config_path)
     write_file('%s/collectd.conf' % etc_config_path, lines)
@@ -128,35 +91,25 @@ def run_create_eb_cron_job(name, settings):
     ################################################################################
     print_message('git clone')
 
-    subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
-    if phase == 'dv':
-        git_command = ['git', 'clone', '--depth=1', git_url]
-    else:
-        git_command = ['git', 'clone', '--depth=1', '-b', phase, git_url]
-    subprocess.Popen(git_command, cwd=environment_path).communicate()
-    if not os.path.exists('%s/%s' % (environment_path, name)):
-        raise Exception()
-
-    git_hash_app = subprocess.Popen(git_rev,
-                                    stdout=subprocess.PIPE,
-                                    cwd='%s/%s' % (environment_path, name)).communicate()[0]
+    branch = None if phase == 'dv' else phase
+    git_hash_app = git_export(git_url, branch, '%s/%s' % (environment_path, name))
 
-    subprocess.Popen(['rm', '-rf', './%s/.git' % name], cwd=environment_path).communicate()
     subprocess.Popen(['rm', '-rf', './%s/.gitignore' % name], cwd=environment_path).communicate()
 
     ################################################################################
 
     for ss in settings['SETTINGS_LOCAL_PATH']:
-        lines = read_file('%s/%s/settings_local_sample.py' % (environment_path, ss))
-        lines = re_sub_lines(lines, '^(DEBUG).*', '\\1 = %s' % debug)
+        rule_list = list()
+        rule_list.append(['^(DEBUG).*', '\\1 = %s' % debug])
         option_list = list()
         option_list.append(['PHASE', phase])
         for key in settings:
             value = settings[key]
             option_list.append([key, value])
         for oo in option_list:
-            lines = re_sub_lines(lines, '^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
-        write_file('%s/%s/settings_local.py' % (environment_path, ss), lines)
+            rule_list.append(['^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+        render_file('%s/%s/settings_local_sample.py' % (environment_path, ss),
+                    '%s/%s/settings_local.py' % (environment_path, ss), rule_list)
 
     ################################################################################
     print_message('check previous version')
@@ -181,31 +134,18 @@ def run_create_eb_cron_job(name, settings):
             break
 
     ################################################################################
-    print_message('create storage location')
+    if settings.get('XRAY'):
+        print_message('put x-ray sampling rule')
 
-    cmd = ['elasticbeanstalk', 'create-storage-location']
-    result = aws_cli.run(cmd)
-
-    s3_bucket = result['S3Bucket']
-    s3_zip_filename = '/'.join(['s3://' + s3_bucket, eb_application_name, zip_filename])
+        aws_cli.put_xray_sampling_rule(get_xray_sampling_rule_name(name), settings['XRAY'])
 
     ################################################################################
     print_message('create application version')
 
-    cmd = ['zip', '-r', zip_filename, '.', '.ebextensions']
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
+    add_wheelhouse(environment_path, settings)
 
-    cmd = ['s3', 'cp', zip_filename, s3_zip_filename]
-    aws_cli.run(cmd, cwd=environment_path)
-
-    cmd = ['rm', '-rf', zip_filename]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
-
-    cmd = ['elasticbeanstalk', 'create-application-version']
-    cmd += ['--application-name', eb_application_name]
-    cmd += ['--source-bundle', 'S3Bucket="%s",S3Key="%s/%s"' % (s3_bucket, eb_application_name, zip_filename)]
-    cmd += ['--version-label', eb_environment_name]
-    aws_cli.run(cmd, cwd=environment_path)
+    version_label = create_eb_application_version(aws_cli, eb_application_name, name, environment_path,
+                                                  eb_environment_name)
 
     ################################################################################
     print_message('create environment %s' % name)
@@ -218,11 +158,17 @@ def run_create_eb_cron_job(name, settings):
     oo['Value'] = key_pair_name
     option_settings.append(oo)
 
-    oo = dict()
-    oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
-    oo['OptionName'] = 'InstanceType'
-    oo['Value'] = 't2.nano'
-    option_settings.append(oo)
+    option_settings += get_eb_scaling_option_settings(settings)
+
+    image_id = aws_cli.get_baked_image_id(name, git_hash_template)
+    if image_id:
+        print('use baked AMI: %s' % image_id)
+
+        oo = dict()
+        oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
+        oo['OptionName'] = 'ImageId'
+        oo['Value'] = image_id
+        option_settings.append(oo)
 
     oo = dict()
     oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
@@ -255,13 +201,13 @@ def run_create_eb_cron_job(name, settings):
     oo = dict()
     oo['Namespace'] = 'aws:ec2:vpc'
     oo['OptionName'] = 'ELBSubnets'
-    oo['Value'] = ','.join([subnet_id_1, subnet_id_2])
+    oo['Value'] = ','.join(subnet_id_list)
     option_settings.append(oo)
 
     oo = dict()
     oo['Namespace'] = 'aws:ec2:vpc'
     oo['OptionName'] = 'Subnets'
-    oo['Value'] = ','.join([subnet_id_1, subnet_id_2])
+    oo['Value'] = ','.join(subnet_id_list)
     option_settings.append(oo)
 
     oo = dict()
@@ -282,6 +228,9 @@ def run_create_eb_cron_job(name, settings):
     oo['Value'] = 'aws-elasticbeanstalk-service-role'
     option_settings.append(oo)
 
+    option_settings += get_eb_cloudwatch_logs_option_settings(settings)
+    option_settings += get_eb_xray_option_settings(settings)
+
     oo = dict()
     oo['Namespace'] = 'aws:elasticbeanstalk:healthreporting:system'
     oo['OptionName'] = 'SystemType'
@@ -305,38 +254,21 @@ def run_create_eb_cron_job(name, settings):
 
     option_settings = json.dumps(option_settings)
 
-    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna.decode('utf-8').strip()
-    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template.decode('utf-8').strip())
-    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app.decode('utf-8').strip())
+    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna
+    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template)
+    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app)
 
     cmd = ['elasticbeanstalk', 'create-environment']
     cmd += ['--application-name', eb_application_name]
     cmd += ['--cname-prefix', cname]
     cmd += ['--environment-name', eb_environment_name]
     cmd += ['--option-settings', option_settings]
-    cmd += ['--solution-stack-name', '64bit Amazon Linux 2017.09 v2.6.5 running Python 3.6']
+    cmd += ['--solution-stack-name', eb_solution_stack_name]
     cmd += ['--tags', tag0, tag1, tag2]
-    cmd += ['--version-label', eb_environment_name]
+    cmd += ['--version-label', version_label]
     aws_cli.run(cmd, cwd=environment_path)
 
-    elapsed_time = 0
-    while True:
-        cmd = ['elasticbeanstalk', 'describe-environments']
-        cmd += ['--application-name', eb_application_name]
-        cmd += ['--environment-name', eb_environment_name]
-        result = aws_cli.run(cmd)
-
-        ee = result['Environments'][0]
-        print(json.dumps(ee, sort_keys=True, indent=4))
-        if ee.get('Health', '') == 'Green' and ee.get('Status', '') == 'Ready':
-            break
-
-        print('creating... (elapsed time: \'%d\' seconds)' % elapsed_time)
-        time.sleep(5)
-        elapsed_time += 5
-
-        if elapsed_time > 60 * 30:
-            raise Exception()
+    aws_cli.wait_eb_environment_ready(eb_application_name, eb_environment_name, str_timestamp)
 
     subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
 
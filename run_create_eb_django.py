@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 import json
-import os
 import subprocess
 import time
 
+from bundle import add_wheelhouse
+from bundle import create_eb_application_version
+from canary import restore_record_set
+from canary import shift_traffic
 from env import env
 from run_common import AWSCli
+from run_common import eb_solution_stack_name
+from run_common import get_eb_cloudwatch_logs_option_settings
+from run_common import get_eb_load_balancer_option_settings
+from run_common import get_eb_scaling_option_settings
+from run_common import get_eb_xray_option_settings
+from run_common import get_git_hash
+from run_common import get_network_context
+from run_common import get_xray_sampling_rule_name
+from run_common import git_export
 from run_common import print_message
 from run_common import print_session
-from run_common import re_sub_lines
 from run_common import read_file
+from run_common import render_file
 from run_common import write_file
+from warmup import warmup_environment
 
 
-def run_create_eb_django(name, settings):
+def run_create_eb_django(name, settings, network_context=None):
     aws_cli = AWSCli()
 
     aws_asg_max_value = settings['AWS_ASG_MAX_VALUE']
@@ -22,6 +35,7 @@ def run_create_eb_django(name, settings):
     aws_eb_notification_email = settings['AWS_EB_NOTIFICATION_EMAIL']
     cname = settings['CNAME']
     debug = env['common']['DEBUG']
+    deploy_mode = settings.get('DEPLOY_MODE', 'bluegreen')
     eb_application_name = env['elasticbeanstalk']['APPLICATION_NAME']
     git_url = settings['GIT_URL']
     key_pair_name = env['common']['AWS_KEY_PAIR_NAME']
@@ -29,15 +43,9 @@ def run_create_eb_django(name, settings):
     ssl_certificate_id = settings['SSL_CERTIFICATE_ID']
     subnet_type = settings['SUBNET_TYPE']
     template_name = env['template']['NAME']
-    service_name = env['common'].get('SERVICE_NAME', '')
-    name_prefix = '%s_' % service_name if service_name else ''
-
-    cidr_subnet = aws_cli.cidr_subnet
 
     str_timestamp = str(int(time.time()))
 
-    zip_filename = '%s-%s.zip' % (name, str_timestamp)
-
     eb_environment_name = '%s-%s' % (name, str_timestamp)
     eb_environment_name_old = None
 
@@ -46,71 +54,30 @@ def run_create_eb_django(name, settings):
     etc_config_path = '%s/configuration/etc' % environment_path
     app_config_path = '%s/%s' % (etc_config_path, name)
 
-    git_rev = ['git', 'rev-parse', 'HEAD']
-    git_hash_johanna = subprocess.Popen(git_rev, stdout=subprocess.PIPE).communicate()[0]
-    git_hash_template = subprocess.Popen(git_rev, stdout=subprocess.PIPE, cwd=template_path).communicate()[0]
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
 
     ################################################################################
     print_session('create %s' % name)
 
     ################################################################################
-    print_message('get vpc id')
+    print_message('get network context')
 
-    rds_vpc_id, eb_vpc_id = aws_cli.get_vpc_id()
+    if not network_context:
+        network_context = get_network_context(aws_default_region)
 
-    if not eb_vpc_id:
+    if not network_context.eb_vpc_id:
         print('ERROR!!! No VPC found')
         raise Exception()
 
-    ################################################################################
-    print_message('get subnet id')
-
-    subnet_id_1 = None
-    subnet_id_2 = None
-    cmd = ['ec2', 'describe-subnets']
-    result = aws_cli.run(cmd)
-    for r in result['Subnets']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if 'public' == subnet_type:
-            if r['CidrBlock'] == cidr_subnet['eb']['public_1']:
-                subnet_id_1 = r['SubnetId']
-            if r['CidrBlock'] == cidr_subnet['eb']['public_2']:
-                subnet_id_2 = r['SubnetId']
-        elif 'private' == subnet_type:
-            if r['CidrBlock'] == cidr_subnet['eb']['private_1']:
-                subnet_id_1 = r['SubnetId']
-            if r['CidrBlock'] == cidr_subnet['eb']['private_2']:
-                subnet_id_2 = r['SubnetId']
-        else:
-            print('ERROR!!! Unknown subnet type:', subnet_type)
-            raise Exception()
+    eb_vpc_id = network_context.eb_vpc_id
+    subnet_id_list = network_context.get_eb_subnet_id_list(subnet_type)
+    security_group_id = network_context.get_eb_security_group_id(subnet_type)
 
     ################################################################################
-    print_message('get security group id')
-
-    security_group_id = None
-    cmd = ['ec2', 'describe-security-groups']
-    result = aws_cli.run(cmd)
-    for r in result['SecurityGroups']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if 'public' == subnet_type:
-            if r['GroupName'] == '%seb_public' % name_prefix:
-                security_group_id = r['GroupId']
-                break
-        elif 'private' == subnet_type:
-            if r['GroupName'] == '%seb_private' % name_prefix:
-                security_group_id = r['GroupId']
-                break
-        else:
-            print('ERROR!!! Unknown subnet type:', subnet_type)
-            raise Exception()
-
-    ################################################################################
-
     print_message('get database address')
-    db_address = aws_cli.get_rds_address()
+
+    db_address = network_context.get_db_address()
 
     ################################################################################
     print_message('configuration %s' % name)
@@ -119,50 +86,40 @@ def run_create_eb_django(name, settings):
         f.write(phase)
         f.close()
 
-    lines = read_file('%s/.ebextensions/%s.config.sample' % (environment_path, name))
-    lines = re_sub_lines(lines, 'AWS_ASG_MAX_VALUE', aws_asg_max_value)
-    lines = re_sub_lines(lines, 'AWS_ASG_MIN_VALUE', aws_asg_min_value)
-    lines = re_sub_lines(lines, 'AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email)
-    lines = re_sub_lines(lines, 'SSL_CERTIFICATE_ID', ssl_certificate_id)
-    write_file('%s/.ebextensions/%s.config' % (environment_path, name), lines)
+    rule_list = list()
+    rule_list.append(['AWS_ASG_MAX_VALUE', aws_asg_max_value])
+    rule_list.append(['AWS_ASG_MIN_VALUE', aws_asg_min_value])
+    rule_list.append(['AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email])
+    rule_list.append(['SSL_CERTIFICATE_ID', ssl_certificate_id])
+    render_file('%s/.ebextensions/%s.config.sample' % (environment_path, name),
+                '%s/.ebextensions/%s.config' % (environment_path, name), rule_list)
 
-    lines = read_file('%s/my_sample.cnf' % app_config_path)
-    lines = re_sub_lines(lines, '^(host).*', '\\1 = %s' % db_address)
-    lines = re_sub_lines(lines, '^(user).*', '\\1 = %s' % env['rds']['USER_NAME'])
-    lines = re_sub_lines(lines, '^(password).*', '\\1 = %s' % env['rds']['USER_PASSWORD'])
-    write_file('%s/my.cnf' % app_config_path, lines)
+    rule_list = list()
+    rule_list.append(['^(host).*', '\\1 = %s' % db_address])
+    rule_list.append(['^(user).*', '\\1 = %s' % env['rds']['USER_NAME']])
+    rule_list.append(['^(password).*', '\\1 = %s' % env['rds']['USER_PASSWORD']])
+    render_file('%s/my_sample.cnf' % app_config_path, '%s/my.cnf' % app_config_path, rule_list)
 
     lines = read_file('%s/collectd_sample.conf' % etc_config_path)
     write_file('%s/collectd.conf' % etc_config_path, lines)
 
-    lines = read_file('%s/settings_local_sample.py' % app_config_path)
-    lines = re_sub_lines(lines, '^(DEBUG).*', '\\1 = %s' % debug)
+    rule_list = list()
+    rule_list.append(['^(DEBUG).*', '\\1 = %s' % debug])
     option_list = list()
     option_list.append(['PHASE', phase])
     for key in settings:
         value = settings[key]
         option_list.append([key, value])
     for oo in option_list:
-        lines = re_sub_lines(lines, '^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
-    write_file('%s/settings_local.py' % app_config_path, lines)
+        rule_list.append(['^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+    render_file('%s/settings_local_sample.py' % app_config_path, '%s/settings_local.py' % app_config_path, rule_list)
 
     ################################################################################
     print_message('git clone')
 
-    subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
-    if phase == 'dv':
-        git_command = ['git', 'clone', '--depth=1', git_url]
-    else:
-        git_command = ['git', 'clone', '--depth=1', '-b', phase, git_url]
-    subprocess.Popen(git_command, cwd=environment_path).communicate()
-    if not os.path.exists('%s/%s' % (environment_path, name)):
-        raise Exception()
+    branch = None if phase == 'dv' else phase
+    git_hash_app = git_export(git_url, branch, '%s/%s' % (environment_path, name))
 
-    git_hash_app = subprocess.Popen(git_rev,
-                                    stdout=subprocess.PIPE,
-                                    cwd='%s/%s' % (environment_path, name)).communicate()[0]
-
-    subprocess.Popen(['rm', '-rf', './%s/.git' % name], cwd=environment_path).communicate()
     subprocess.Popen(['rm', '-rf', './%s/.gitignore' % name], cwd=environment_path).communicate()
 
     ################################################################################
@@ -188,31 +145,32 @@ def run_create_eb_django(name, settings):
             break
 
     ################################################################################
-    print_message('create storage location')
-
-    cmd = ['elasticbeanstalk', 'create-storage-location']
-    result = aws_cli.run(cmd)
+    if settings.get('XRAY'):
+        print_message('put x-ray sampling rule')
 
-    s3_bucket = result['S3Bucket']
-    s3_zip_filename = '/'.join(['s3://' + s3_bucket, eb_application_name, zip_filename])
+        aws_cli.put_xray_sampling_rule(get_xray_sampling_rule_name(name), settings['XRAY'], settings['HOST'])
 
     ################################################################################
     print_message('create application version')
 
-    cmd = ['zip', '-r', zip_filename, '.', '.ebextensions']
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
+    add_wheelhouse(environment_path, settings)
 
-    cmd = ['s3', 'cp', zip_filename, s3_zip_filename]
-    aws_cli.run(cmd, cwd=environment_path)
+    version_label = create_eb_application_version(aws_cli, eb_application_name, name, environment_path,
+                                                  eb_environment_name)
 
-    cmd = ['rm', '-rf', zip_filename]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
+    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna
+    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template)
+    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app)
 
-    cmd = ['elasticbeanstalk', 'create-application-version']
-    cmd += ['--application-name', eb_application_name]
-    cmd += ['--source-bundle', 'S3Bucket="%s",S3Key="%s/%s"' % (s3_bucket, eb_application_name, zip_filename)]
-    cmd += ['--version-label', eb_environment_name]
-    aws_cli.run(cmd, cwd=environment_path)
+    ################################################################################
+    if deploy_mode != 'bluegreen' and eb_environment_name_old:
+        print_message('update environment %s (%s)' % (eb_environment_name_old, deploy_mode))
+
+        aws_cli.update_eb_environment_version(eb_application_name, eb_environment_name_old, version_label,
+                                              settings, [tag0, tag1, tag2])
+
+        subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
+        return
 
     ################################################################################
     print_message('create environment %s' % name)
@@ -225,11 +183,17 @@ def run_create_eb_django(name, settings):
     oo['Value'] = key_pair_name
     option_settings.append(oo)
 
-    oo = dict()
-    oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
-    oo['OptionName'] = 'InstanceType'
-    oo['Value'] = 't2.nano'
-    option_settings.append(oo)
+    option_settings += get_eb_scaling_option_settings(settings)
+
+    image_id = aws_cli.get_baked_image_id(name, git_hash_template)
+    if image_id:
+        print('use baked AMI: %s' % image_id)
+
+        oo = dict()
+        oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
+        oo['OptionName'] = 'ImageId'
+        oo['Value'] = image_id
+        option_settings.append(oo)
 
     oo = dict()
     oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
@@ -262,13 +226,13 @@ def run_create_eb_django(name, settings):
     oo = dict()
     oo['Namespace'] = 'aws:ec2:vpc'
     oo['OptionName'] = 'ELBSubnets'
-    oo['Value'] = ','.join([subnet_id_1, subnet_id_2])
+    oo['Value'] = ','.join(subnet_id_list)
     option_settings.append(oo)
 
     oo = dict()
     oo['Namespace'] = 'aws:ec2:vpc'
     oo['OptionName'] = 'Subnets'
-    oo['Value'] = ','.join([subnet_id_1, subnet_id_2])
+    oo['Value'] = ','.join(subnet_id_list)
     option_settings.append(oo)
 
     oo = dict()
@@ -283,12 +247,17 @@ def run_create_eb_django(name, settings):
     oo['Value'] = 'LoadBalanced'
     option_settings.append(oo)
 
+    option_settings += get_eb_load_balancer_option_settings(settings, ssl_certificate_id)
+
     oo = dict()
     oo['Namespace'] = 'aws:elasticbeanstalk:environment'
     oo['OptionName'] = 'ServiceRole'
     oo['Value'] = 'aws-elasticbeanstalk-service-role'
     option_settings.append(oo)
 
+    option_settings += get_eb_cloudwatch_logs_option_settings(settings)
+    option_settings += get_eb_xray_option_settings(settings)
+
     oo = dict()
     oo['Namespace'] = 'aws:elasticbeanstalk:healthreporting:system'
     oo['OptionName'] = 'SystemType'
@@ -319,38 +288,17 @@ def run_create_eb_django(name, settings):
 
     option_settings = json.dumps(option_settings)
 
-    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna.decode('utf-8').strip()
-    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template.decode('utf-8').strip())
-    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app.decode('utf-8').strip())
-
     cmd = ['elasticbeanstalk', 'create-environment']
     cmd += ['--application-name', eb_application_name]
     cmd += ['--cname-prefix', cname]
     cmd += ['--environment-name', eb_environment_name]
     cmd += ['--option-settings', option_settings]
-    cmd += ['--solution-stack-name', '64bit Amazon Linux 2017.09 v2.6.5 running Python 3.6']
+    cmd += ['--solution-stack-name', eb_solution_stack_name]
     cmd += ['--tags', tag0, tag1, tag2]
-    cmd += ['--version-label', eb_environment_name]
+    cmd += ['--version-label', version_label]
     aws_cli.run(cmd, cwd=environment_path)
 
-    elapsed_time = 0
-    while True:
-        cmd = ['elasticbeanstalk', 'describe-environments']
-        cmd += ['--application-name', eb_application_name]
-        cmd += ['--environment-name', eb_environment_name]
-        result = aws_cli.run(cmd)
-
-        ee = result['Environments'][0]
-        print(json.dumps(ee, sort_keys=True, indent=4))
-        if ee.get('Health', '') == 'Green' and ee.get('Status', '') == 'Ready':
-            break
-
-        print('creating... (elapsed time: \'%d\' seconds)' % elapsed_time)
-        time.sleep(5)
-        elapsed_time += 5
-
-        if elapsed_time > 60 * 30:
-            raise Exception()
+    aws_cli.wait_eb_environment_ready(eb_application_name, eb_environment_name, str_timestamp)
 
     subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
 
@@ -369,11 +317,30 @@ def run_create_eb_django(name, settings):
         cmd += ['--cidr', '0.0.0.0/0']
         aws_cli.run(cmd, ignore_error=True)
 
+    ################################################################################
+    if eb_environment_name_old and settings.get('WARMUP'):
+        print_message('warm up %s' % eb_environment_name)
+
+        base_url = 'http://%s.%s.elasticbeanstalk.com' % (cname, aws_default_region)
+        if not warmup_environment(base_url, settings['WARMUP'], settings.get('HOST')):
+            print('ERROR!!! warm-up failed, CNAME is not swapped (%s is left for the old environment reaper)' %
+                  eb_environment_name)
+            raise Exception()
+
     ################################################################################
     print_message('swap CNAME if the previous version exists')
 
+    shift_result = None
+    if eb_environment_name_old and settings.get('CANARY'):
+        cname_old = '%s.%s.elasticbeanstalk.com' % (settings['CNAME'], aws_default_region)
+        shift_result = shift_traffic(aws_cli, eb_environment_name_old, eb_environment_name, cname_old,
+                                     settings['HOST'], settings['CANARY'])
+
     if eb_environment_name_old:
         cmd = ['elasticbeanstalk', 'swap-environment-cnames']
         cmd += ['--source-environment-name', eb_environment_name_old]
         cmd += ['--destination-environment-name', eb_environment_name]
         aws_cli.run(cmd)
+
+    if shift_result:
+        restore_record_set(aws_cli, shift_result)
@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 import json
-import os
 import subprocess
 import time
 
+from bundle import create_eb_application_version
 from env import env
 from run_common import AWSCli
+from run_common import eb_solution_stack_name
+from run_common import get_eb_cloudwatch_logs_option_settings
+from run_common import get_git_hash
+from run_common import get_network_context
+from run_common import git_export
 from run_common import print_message
 from run_common import print_session
-from run_common import re_sub_lines
 from run_common import read_file
+from run_common import render_file
 from run_common import write_file
 
 
-def run_create_eb_openvpn(name, settings):
+def run_create_eb_openvpn(name, settings, network_context=None):
     aws_cli = AWSCli(settings['AWS_DEFAULT_REGION'])
 
     accounts = settings['ACCOUNTS']
@@ -32,16 +37,11 @@ def run_create_eb_openvpn(name, settings):
     openvpn_subnet_ip = settings['OPENVPN_SUBNET_IP']
     phase = env['common']['PHASE']
     template_name = env['template']['NAME']
-    service_name = env['common'].get('SERVICE_NAME', '')
-    name_prefix = '%s_' % service_name if service_name else ''
 
     cidr_vpc = aws_cli.cidr_vpc
-    cidr_subnet = aws_cli.cidr_subnet
 
     str_timestamp = str(int(time.time()))
 
-    zip_filename = '%s-%s.zip' % (name, str_timestamp)
-
     eb_environment_name = '%s-%s' % (name, str_timestamp)
     eb_environment_name_old = None
 
@@ -50,9 +50,8 @@ def run_create_eb_openvpn(name, settings):
     etc_config_path = '%s/configuration/etc' % environment_path
     app_config_path = '%s/%s' % (etc_config_path, name)
 
-    git_rev = ['git', 'rev-parse', 'HEAD']
-    git_hash_johanna = subprocess.Popen(git_rev, stdout=subprocess.PIPE).communicate()[0]
-    git_hash_template = subprocess.Popen(git_rev, stdout=subprocess.PIPE, cwd=template_path).communicate()[0]
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
 
     ################################################################################
     #
@@ -62,41 +61,18 @@ def run_create_eb_openvpn(name, settings):
     print_session('create %s' % name)
 
     ################################################################################
-    print_message('get vpc id')
+    print_message('get network context')
 
-    rds_vpc_id, eb_vpc_id = aws_cli.get_vpc_id()
+    if not network_context:
+        network_context = get_network_context(aws_default_region)
 
-    if not rds_vpc_id or not eb_vpc_id:
+    if not network_context.rds_vpc_id or not network_context.eb_vpc_id:
         print('ERROR!!! No VPC found')
         raise Exception()
 
-    ################################################################################
-    print_message('get subnet id')
-
-    subnet_id_1 = None
-    subnet_id_2 = None
-    cmd = ['ec2', 'describe-subnets']
-    result = aws_cli.run(cmd)
-    for r in result['Subnets']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if r['CidrBlock'] == cidr_subnet['eb']['public_1']:
-            subnet_id_1 = r['SubnetId']
-        if r['CidrBlock'] == cidr_subnet['eb']['public_2']:
-            subnet_id_2 = r['SubnetId']
-
-    ################################################################################
-    print_message('get security group id')
-
-    security_group_id = None
-    cmd = ['ec2', 'describe-security-groups']
-    result = aws_cli.run(cmd)
-    for r in result['SecurityGroups']:
-        if r['VpcId'] != eb_vpc_id:
-            continue
-        if r['GroupName'] == '%seb_public' % name_prefix:
-            security_group_id = r['GroupId']
-            break
+    eb_vpc_id = network_context.eb_vpc_id
+    subnet_id_list = network_context.get_eb_subnet_id_list('public')
+    security_group_id = network_context.get_eb_security_group_id('public')
 
     ################################################################################
     print_message('configuration openvpn')
@@ -135,50 +111,41 @@ def run_create_eb_openvpn(name, settings):
         f.write(phase)
         f.close()
 
-    lines = read_file('%s/.ebextensions/%s.config.sample' % (environment_path, name))
-    lines = re_sub_lines(lines, 'AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email)
-    write_file('%s/.ebextensions/%s.config' % (environment_path, name), lines)
+    rule_list = list()
+    rule_list.append(['AWS_EB_NOTIFICATION_EMAIL', aws_eb_notification_email])
+    render_file('%s/.ebextensions/%s.config.sample' % (environment_path, name),
+                '%s/.ebextensions/%s.config' % (environment_path, name), rule_list)
 
     lines = read_file('%s/collectd_sample.conf' % etc_config_path)
     write_file('%s/collectd.conf' % etc_config_path, lines)
 
-    lines = read_file('%s/openvpn/server_sample.conf' % etc_config_path)
-    lines = re_sub_lines(lines, 'OPENVPN_SUBNET_IP', openvpn_subnet_ip)
-    write_file('%s/openvpn/server.conf' % etc_config_path, lines)
+    rule_list = list()
+    rule_list.append(['OPENVPN_SUBNET_IP', openvpn_subnet_ip])
+    render_file('%s/openvpn/server_sample.conf' % etc_config_path,
+                '%s/openvpn/server.conf' % etc_config_path, rule_list)
 
-    lines = read_file('%s/sysconfig/iptables_sample' % etc_config_path)
-    lines = re_sub_lines(lines, 'AWS_VPC_EB', cidr_vpc['eb'])
-    lines = re_sub_lines(lines, 'OPENVPN_SUBNET_IP', openvpn_subnet_ip)
-    write_file('%s/sysconfig/iptables' % etc_config_path, lines)
+    rule_list = list()
+    rule_list.append(['AWS_VPC_EB', cidr_vpc['eb']])
+    rule_list.append(['OPENVPN_SUBNET_IP', openvpn_subnet_ip])
+    render_file('%s/sysconfig/iptables_sample' % etc_config_path, '%s/sysconfig/iptables' % etc_config_path, rule_list)
 
-    lines = read_file('%s/settings_local_sample.py' % app_config_path)
-    lines = re_sub_lines(lines, '^(DEBUG).*', '\\1 = %s' % debug)
+    rule_list = list()
+    rule_list.append(['^(DEBUG).*', '\\1 = %s' % debug])
     option_list = list()
     option_list.append(['PHASE', phase])
     for key in settings:
         value = settings[key]
         option_list.append([key, value])
     for oo in option_list:
-        lines = re_sub_lines(lines, '^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
-    write_file('%s/settings_local.py' % app_config_path, lines)
+        rule_list.append(['^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+    render_file('%s/settings_local_sample.py' % app_config_path, '%s/settings_local.py' % app_config_path, rule_list)
 
     ################################################################################
     print_message('git clone')
 
-    subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
-    if phase == 'dv':
-        git_command = ['git', 'clone', '--depth=1', git_url]
-    else:
-        git_command = ['git', 'clone', '--depth=1', '-b', phase, git_url]
-    subprocess.Popen(git_command, cwd=environment_path).communicate()
-    if not os.path.exists('%s/%s' % (environment_path, name)):
-        raise Exception()
-
-    git_hash_app = subprocess.Popen(git_rev,
-                                    stdout=subprocess.PIPE,
-                                    cwd='%s/%s' % (environment_path, name)).communicate()[0]
+    branch = None if phase == 'dv' else phase
+    git_hash_app = git_export(git_url, branch, '%s/%s' % (environment_path, name))
 
-    subprocess.Popen(['rm', '-rf', './%s/.git' % name], cwd=environment_path).communicate()
     subprocess.Popen(['rm', '-rf', './%s/.gitignore' % name], cwd=environment_path).communicate()
 
     ################################################################################
@@ -203,32 +170,11 @@ def run_create_eb_openvpn(name, settings):
             cname += '-%s' % str_timestamp
             break
 
-    ################################################################################
-    print_message('create storage location')
-
-    cmd = ['elasticbeanstalk', 'create-storage-location']
-    result = aws_cli.run(cmd)
-
-    s3_bucket = result['S3Bucket']
-    s3_zip_filename = '/'.join(['s3://' + s3_bucket, eb_application_name, zip_filename])
-
     ################################################################################
     print_message('create application version')
 
-    cmd = ['zip', '-r', zip_filename, '.', '.ebextensions']
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
-
-    cmd = ['s3', 'cp', zip_filename, s3_zip_filename]
-    aws_cli.run(cmd, cwd=environment_path)
-
-    cmd = ['rm', '-rf', zip_filename]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=environment_path).communicate()
-
-    cmd = ['elasticbeanstalk', 'create-application-version']
-    cmd += ['--application-name', eb_application_name]
-    cmd += ['--source-bundle', 'S3Bucket="%s",S3Key="%s/%s"' % (s3_bucket, eb_application_name, zip_filename)]
-    cmd += ['--version-label', eb_environment_name]
-    aws_cli.run(cmd, cwd=environment_path)
+    version_label = create_eb_application_version(aws_cli, eb_application_name, name, environment_path,
+                                                  eb_environment_name)
 
     ################################################################################
     print_message('create environment %s' % name)
@@ -244,9 +190,19 @@ def run_create_eb_openvpn(name, settings):
     oo = dict()
     oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
     oo['OptionName'] = 'InstanceType'
-    oo['Value'] = 't2.nano'
+    oo['Value'] = settings.get('INSTANCE_TYPE', 't2.nano')
     option_settings.append(oo)
 
+    image_id = aws_cli.get_baked_image_id(name, git_hash_template)
+    if image_id:
+        print('use baked AMI: %s' % image_id)
+
+        oo = dict()
+        oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
+        oo['OptionName'] = 'ImageId'
+        oo['Value'] = image_id
+        option_settings.append(oo)
+
     oo = dict()
     oo['Namespace'] = 'aws:autoscaling:launchconfiguration'
     oo['OptionName'] = 'IamInstanceProfile'
@@ -280,7 +236,7 @@ def run_create_eb_openvpn(name, settings):
     oo = dict()
     oo['Namespace'] = 'aws:ec2:vpc'
     oo['OptionName'] = 'Subnets'
-    oo['Value'] = ','.join([subnet_id_1, subnet_id_2])
+    oo['Value'] = ','.join(subnet_id_list)
     option_settings.append(oo)
 
     oo = dict()
@@ -301,6 +257,8 @@ def run_create_eb_openvpn(name, settings):
     oo['Value'] = 'aws-elasticbeanstalk-service-role'
     option_settings.append(oo)
 
+    option_settings += get_eb_cloudwatch_logs_option_settings(settings)
+
     oo = dict()
     oo['Namespace'] = 'aws:elasticbeanstalk:healthreporting:system'
     oo['OptionName'] = 'SystemType'
@@ -324,38 +282,21 @@ def run_create_eb_openvpn(name, settings):
 
     option_settings = json.dumps(option_settings)
 
-    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna.decode('utf-8').strip()
-    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template.decode('utf-8').strip())
-    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app.decode('utf-8').strip())
+    tag0 = 'Key=git_hash_johanna,Value=%s' % git_hash_johanna
+    tag1 = 'Key=git_hash_%s,Value=%s' % (template_name, git_hash_template)
+    tag2 = 'Key=git_hash_%s,Value=%s' % (name, git_hash_app)
 
     cmd = ['elasticbeanstalk', 'create-environment']
     cmd += ['--application-name', eb_application_name]
     cmd += ['--cname-prefix', cname]
     cmd += ['--environment-name', eb_environment_name]
     cmd += ['--option-settings', option_settings]
-    cmd += ['--solution-stack-name', '64bit Amazon Linux 2017.09 v2.6.5 running Python 3.6']
+    cmd += ['--solution-stack-name', eb_solution_stack_name]
     cmd += ['--tags', tag0, tag1, tag2]
-    cmd += ['--version-label', eb_environment_name]
+    cmd += ['--version-label', version_label]
     aws_cli.run(cmd, cwd=environment_path)
 
-    elapsed_time = 0
-    while True:
-        cmd = ['elasticbeanstalk', 'describe-environments']
-        cmd += ['--application-name', eb_application_name]
-        cmd += ['--environment-name', eb_environment_name]
-        result = aws_cli.run(cmd)
-
-        ee = result['Environments'][0]
-        print(json.dumps(ee, sort_keys=True, indent=4))
-        if ee.get('Health', '') == 'Green' and ee.get('Status', '') == 'Ready':
-            break
-
-        print('creating... (elapsed time: \'%d\' seconds)' % elapsed_time)
-        time.sleep(5)
-        elapsed_time += 5
-
-        if elapsed_time > 60 * 30:
-            raise Exception()
+    aws_cli.wait_eb_environment_ready(eb_application_name, eb_environment_name, str_timestamp)
 
     subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
 
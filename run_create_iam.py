@@ -52,6 +52,12 @@ def create_iam():
     cmd += ['--policy-arn', 'arn:aws:iam::aws:policy/AWSElasticBeanstalkWorkerTier']
     aws_cli.run(cmd)
 
+    # the x-ray daemon of the environments ('XRAY') uploads the segments with the instance role
+    cmd = ['iam', 'attach-role-policy']
+    cmd += ['--role-name', 'aws-elasticbeanstalk-ec2-role']
+    cmd += ['--policy-arn', 'arn:aws:iam::aws:policy/AWSXRayDaemonWriteAccess']
+    aws_cli.run(cmd)
+
     ################################################################################
     print_message('create iam: aws-elasticbeanstalk-service-role')
 
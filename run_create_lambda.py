@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
+import json
+import os
 import time
 
+from bundle import write_lambda_zip
 from env import env
 from run_common import AWSCli
 from run_common import check_template_availability
 from run_common import print_message
 from run_common import print_session
+from run_common import render_file
+from run_common import run_parallel
+from run_common import run_subprocess
 from run_create_lambda_cron import run_create_lambda_cron
 from run_create_lambda_default import run_create_lambda_default
 from run_create_lambda_sns import run_create_lambda_sns
@@ -34,7 +40,11 @@ def create_iam_for_lambda():
         sleep_required = True
 
     policy_name = 'aws-lambda-default-policy'
-    if not aws_cli.get_iam_role_policy(role_name, policy_name):
+    policy = aws_cli.get_iam_role_policy(role_name, policy_name)
+    with open('aws_iam/aws-lambda-default-policy.json') as f:
+        policy_document = json.load(f)
+    # the policy of an existing role is replaced when the actions are changed (e.g. x-ray)
+    if not policy or policy.get('PolicyDocument') != policy_document:
         print_message('put iam role policy')
 
         cmd = ['iam', 'put-role-policy']
@@ -49,6 +59,50 @@ def create_iam_for_lambda():
         time.sleep(120)
 
 
+def package_lambda(name, settings):
+    # runs in a worker thread: cleanup, environment values and the reproducible zip of the handler code
+    template_path = 'template/%s' % env['template']['NAME']
+    deploy_folder = '%s/lambda/%s' % (template_path, name)
+
+    ################################################################################
+    print_session('packaging lambda: %s' % settings['NAME'])
+
+    print_message('cleanup generated files')
+    run_subprocess(['git', 'clean', '-d', '-f', '-x'], cwd=deploy_folder)
+
+    settings_path = '%s/settings_local_sample.py' % deploy_folder
+    if os.path.exists(settings_path):
+        print_message('create environment values')
+
+        rule_list = list()
+        option_list = list()
+        option_list.append(['PHASE', env['common']['PHASE']])
+        for key in settings:
+            value = settings[key]
+            option_list.append([key, value])
+        for oo in option_list:
+            rule_list.append(['^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+        render_file(settings_path, '%s/settings_local.py' % deploy_folder, rule_list)
+
+    print_message('zip files')
+
+    return write_lambda_zip(deploy_folder)
+
+
+def run_create_lambda(lambda_env, code_sha256, function_configuration):
+    if lambda_env['TYPE'] == 'default':
+        run_create_lambda_default(lambda_env['NAME'], lambda_env, code_sha256, function_configuration)
+    elif lambda_env['TYPE'] == 'cron':
+        run_create_lambda_cron(lambda_env['NAME'], lambda_env, code_sha256, function_configuration)
+    elif lambda_env['TYPE'] == 'sns':
+        run_create_lambda_sns(lambda_env['NAME'], lambda_env, code_sha256, function_configuration)
+
+    if lambda_env.get('LOG_RETENTION_IN_DAYS'):
+        print_message('set log retention of %s' % lambda_env['NAME'])
+
+        aws_cli.set_log_retention('/aws/lambda/%s' % lambda_env['NAME'], lambda_env['LOG_RETENTION_IN_DAYS'])
+
+
 ################################################################################
 #
 # start
@@ -64,33 +118,30 @@ create_iam_for_lambda()
 lambdas_list = env['lambda']
 if len(args) == 2:
     target_lambda_name = args[1]
-    target_lambda_name_exists = False
-    for lambda_env in lambdas_list:
-        if lambda_env['NAME'] == target_lambda_name:
-            target_lambda_name_exists = True
-            if lambda_env['TYPE'] == 'default':
-                run_create_lambda_default(lambda_env['NAME'], lambda_env)
-                break
-            if lambda_env['TYPE'] == 'cron':
-                run_create_lambda_cron(lambda_env['NAME'], lambda_env)
-                break
-            if lambda_env['TYPE'] == 'sns':
-                run_create_lambda_sns(lambda_env['NAME'], lambda_env)
-                break
-            print('"%s" is not supported' % lambda_env['TYPE'])
-            raise Exception()
-    if not target_lambda_name_exists:
+    lambdas_list = [ll for ll in lambdas_list if ll['NAME'] == target_lambda_name]
+    if not lambdas_list:
         print('"%s" is not exists in config.json' % target_lambda_name)
-else:
-    for lambda_env in lambdas_list:
-        if lambda_env['TYPE'] == 'default':
-            run_create_lambda_default(lambda_env['NAME'], lambda_env)
-            continue
-        if lambda_env['TYPE'] == 'cron':
-            run_create_lambda_cron(lambda_env['NAME'], lambda_env)
-            continue
-        if lambda_env['TYPE'] == 'sns':
-            run_create_lambda_sns(lambda_env['NAME'], lambda_env)
-            continue
+
+for lambda_env in lambdas_list:
+    if lambda_env['TYPE'] not in ('default', 'cron', 'sns'):
         print('"%s" is not supported' % lambda_env['TYPE'])
         raise Exception()
+
+################################################################################
+print_message('check previous versions')
+
+# one paginated listing instead of one listing per function
+function_list = aws_cli.get_lambda_function_list()
+
+################################################################################
+# the zips are built in threads as well; the compression runs in the thread pool of Bundle (zlib releases the GIL)
+job_list = list()
+for lambda_env in lambdas_list:
+    job_list.append([lambda_env['NAME'], package_lambda, (lambda_env['NAME'], lambda_env)])
+code_sha256_list = run_parallel(job_list, 4)
+
+job_list = list()
+for lambda_env, code_sha256 in zip(lambdas_list, code_sha256_list):
+    job_list.append([lambda_env['NAME'], run_create_lambda,
+                     (lambda_env, code_sha256, function_list.get(lambda_env['NAME']))])
+run_parallel(job_list, 8)
@@ -1,30 +1,78 @@
 #!/usr/bin/env python3
 import os
-import subprocess
 
+from bundle import publish_lambda_layer
 from env import env
 from run_common import AWSCli
+from run_common import get_git_hash
+from run_common import get_lambda_configuration_args
+from run_common import get_lambda_layer_name
 from run_common import print_message
 from run_common import print_session
-from run_common import re_sub_lines
-from run_common import read_file
-from run_common import write_file
 
 
-def run_create_lambda_sns(name, settings):
+def _move_subscription_to_alias(aws_cli, function_name, function_arn, alias_arn, topic_arn):
+    # the alias is subscribed before the function is unsubscribed, so no message is lost while moving
+    topic_region = topic_arn.split(':')[3]
+    topic_aws_cli = AWSCli(topic_region)
+
+    subscription_list = list()
+    next_token = None
+    while True:
+        cmd = ['sns', 'list-subscriptions-by-topic',
+               '--topic-arn', topic_arn]
+        if next_token:
+            cmd += ['--next-token', next_token]
+        result = topic_aws_cli.run(cmd)
+
+        subscription_list += result['Subscriptions']
+        next_token = result.get('NextToken')
+        if not next_token:
+            break
+
+    function_subscription_list = [ss for ss in subscription_list
+                                  if ss['Protocol'] == 'lambda' and ss['Endpoint'] == function_arn]
+    if not function_subscription_list:
+        return
+
+    print_message('move subscription to alias: %s' % topic_arn)
+
+    # the statement is already there when the subscription was moved by the previous deploy
+    cmd = ['lambda', 'add-permission',
+           '--function-name', function_name,
+           '--qualifier', alias_arn.split(':')[-1],
+           '--statement-id', '%s_%s_AliasPermission' % (function_name, topic_region),
+           '--action', 'lambda:InvokeFunction',
+           '--principal', 'sns.amazonaws.com',
+           '--source-arn', topic_arn]
+    aws_cli.run(cmd, ignore_error=True)
+
+    cmd = ['sns', 'subscribe',
+           '--topic-arn', topic_arn,
+           '--protocol', 'lambda',
+           '--notification-endpoint', alias_arn]
+    topic_aws_cli.run(cmd)
+
+    for ss in function_subscription_list:
+        cmd = ['sns', 'unsubscribe',
+               '--subscription-arn', ss['SubscriptionArn']]
+        topic_aws_cli.run(cmd)
+
+
+def run_create_lambda_sns(name, settings, code_sha256, function_configuration=None):
     aws_cli = AWSCli()
 
     description = settings['DESCRIPTION']
     function_name = settings['NAME']
-    phase = env['common']['PHASE']
+    architecture = settings.get('ARCHITECTURE', 'x86_64')
+    runtime = settings.get('RUNTIME', 'python3.6')
     template_name = env['template']['NAME']
 
     template_path = 'template/%s' % template_name
     deploy_folder = '%s/lambda/%s' % (template_path, name)
 
-    git_rev = ['git', 'rev-parse', 'HEAD']
-    git_hash_johanna = subprocess.Popen(git_rev, stdout=subprocess.PIPE).communicate()[0]
-    git_hash_template = subprocess.Popen(git_rev, stdout=subprocess.PIPE, cwd=template_path).communicate()[0]
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
 
     ################################################################################
     topic_arn_list = list()
@@ -38,74 +86,68 @@ def run_create_lambda_sns(name, settings):
         topic_arn_list.append(topic_arn)
 
     ################################################################################
-    print_session('packaging lambda: %s' % function_name)
-
-    print_message('cleanup generated files')
-    subprocess.Popen(['git', 'clean', '-d', '-f', '-x'], cwd=deploy_folder).communicate()
-
+    # the dependencies are not in the function zip but in a layer shared by the same requirements
     requirements_path = '%s/requirements.txt' % deploy_folder
+    layer_arn = None
     if os.path.exists(requirements_path):
-        print_message('install dependencies')
-
-        cmd = ['pip3', 'install', '-r', requirements_path, '-t', deploy_folder]
-        subprocess.Popen(cmd).communicate()
-
-    settings_path = '%s/settings_local_sample.py' % deploy_folder
-    if os.path.exists(settings_path):
-        print_message('create environment values')
+        print_message('publish dependency layer')
 
-        lines = read_file(settings_path)
-        option_list = list()
-        option_list.append(['PHASE', phase])
-        for key in settings:
-            value = settings[key]
-            option_list.append([key, value])
-        for oo in option_list:
-            lines = re_sub_lines(lines, '^(%s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
-        write_file('%s/settings_local.py' % deploy_folder, lines)
-
-    print_message('zip files')
-
-    cmd = ['zip', '-r', 'deploy.zip', '.']
-    subprocess.Popen(cmd, cwd=deploy_folder).communicate()
+        layer_arn = publish_lambda_layer(aws_cli, requirements_path, get_lambda_layer_name(), runtime, architecture)
 
     print_message('create lambda function')
 
     role_arn = aws_cli.get_role_arn('aws-lambda-default-role')
 
     tags = list()
-    # noinspection PyUnresolvedReferences
-    tags.append('git_hash_johanna=%s' % git_hash_johanna.decode('utf-8').strip())
-    # noinspection PyUnresolvedReferences
-    tags.append('git_hash_%s=%s' % (template_name, git_hash_template.decode('utf-8').strip()))
-
-    ################################################################################
-    print_message('check previous version')
-
-    need_update = False
-    cmd = ['lambda', 'list-functions']
-    result = aws_cli.run(cmd)
-    for ff in result['Functions']:
-        if function_name == ff['FunctionName']:
-            need_update = True
-            break
+    tags.append('git_hash_johanna=%s' % git_hash_johanna)
+    tags.append('git_hash_%s=%s' % (template_name, git_hash_template))
 
     ################################################################################
-    if need_update:
+    if function_configuration:
         print_session('update lambda: %s' % function_name)
 
-        cmd = ['lambda', 'update-function-code',
-               '--function-name', function_name,
-               '--zip-file', 'fileb://deploy.zip']
-        result = aws_cli.run(cmd, cwd=deploy_folder)
-        function_arn = result['FunctionArn']
-
-        print_message('update lambda tags')
-
-        cmd = ['lambda', 'tag-resource',
-               '--resource', function_arn,
-               '--tags', ','.join(tags)]
-        aws_cli.run(cmd, cwd=deploy_folder)
+        configuration_args = get_lambda_configuration_args(settings, layer_arn, function_configuration)
+        if configuration_args:
+            print_message('update lambda configuration')
+
+            cmd = ['lambda', 'update-function-configuration',
+                   '--function-name', function_name]
+            cmd += configuration_args
+            aws_cli.run(cmd)
+
+            # the code can not be updated while the configuration is being updated
+            cmd = ['lambda', 'wait', 'function-updated',
+                   '--function-name', function_name]
+            aws_cli.run(cmd, ignore_error=True)
+
+        architecture_changed = function_configuration.get('Architectures', ['x86_64']) != [architecture]
+        if function_configuration.get('CodeSha256') == code_sha256 and not architecture_changed:
+            print('skip: the code is not changed (CodeSha256: %s)' % code_sha256)
+        else:
+            cmd = ['lambda', 'update-function-code',
+                   '--function-name', function_name,
+                   '--zip-file', 'fileb://deploy.zip']
+            if architecture_changed:
+                cmd += ['--architectures', architecture]
+            result = aws_cli.run(cmd, cwd=deploy_folder)
+            function_arn = result['FunctionArn']
+
+            print_message('update lambda tags')
+
+            cmd = ['lambda', 'tag-resource',
+                   '--resource', function_arn,
+                   '--tags', ','.join(tags)]
+            aws_cli.run(cmd, cwd=deploy_folder)
+
+        print_message('set lambda concurrency')
+
+        alias_arn = aws_cli.update_lambda_concurrency(function_name, settings, True)
+
+        if alias_arn:
+            # the subscriptions of the function are moved to the alias the first time it gets one
+            for topic_arn in topic_arn_list:
+                _move_subscription_to_alias(aws_cli, function_name, function_configuration['FunctionArn'],
+                                            alias_arn, topic_arn)
         return
 
     ################################################################################
@@ -117,13 +159,20 @@ def run_create_lambda_sns(name, settings):
            '--zip-file', 'fileb://deploy.zip',
            '--role', role_arn,
            '--handler', 'lambda.handler',
-           '--runtime', 'python3.6',
-           '--tags', ','.join(tags),
-           '--timeout', '120']
+           '--tags', ','.join(tags)]
+    cmd += get_lambda_configuration_args(settings, layer_arn)
+    if architecture != 'x86_64':
+        cmd += ['--architectures', architecture]
     result = aws_cli.run(cmd, cwd=deploy_folder)
 
     function_arn = result['FunctionArn']
 
+    print_message('set lambda concurrency')
+
+    # the invokers use the alias of the published version when it has provisioned concurrency
+    alias_arn = aws_cli.update_lambda_concurrency(function_name, settings, False)
+    invoke_arn = alias_arn or function_arn
+
     for topic_arn in topic_arn_list:
         print_message('create subscription')
 
@@ -132,7 +181,7 @@ def run_create_lambda_sns(name, settings):
         cmd = ['sns', 'subscribe',
                '--topic-arn', topic_arn,
                '--protocol', 'lambda',
-               '--notification-endpoint', function_arn]
+               '--notification-endpoint', invoke_arn]
         AWSCli(topic_region).run(cmd)
 
         print_message('Add permission to lambda')
@@ -145,6 +194,8 @@ def run_create_lambda_sns(name, settings):
                '--action', 'lambda:InvokeFunction',
                '--principal', 'sns.amazonaws.com',
                '--source-arn', topic_arn]
+        if alias_arn:
+            cmd += ['--qualifier', alias_arn.split(':')[-1]]
         aws_cli.run(cmd)
 
     print_message('update tag with subscription info')
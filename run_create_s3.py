@@ -6,11 +6,11 @@ import time
 from env import env
 from run_common import AWSCli
 from run_common import check_template_availability
+from run_common import get_git_hash
+from run_common import git_export
 from run_common import print_message
 from run_common import print_session
-from run_common import re_sub_lines
-from run_common import read_file
-from run_common import write_file
+from run_common import render_file
 
 args = []
 
@@ -38,9 +38,8 @@ def run_create_s3_webapp(name, settings):
     bucket_prefix = settings.get('BUCKET_PREFIX', '')
     deploy_bucket_prefix = os.path.normpath('%s/%s' % (deploy_bucket_name, bucket_prefix))
 
-    git_rev = ['git', 'rev-parse', 'HEAD']
-    git_hash_johanna = subprocess.Popen(git_rev, stdout=subprocess.PIPE).communicate()[0]
-    git_hash_template = subprocess.Popen(git_rev, stdout=subprocess.PIPE, cwd=template_path).communicate()[0]
+    git_hash_johanna = get_git_hash()
+    git_hash_template = get_git_hash(template_path)
 
     ################################################################################
     print_session('create %s' % name)
@@ -48,20 +47,12 @@ def run_create_s3_webapp(name, settings):
     ################################################################################
     print_message('git clone')
 
-    subprocess.Popen(['rm', '-rf', './%s' % name], cwd=environment_path).communicate()
-    if phase == 'dv':
-        git_command = ['git', 'clone', '--depth=1', git_url, name]
-    else:
-        git_command = ['git', 'clone', '--depth=1', '-b', phase, git_url, name]
-    subprocess.Popen(git_command, cwd=environment_path).communicate()
+    branch = None if phase == 'dv' else phase
+    git_clone_folder = '%s/%s' % (environment_path, name)
+    git_hash_app = git_export(git_url, branch, git_clone_folder)
     if not os.path.exists(app_root_path):
         raise Exception()
 
-    git_clone_folder = '%s/%s' % (environment_path, name)
-    git_hash_app = subprocess.Popen(git_rev,
-                                    stdout=subprocess.PIPE,
-                                    cwd=git_clone_folder).communicate()[0]
-    subprocess.Popen(['rm', '-rf', './.git'], cwd=git_clone_folder).communicate()
     subprocess.Popen(['rm', '-rf', './.gitignore'], cwd=git_clone_folder).communicate()
 
     ################################################################################
@@ -84,15 +75,16 @@ def run_create_s3_webapp(name, settings):
     ################################################################################
     print_message('configure %s' % name)
 
-    lines = read_file('%s/configuration/app/scripts/settings-local-sample.js' % environment_path)
+    rule_list = list()
     option_list = list()
     option_list.append(['phase', phase])
     for key in settings:
         value = settings[key]
         option_list.append([key, value])
     for oo in option_list:
-        lines = re_sub_lines(lines, '^(var %s) .*' % oo[0], '\\1 = \'%s\'' % oo[1])
-    write_file('%s/app/scripts/settings-local.js' % app_root_path, lines)
+        rule_list.append(['^(var %s) .*' % oo[0], '\\1 = \'%s\'' % oo[1]])
+    render_file('%s/configuration/app/scripts/settings-local-sample.js' % environment_path,
+                '%s/app/scripts/settings-local.js' % app_root_path, rule_list)
 
     ################################################################################
     print_message('grunt build')
@@ -160,9 +152,9 @@ def run_create_s3_webapp(name, settings):
             tag_dict[key] = value
 
     tag_dict['phase'] = phase
-    tag_dict['git_hash_johanna'] = git_hash_johanna.decode('utf-8')
-    tag_dict['git_hash_template'] = git_hash_template.decode('utf-8')
-    tag_dict['git_hash_%s' % name] = git_hash_app.decode('utf-8')
+    tag_dict['git_hash_johanna'] = git_hash_johanna
+    tag_dict['git_hash_template'] = git_hash_template
+    tag_dict['git_hash_%s' % name] = git_hash_app
     tag_dict['timestamp_%s' % name] = timestamp
 
     tag_format = '{Key=%s, Value=%s}'
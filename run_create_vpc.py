@@ -3,6 +3,7 @@ import sys
 
 from env import env
 from run_common import AWSCli
+from run_common import get_availability_zones
 from run_common import print_message
 from run_common import print_session
 
@@ -13,8 +14,7 @@ if __name__ == "__main__":
 
 
 def main(settings):
-    aws_availability_zone_1 = settings['AWS_AVAILABILITY_ZONE_1']
-    aws_availability_zone_2 = settings['AWS_AVAILABILITY_ZONE_2']
+    aws_availability_zone_list = get_availability_zones(settings)
     aws_cli = AWSCli(settings['AWS_DEFAULT_REGION'])
     rds_subnet_name = env['rds']['DB_SUBNET_NAME']
     service_name = env['common'].get('SERVICE_NAME', '')
@@ -87,21 +87,16 @@ def main(settings):
 
     rds_subnet_id = dict()
 
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', rds_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['rds']['private_1']]
-    cmd += ['--availability-zone', aws_availability_zone_1]
-    result = aws_cli.run(cmd)
-    rds_subnet_id['private_1'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(rds_subnet_id['private_1'], '%srds_private_1' % name_prefix)
+    for ii, aws_availability_zone in enumerate(aws_availability_zone_list):
+        key = 'private_%d' % (ii + 1)
 
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', rds_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['rds']['private_2']]
-    cmd += ['--availability-zone', aws_availability_zone_2]
-    result = aws_cli.run(cmd)
-    rds_subnet_id['private_2'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(rds_subnet_id['private_2'], '%srds_private_2' % name_prefix)
+        cmd = ['ec2', 'create-subnet']
+        cmd += ['--vpc-id', rds_vpc_id]
+        cmd += ['--cidr-block', cidr_subnet['rds'][key]]
+        cmd += ['--availability-zone', aws_availability_zone]
+        result = aws_cli.run(cmd)
+        rds_subnet_id[key] = result['Subnet']['SubnetId']
+        aws_cli.set_name_tag(rds_subnet_id[key], '%srds_%s' % (name_prefix, key))
 
     ################################################################################
     print_message('create db subnet group')
@@ -109,7 +104,7 @@ def main(settings):
     cmd = ['rds', 'create-db-subnet-group']
     cmd += ['--db-subnet-group-name', rds_subnet_name]
     cmd += ['--db-subnet-group-description', rds_subnet_name]
-    cmd += ['--subnet-ids', rds_subnet_id['private_1'], rds_subnet_id['private_2']]
+    cmd += ['--subnet-ids'] + [rds_subnet_id[key] for key in sorted(rds_subnet_id)]
     aws_cli.run(cmd)
 
     ################################################################################
@@ -126,15 +121,11 @@ def main(settings):
     ################################################################################
     print_message('associate route table')
 
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', rds_subnet_id['private_1']]
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', rds_subnet_id['private_2']]
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    aws_cli.run(cmd)
+    for key in sorted(rds_subnet_id):
+        cmd = ['ec2', 'associate-route-table']
+        cmd += ['--subnet-id', rds_subnet_id[key]]
+        cmd += ['--route-table-id', rds_route_table_id['private']]
+        aws_cli.run(cmd)
 
     ################################################################################
     print_message('create security group')
@@ -185,37 +176,17 @@ def main(settings):
 
     eb_subnet_id = dict()
 
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', eb_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['eb']['private_1']]
-    cmd += ['--availability-zone', aws_availability_zone_1]
-    result = aws_cli.run(cmd)
-    eb_subnet_id['private_1'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(eb_subnet_id['private_1'], '%seb_private_1' % name_prefix)
-
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', eb_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['eb']['private_2']]
-    cmd += ['--availability-zone', aws_availability_zone_2]
-    result = aws_cli.run(cmd)
-    eb_subnet_id['private_2'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(eb_subnet_id['private_2'], '%seb_private_2' % name_prefix)
-
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', eb_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['eb']['public_1']]
-    cmd += ['--availability-zone', aws_availability_zone_1]
-    result = aws_cli.run(cmd)
-    eb_subnet_id['public_1'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(eb_subnet_id['public_1'], '%seb_public_1' % name_prefix)
+    for subnet_type in ('private', 'public'):
+        for ii, aws_availability_zone in enumerate(aws_availability_zone_list):
+            key = '%s_%d' % (subnet_type, ii + 1)
 
-    cmd = ['ec2', 'create-subnet']
-    cmd += ['--vpc-id', eb_vpc_id]
-    cmd += ['--cidr-block', cidr_subnet['eb']['public_2']]
-    cmd += ['--availability-zone', aws_availability_zone_2]
-    result = aws_cli.run(cmd)
-    eb_subnet_id['public_2'] = result['Subnet']['SubnetId']
-    aws_cli.set_name_tag(eb_subnet_id['public_2'], '%seb_public_2' % name_prefix)
+            cmd = ['ec2', 'create-subnet']
+            cmd += ['--vpc-id', eb_vpc_id]
+            cmd += ['--cidr-block', cidr_subnet['eb'][key]]
+            cmd += ['--availability-zone', aws_availability_zone]
+            result = aws_cli.run(cmd)
+            eb_subnet_id[key] = result['Subnet']['SubnetId']
+            aws_cli.set_name_tag(eb_subnet_id[key], '%seb_%s' % (name_prefix, key))
 
     ################################################################################
     print_message('create internet gateway')
@@ -234,23 +205,33 @@ def main(settings):
     aws_cli.run(cmd)
 
     ################################################################################
-    print_message('create eip')  # We use only one NAT gateway at subnet 'public_1'
+    print_message('create eip')  # We use one NAT gateway per availability zone at subnet 'public_N'
 
-    cmd = ['ec2', 'allocate-address']
-    cmd += ['--domain', 'vpc']
-    result = aws_cli.run(cmd)
-    eb_eip_id = result['AllocationId']
-    aws_cli.set_name_tag(eb_eip_id, '%snat' % name_prefix)
+    eb_eip_id = dict()
+
+    for ii in range(len(aws_availability_zone_list)):
+        key = '%d' % (ii + 1)
+
+        cmd = ['ec2', 'allocate-address']
+        cmd += ['--domain', 'vpc']
+        result = aws_cli.run(cmd)
+        eb_eip_id[key] = result['AllocationId']
+        aws_cli.set_name_tag(eb_eip_id[key], '%snat_%s' % (name_prefix, key))
 
     ################################################################################
-    print_message('create nat gateway')  # We use only one NAT gateway at subnet 'public_1'
+    print_message('create nat gateway')  # We use one NAT gateway per availability zone at subnet 'public_N'
 
-    cmd = ['ec2', 'create-nat-gateway']
-    cmd += ['--subnet-id', eb_subnet_id['public_1']]
-    cmd += ['--allocation-id', eb_eip_id]
-    result = aws_cli.run(cmd)
-    eb_nat_gateway_id = result['NatGateway']['NatGatewayId']
-    aws_cli.set_name_tag(eb_nat_gateway_id, '%seb' % name_prefix)
+    eb_nat_gateway_id = dict()
+
+    for ii in range(len(aws_availability_zone_list)):
+        key = '%d' % (ii + 1)
+
+        cmd = ['ec2', 'create-nat-gateway']
+        cmd += ['--subnet-id', eb_subnet_id['public_%s' % key]]
+        cmd += ['--allocation-id', eb_eip_id[key]]
+        result = aws_cli.run(cmd)
+        eb_nat_gateway_id[key] = result['NatGateway']['NatGatewayId']
+        aws_cli.set_name_tag(eb_nat_gateway_id[key], '%seb_%s' % (name_prefix, key))
 
     ################################################################################
     print_message('wait create nat gateway')
@@ -262,11 +243,14 @@ def main(settings):
 
     eb_route_table_id = dict()
 
-    cmd = ['ec2', 'create-route-table']
-    cmd += ['--vpc-id', eb_vpc_id]
-    result = aws_cli.run(cmd)
-    eb_route_table_id['private'] = result['RouteTable']['RouteTableId']
-    aws_cli.set_name_tag(eb_route_table_id['private'], '%seb_private' % name_prefix)
+    for ii in range(len(aws_availability_zone_list)):
+        key = 'private_%d' % (ii + 1)
+
+        cmd = ['ec2', 'create-route-table']
+        cmd += ['--vpc-id', eb_vpc_id]
+        result = aws_cli.run(cmd)
+        eb_route_table_id[key] = result['RouteTable']['RouteTableId']
+        aws_cli.set_name_tag(eb_route_table_id[key], '%seb_%s' % (name_prefix, key))
 
     cmd = ['ec2', 'create-route-table']
     cmd += ['--vpc-id', eb_vpc_id]
@@ -277,25 +261,13 @@ def main(settings):
     ################################################################################
     print_message('associate route table')
 
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', eb_subnet_id['private_1']]
-    cmd += ['--route-table-id', eb_route_table_id['private']]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', eb_subnet_id['private_2']]
-    cmd += ['--route-table-id', eb_route_table_id['private']]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', eb_subnet_id['public_1']]
-    cmd += ['--route-table-id', eb_route_table_id['public']]
-    aws_cli.run(cmd)
+    for key in sorted(eb_subnet_id):
+        route_table_key = key if key.startswith('private_') else 'public'
 
-    cmd = ['ec2', 'associate-route-table']
-    cmd += ['--subnet-id', eb_subnet_id['public_2']]
-    cmd += ['--route-table-id', eb_route_table_id['public']]
-    aws_cli.run(cmd)
+        cmd = ['ec2', 'associate-route-table']
+        cmd += ['--subnet-id', eb_subnet_id[key]]
+        cmd += ['--route-table-id', eb_route_table_id[route_table_key]]
+        aws_cli.run(cmd)
 
     ################################################################################
     print_message('create route')
@@ -306,11 +278,26 @@ def main(settings):
     cmd += ['--gateway-id', internet_gateway_id]
     aws_cli.run(cmd)
 
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', eb_route_table_id['private']]
-    cmd += ['--destination-cidr-block', '0.0.0.0/0']
-    cmd += ['--nat-gateway-id', eb_nat_gateway_id]
-    aws_cli.run(cmd)
+    for ii in range(len(aws_availability_zone_list)):
+        key = '%d' % (ii + 1)
+
+        cmd = ['ec2', 'create-route']
+        cmd += ['--route-table-id', eb_route_table_id['private_%s' % key]]
+        cmd += ['--destination-cidr-block', '0.0.0.0/0']
+        cmd += ['--nat-gateway-id', eb_nat_gateway_id[key]]
+        aws_cli.run(cmd)
+
+    ################################################################################
+    print_message('create vpc endpoint')  # S3 (and DynamoDB) traffic bypasses the NAT gateways
+
+    for endpoint_service in settings.get('AWS_VPC_GATEWAY_ENDPOINTS', ['s3']):
+        cmd = ['ec2', 'create-vpc-endpoint']
+        cmd += ['--vpc-id', eb_vpc_id]
+        cmd += ['--service-name', 'com.amazonaws.%s.%s' % (settings['AWS_DEFAULT_REGION'], endpoint_service)]
+        cmd += ['--route-table-ids'] + [eb_route_table_id[key] for key in sorted(eb_route_table_id)]
+        result = aws_cli.run(cmd)
+        vpc_endpoint_id = result['VpcEndpoint']['VpcEndpointId']
+        aws_cli.set_name_tag(vpc_endpoint_id, '%seb_%s' % (name_prefix, endpoint_service))
 
     ################################################################################
     print_message('create security group')
@@ -388,7 +375,7 @@ def main(settings):
         cmd = ['elasticache', 'create-cache-subnet-group']
         cmd += ['--cache-subnet-group-name', elasticache_subnet_name]
         cmd += ['--cache-subnet-group-description', elasticache_subnet_name]
-        cmd += ['--subnet-ids', eb_subnet_id['private_1'], eb_subnet_id['private_2']]
+        cmd += ['--subnet-ids'] + [eb_subnet_id[key] for key in sorted(eb_subnet_id) if key.startswith('private_')]
         aws_cli.run(cmd)
 
     ################################################################################
@@ -415,56 +402,23 @@ def main(settings):
     ################################################################################
     print_message('create route: rds -> eb')
 
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['eb']['private_1']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['eb']['private_2']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['eb']['public_1']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', rds_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['eb']['public_2']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
+    for key in sorted(eb_subnet_id):
+        cmd = ['ec2', 'create-route']
+        cmd += ['--route-table-id', rds_route_table_id['private']]
+        cmd += ['--destination-cidr-block', cidr_subnet['eb'][key]]
+        cmd += ['--vpc-peering-connection-id', peering_connection_id]
+        aws_cli.run(cmd)
 
     ################################################################################
     print_message('create route: eb -> rds')
 
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', eb_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['rds']['private_1']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', eb_route_table_id['private']]
-    cmd += ['--destination-cidr-block', cidr_subnet['rds']['private_2']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', eb_route_table_id['public']]
-    cmd += ['--destination-cidr-block', cidr_subnet['rds']['private_1']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
-
-    cmd = ['ec2', 'create-route']
-    cmd += ['--route-table-id', eb_route_table_id['public']]
-    cmd += ['--destination-cidr-block', cidr_subnet['rds']['private_2']]
-    cmd += ['--vpc-peering-connection-id', peering_connection_id]
-    aws_cli.run(cmd)
+    for route_table_key in sorted(eb_route_table_id):
+        for key in sorted(rds_subnet_id):
+            cmd = ['ec2', 'create-route']
+            cmd += ['--route-table-id', eb_route_table_id[route_table_key]]
+            cmd += ['--destination-cidr-block', cidr_subnet['rds'][key]]
+            cmd += ['--vpc-peering-connection-id', peering_connection_id]
+            aws_cli.run(cmd)
 
     ################################################################################
     #
@@ -23,13 +23,12 @@ def describe_cron_lambda(func_info):
 
 results = list()
 
-cmd = ['lambda', 'list-functions']
-result = aws_cli.run(cmd)
+function_list = aws_cli.get_lambda_function_list()
 
 default_lambda_count = 0
 cron_lambda_count = 0
 
-for func in result['Functions']:
+for func in function_list.values():
     if describe_default_lambda(func):
         default_lambda_count += 1
     if describe_cron_lambda(func):
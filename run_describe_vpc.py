@@ -59,6 +59,17 @@ def describe_nat_gateways(vpc_id=None):
     return True
 
 
+def describe_vpc_endpoints(vpc_id=None):
+    cmd = ['ec2', 'describe-vpc-endpoints']
+    cmd += ['--filters=Name=vpc-id,Values=%s' % vpc_id]
+    result = aws_cli.run(cmd, ignore_error=True)
+
+    if not result['VpcEndpoints']:
+        return False
+    else:
+        return True
+
+
 def describe_eb_route_tables(vpc_id=None):
     cmd = ['ec2', 'describe-route-tables']
     cmd += ['--filters=Name=vpc-id,Values=%s' % vpc_id]
@@ -169,6 +180,11 @@ if not describe_nat_gateways(current_eb_vpc_id):
 else:
     results.append(['EC2 Nat Gateway', 'O'])
 
+if not describe_vpc_endpoints(current_eb_vpc_id):
+    results.append(['EC2 VPC Endpoint', 'X'])
+else:
+    results.append(['EC2 VPC Endpoint', 'O'])
+
 if not describe_eb_route_tables(current_eb_vpc_id):
     results.append(['EC2 Route', 'X'])
 else:
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from access_log import AccessLogStat
+from access_log import read_access_log
+from run_common import AWSCli
+from run_common import get_live_eb_environment_list
+from run_common import print_message
+from run_common import print_session
+from run_common import run_parallel
+
+args = []
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    args = parse_args()
+
+
+def _request_log_bundle(aws_default_region, environment_name):
+    aws_cli = AWSCli(aws_default_region)
+
+    cmd = ['elasticbeanstalk', 'describe-environment-resources']
+    cmd += ['--environment-name', environment_name]
+    result = aws_cli.run(cmd)
+
+    instance_list = [ii['Id'] for ii in result['EnvironmentResources']['Instances']]
+
+    cmd = ['elasticbeanstalk', 'request-environment-info']
+    cmd += ['--environment-name', environment_name]
+    cmd += ['--info-type', 'bundle']
+    aws_cli.run(cmd)
+
+    return instance_list
+
+
+def _retrieve_log_bundle(aws_default_region, environment_name, instance_list, request_time):
+    # returns {instance id: url} when every instance has uploaded its bundle
+    aws_cli = AWSCli(aws_default_region)
+
+    elapsed_time = 0
+    while True:
+        cmd = ['elasticbeanstalk', 'retrieve-environment-info']
+        cmd += ['--environment-name', environment_name]
+        cmd += ['--info-type', 'bundle']
+        result = aws_cli.run(cmd)
+
+        url_list = dict()
+        for ii in sorted(result['EnvironmentInfo'], key=lambda x: x['SampleTimestamp']):
+            if ii['SampleTimestamp'][:19] >= request_time:
+                url_list[ii['Ec2InstanceId']] = ii['Message']
+
+        if all([ii in url_list for ii in instance_list]):
+            return url_list
+
+        if elapsed_time > 60 * 5:
+            print('ERROR!!! log bundles of %s are not ready (%d/%d)' %
+                  (environment_name, len(url_list), len(instance_list)))
+            raise Exception()
+
+        print('waiting for log bundles... (%d/%d, elapsed time: \'%d\' seconds)' %
+              (len(url_list), len(instance_list), elapsed_time))
+        time.sleep(10)
+        elapsed_time += 10
+
+
+def _download(url, file_path):
+    with urllib.request.urlopen(url, timeout=60) as response, open(file_path, 'wb') as f:
+        shutil.copyfileobj(response, f, 1024 * 1024)
+    print('downloaded: %s (%d bytes)' % (file_path, os.path.getsize(file_path)))
+    return file_path
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('fetch eb logs')
+
+live_list = get_live_eb_environment_list()
+if len(args) > 1:
+    live_list = [ll for ll in live_list if ll[1].startswith(args[1])]
+
+if not live_list:
+    print('no environment is running')
+    raise SystemExit(0)
+
+################################################################################
+print_message('request log bundles')
+
+request_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+str_timestamp = str(int(time.time()))
+
+job_list = list()
+for region, environment_name in live_list:
+    job_list.append([environment_name, _request_log_bundle, (region, environment_name)])
+instance_list = run_parallel(job_list, len(job_list))
+
+################################################################################
+print_message('retrieve log bundles')
+
+job_list = list()
+for (region, environment_name), ii in zip(live_list, instance_list):
+    job_list.append([environment_name, _retrieve_log_bundle, (region, environment_name, ii, request_time)])
+url_list = run_parallel(job_list, len(job_list))
+
+################################################################################
+print_message('download log bundles')
+
+file_list = dict()
+with ThreadPoolExecutor(max_workers=16) as executor:
+    future_list = list()
+    for (region, environment_name), uu in zip(live_list, url_list):
+        log_path = 'log/%s' % environment_name
+        os.makedirs(log_path, exist_ok=True)
+        file_list[environment_name] = list()
+        for instance_id in sorted(uu):
+            file_path = '%s/%s-%s.zip' % (log_path, instance_id, str_timestamp)
+            future_list.append([environment_name, executor.submit(_download, uu[instance_id], file_path)])
+
+    for environment_name, ff in future_list:
+        file_list[environment_name].append(ff.result())
+
+################################################################################
+# the access logs are read as streams in separate processes and only the sketches are merged
+with ProcessPoolExecutor() as executor:
+    for region, environment_name in live_list:
+        print_message('access log of %s' % environment_name)
+
+        stat = AccessLogStat()
+        for ss in executor.map(read_access_log, file_list[environment_name]):
+            stat.merge(ss)
+        stat.print_report()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from env import env
+from run_common import AWSCli
+from run_common import get_option
+from run_common import print_session
+
+args = []
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    args = parse_args()
+
+# log streams which are read by one 'filter-log-events' pagination
+_stream_batch_size = 10
+
+
+def _get_log_group_prefix_list(target):
+    # an eb environment name, a lambda function name or a log group name prefix ('/...')
+    prefix_list = list()
+    if target and target.startswith('/'):
+        return [[env['aws']['AWS_DEFAULT_REGION'], target]]
+
+    for eb_env in env.get('elasticbeanstalk', dict()).get('ENVIRONMENTS', list()):
+        if target and eb_env['NAME'] != target:
+            continue
+        region = eb_env.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])
+        prefix_list.append([region, '/aws/elasticbeanstalk/%s-' % eb_env['NAME']])
+
+    for lambda_env in env.get('lambda', list()):
+        if target and lambda_env['NAME'] != target:
+            continue
+        prefix_list.append([env['aws']['AWS_DEFAULT_REGION'], '/aws/lambda/%s' % lambda_env['NAME']])
+
+    return prefix_list
+
+
+def _describe_log_streams(aws_cli, log_group_name, start_time):
+    # the most recently written streams first; the older ones have no event after 'start_time'
+    stream_list = list()
+    next_token = None
+    while True:
+        cmd = ['logs', 'describe-log-streams']
+        cmd += ['--log-group-name', log_group_name]
+        cmd += ['--order-by', 'LastEventTime']
+        cmd += ['--descending']
+        if next_token:
+            cmd += ['--next-token', next_token]
+        result = aws_cli.run(cmd, quiet=True)
+
+        for ss in result['logStreams']:
+            if ss.get('lastEventTimestamp', 0) < start_time - 60 * 60 * 1000:
+                return stream_list
+            stream_list.append(ss['logStreamName'])
+
+        next_token = result.get('nextToken')
+        if not next_token:
+            return stream_list
+
+
+def _get_job_list(executor, start_time):
+    # log groups and their streams are listed concurrently
+    group_list = list()
+    for region, prefix in prefix_list:
+        aws_cli = AWSCli(region)
+
+        if prefix.startswith('/aws/lambda/'):
+            group_list.append([aws_cli, prefix])
+            continue
+
+        cmd = ['logs', 'describe-log-groups']
+        cmd += ['--log-group-name-prefix', prefix]
+        result = aws_cli.run(cmd, quiet=True)
+        group_list += [[aws_cli, gg['logGroupName']] for gg in result['logGroups']]
+
+    future_list = list()
+    for aws_cli, log_group_name in group_list:
+        future_list.append([aws_cli, log_group_name,
+                            executor.submit(_describe_log_streams, aws_cli, log_group_name, start_time)])
+
+    job_list = list()
+    for aws_cli, log_group_name, ff in future_list:
+        # noinspection PyBroadException
+        try:
+            stream_list = ff.result()
+        except Exception:
+            continue
+        for ii in range(0, len(stream_list), _stream_batch_size):
+            job_list.append([aws_cli, log_group_name, stream_list[ii:ii + _stream_batch_size]])
+    return job_list
+
+
+def _filter_log_events(aws_cli, log_group_name, stream_list, start_time, filter_pattern):
+    event_list = list()
+    next_token = None
+    while True:
+        cmd = ['logs', 'filter-log-events']
+        cmd += ['--log-group-name', log_group_name]
+        cmd += ['--log-stream-names'] + stream_list
+        cmd += ['--start-time', str(start_time)]
+        if filter_pattern:
+            cmd += ['--filter-pattern', filter_pattern]
+        if next_token:
+            cmd += ['--next-token', next_token]
+        result = aws_cli.run(cmd, quiet=True)
+
+        for ee in result['events']:
+            event_list.append((ee['timestamp'], ee['eventId'], log_group_name, ee['logStreamName'], ee['message']))
+
+        next_token = result.get('nextToken')
+        if not next_token:
+            break
+
+    event_list.sort()
+    return event_list
+
+
+def _print_event(ee):
+    timestamp, event_id, log_group_name, log_stream_name, message = ee
+    str_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp // 1000))
+    print('%s.%03d %s %s %s' % (str_time, timestamp % 1000, log_group_name, log_stream_name, message.rstrip()))
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('logs')
+
+prefix_list = _get_log_group_prefix_list(args[1] if len(args) > 1 else None)
+
+start_time = int((time.time() - float(get_option('since') or 10) * 60) * 1000)
+filter_pattern = get_option('filter_pattern')
+
+# events at the last printed timestamp are remembered so that '--follow' does not print them twice
+seen_event_list = set()
+
+try:
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        while True:
+            future_list = list()
+            for aws_cli, log_group_name, stream_list in _get_job_list(executor, start_time):
+                future_list.append(executor.submit(_filter_log_events, aws_cli, log_group_name, stream_list,
+                                                   start_time, filter_pattern))
+
+            last_timestamp = start_time
+            last_event_list = set()
+            for ee in heapq.merge(*[ff.result() for ff in future_list]):
+                if ee[1] in seen_event_list:
+                    continue
+                _print_event(ee)
+
+                if ee[0] > last_timestamp:
+                    last_timestamp = ee[0]
+                    last_event_list = set()
+                last_event_list.add(ee[1])
+
+            if not get_option('follow'):
+                break
+
+            if last_timestamp > start_time:
+                seen_event_list = last_event_list
+            else:
+                seen_event_list |= last_event_list
+            start_time = last_timestamp
+            time.sleep(5)
+except KeyboardInterrupt:
+    print('')
@@ -4,6 +4,7 @@ import subprocess
 
 from env import env
 from run_common import AWSCli
+from run_common import git_worktree
 from run_common import print_message
 from run_common import print_session
 
@@ -23,17 +24,12 @@ git_url = env['template']['GIT_URL']
 name = env['template']['NAME']
 phase = env['common']['PHASE']
 
-print_message('cleanup existing template')
+print_message('download template from git repository')
 
 subprocess.Popen(['mkdir', '-p', './template']).communicate()
-subprocess.Popen(['rm', '-rf', './%s' % name], cwd='template').communicate()
 
-print_message('download template from git repository')
-if phase == 'dv':
-    template_git_command = ['git', 'clone', '--depth=1', git_url]
-else:
-    template_git_command = ['git', 'clone', '--depth=1', '-b', phase, git_url]
-subprocess.Popen(template_git_command, cwd='template').communicate()
+branch = None if phase == 'dv' else phase
+git_worktree(git_url, branch, 'template/%s' % name)
 
 if not os.path.exists('template/' + name):
     raise Exception()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
-import time
-
 from env import env
 from run_common import AWSCli
+from run_common import describe_eb_environments
+from run_common import get_xray_sampling_rule_name
+from run_common import is_dry_run
 from run_common import print_message
 from run_common import print_session
+from run_common import reap_eb_environments
 
 args = []
 
@@ -13,38 +15,6 @@ if __name__ == "__main__":
 
     args = parse_args()
 
-
-def run_terminate_environment(name):
-    print_message('terminate %s' % name)
-
-    elapsed_time = 0
-    while True:
-        cmd = ['elasticbeanstalk', 'describe-environments']
-        cmd += ['--application-name', eb_application_name]
-        result = aws_cli.run(cmd)
-
-        count = 0
-        for r in result['Environments']:
-            if not r['EnvironmentName'].startswith(name):
-                continue
-
-            if r['Status'] not in ('Ready', 'Terminating', 'Terminated'):
-                count += 1
-                continue
-
-            if r['Status'] == 'Ready':
-                cmd = ['elasticbeanstalk', 'terminate-environment']
-                cmd += ['--environment-name', r['EnvironmentName']]
-                aws_cli.run(cmd, ignore_error=True)
-
-        if count == 0:
-            break
-
-        print('deleting the environment... (elapsed time: \'%d\' seconds)' % elapsed_time)
-        time.sleep(5)
-        elapsed_time += 5
-
-
 ################################################################################
 #
 # start
@@ -52,24 +22,48 @@ def run_terminate_environment(name):
 ################################################################################
 print_session('terminate eb')
 
-eb_application_name = env['elasticbeanstalk']['APPLICATION_NAME']
+eb = env['elasticbeanstalk']
+
+name_list = [eb_env['NAME'] for eb_env in eb['ENVIRONMENTS']]
+
+if len(args) == 2:
+    target_eb_name = args[1]
+    if target_eb_name not in name_list:
+        print('"%s" is not exists in config.json' % target_eb_name)
+    name_list = [nn for nn in name_list if nn == target_eb_name]
+
+################################################################################
+print_message('terminate %s' % ', '.join(name_list))
 
-for vpc_env in env['vpc']:
-    aws_cli = AWSCli(vpc_env['AWS_DEFAULT_REGION'])
-    aws_default_region = vpc_env['AWS_DEFAULT_REGION']
+region_list = sorted(set([vpc_env['AWS_DEFAULT_REGION'] for vpc_env in env['vpc']]))
+environment_list = describe_eb_environments(region_list)
 
-    eb = env['elasticbeanstalk']
+# environments which are launching or updating are terminated when they become 'Ready'
+candidate_list = list()
+for region in region_list:
+    for r in environment_list[region]:
+        if r['Status'] == 'Terminated':
+            continue
 
-    if len(args) == 2:
-        target_eb_name = args[1]
-        target_eb_name_exists = False
-        for eb_env in eb['ENVIRONMENTS']:
-            if eb_env['NAME'] == target_eb_name:
-                target_eb_name_exists = True
-                run_terminate_environment(eb_env['NAME'])
+        for name in name_list:
+            if r['EnvironmentName'].startswith(name):
+                candidate_list.append([region, r['EnvironmentName'], 'NAME %s (%s)' % (name, r['Status'])])
                 break
-        if not target_eb_name_exists:
-            print('"%s" is not exists in config.json' % target_eb_name)
-    else:
-        for eb_env in eb['ENVIRONMENTS']:
-            run_terminate_environment(eb_env['NAME'])
+
+reap_eb_environments(candidate_list, is_dry_run())
+
+################################################################################
+# x-ray allows 25 sampling rules per region, so the rules of the terminated environments are removed
+for eb_env in eb['ENVIRONMENTS']:
+    if eb_env['NAME'] not in name_list or not eb_env.get('XRAY'):
+        continue
+
+    rule_name = get_xray_sampling_rule_name(eb_env['NAME'])
+    print_message('delete x-ray sampling rule: %s' % rule_name)
+    if is_dry_run():
+        print('(dry run)')
+        continue
+
+    for region in sorted(set([env['aws']['AWS_DEFAULT_REGION'],
+                              eb_env.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])])):
+        AWSCli(region).delete_xray_sampling_rule(rule_name)
@@ -2,9 +2,11 @@
 import time
 
 from env import env
-from run_common import AWSCli
+from run_common import describe_eb_environments
+from run_common import is_dry_run
 from run_common import print_message
 from run_common import print_session
+from run_common import reap_eb_environments
 
 if __name__ == "__main__":
     from run_common import parse_args
@@ -12,7 +14,8 @@ if __name__ == "__main__":
     parse_args()
 
 
-def _is_old_environment(cname):
+def _get_old_environment_reason(cname):
+    # returns the reason to reap the environment or None
     cc = cname.split('.')[0]
     cc = cc.split('-')[-1]
 
@@ -20,23 +23,24 @@ def _is_old_environment(cname):
     try:
         old_timestamp = int(cc)
     except Exception:
-        return False
+        return None
 
     # 'old_timestamp' MUST NOT be greater than current timestamp
     if old_timestamp > timestamp:
-        print('wrong old timestamp (too big)')
-        return False
+        print('wrong old timestamp (too big):', cname)
+        return None
 
     # 'old_timestamp' MUST NOT be less than timestamp of '2016-01-01 00:00:00'.
     if old_timestamp < 1451606400:
-        print('wrong old timestamp (too small)')
-        return False
+        print('wrong old timestamp (too small):', cname)
+        return None
 
-    if old_timestamp + max_age_seconds > timestamp:
-        print('skip this time')
-        return False
+    age = timestamp - old_timestamp
+    if age < max_age_seconds:
+        print('skip this time (age: %dm):' % (age // 60), cname)
+        return None
 
-    return True
+    return 'age %dh %02dm > %dm (CNAME %s)' % (age // 3600, age % 3600 // 60, max_age_seconds // 60, cname)
 
 
 ################################################################################
@@ -52,32 +56,22 @@ max_age_seconds = 60 * 50
 ################################################################################
 print_message('terminate old environment (current timestamp: %d)' % timestamp)
 
-eb_application_name = env['elasticbeanstalk']['APPLICATION_NAME']
+region_list = sorted(set([vpc_env['AWS_DEFAULT_REGION'] for vpc_env in env['vpc']]))
+environment_list = describe_eb_environments(region_list)
 
-for vpc_env in env['vpc']:
-    aws_cli = AWSCli(vpc_env['AWS_DEFAULT_REGION'])
-    aws_default_region = vpc_env['AWS_DEFAULT_REGION']
-
-    cmd = ['elasticbeanstalk', 'describe-environments']
-    cmd += ['--application-name', eb_application_name]
-    result = aws_cli.run(cmd)
-
-    for r in result['Environments']:
+candidate_list = list()
+for region in region_list:
+    for r in environment_list[region]:
         if 'CNAME' not in r:
             continue
 
-        print('')
-        print('EnvironmentName:', r['EnvironmentName'])
-        print('CNAME:', r['CNAME'])
-        print('Status:', r['Status'])
-        print('')
-
         if r['Status'] != 'Ready':
             continue
 
-        if not _is_old_environment(r['CNAME']):
+        reason = _get_old_environment_reason(r['CNAME'])
+        if not reason:
             continue
 
-        cmd = ['elasticbeanstalk', 'terminate-environment']
-        cmd += ['--environment-name', r['EnvironmentName']]
-        aws_cli.run(cmd, ignore_error=True)
+        candidate_list.append([region, r['EnvironmentName'], reason])
+
+reap_eb_environments(candidate_list, is_dry_run())
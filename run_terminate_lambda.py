@@ -3,8 +3,10 @@ import json
 
 from env import env
 from run_common import AWSCli
+from run_common import get_lambda_layer_name
 from run_common import print_message
 from run_common import print_session
+from run_common import run_parallel
 
 args = []
 
@@ -31,6 +33,22 @@ def terminate_iam_for_lambda():
     aws_cli.run(cmd, ignore_error=True)
 
 
+def terminate_lambda_layer():
+    print_message('delete lambda layer versions')
+
+    layer_name = get_lambda_layer_name()
+
+    cmd = ['lambda', 'list-layer-versions',
+           '--layer-name', layer_name]
+    result = aws_cli.run(cmd, ignore_error=True)
+
+    for ll in (result or dict()).get('LayerVersions', list()):
+        cmd = ['lambda', 'delete-layer-version',
+               '--layer-name', layer_name,
+               '--version-number', str(ll['Version'])]
+        aws_cli.run(cmd, ignore_error=True)
+
+
 def run_terminate_default_lambda(name, settings):
     function_name = settings['NAME']
     template_name = env['template']['NAME']
@@ -109,39 +127,44 @@ def run_terminate_sns_lambda(name, settings):
     ################################################################################
     print_session('terminate lambda: %s' % function_name)
 
-    cmd = ['lambda', 'get-policy',
-           '--function-name', function_name]
-    result = aws_cli.run(cmd, ignore_error=True)
+    # the topics subscribe the function, or its alias when it has provisioned concurrency
+    statement_list = list()
+    for qualifier in (None, settings.get('ALIAS', 'live')):
+        cmd = ['lambda', 'get-policy',
+               '--function-name', function_name]
+        if qualifier:
+            cmd += ['--qualifier', qualifier]
+        result = aws_cli.run(cmd, ignore_error=True)
 
-    if result:
-        policy = result['Policy']
-        policy = json.loads(policy)
+        if result:
+            policy = result['Policy']
+            policy = json.loads(policy)
 
-        statement_list = policy['Statement']
+            statement_list += policy['Statement']
 
-        for statement in statement_list:
-            print_message('remove subscription')
+    for statement in statement_list:
+        print_message('remove subscription')
 
-            arn_like = statement['Condition']['ArnLike']
-            source_arn = arn_like['AWS:SourceArn']
+        arn_like = statement['Condition']['ArnLike']
+        source_arn = arn_like['AWS:SourceArn']
 
-            sns_region = source_arn.split(':')[3]
+        sns_region = source_arn.split(':')[3]
 
-            cmd = ['sns', 'list-subscriptions-by-topic',
-                   '--topic-arn', source_arn]
-            result = AWSCli(sns_region).run(cmd, ignore_error=True)
-            if not result:
-                continue
+        cmd = ['sns', 'list-subscriptions-by-topic',
+               '--topic-arn', source_arn]
+        result = AWSCli(sns_region).run(cmd, ignore_error=True)
+        if not result:
+            continue
 
-            subscription_list = result['Subscriptions']
-            for subscription in subscription_list:
-                if subscription['Protocol'] != 'lambda':
-                    continue
+        subscription_list = result['Subscriptions']
+        for subscription in subscription_list:
+            if subscription['Protocol'] != 'lambda':
+                continue
 
-                subscription_arn = subscription['SubscriptionArn']
-                cmd = ['sns', 'unsubscribe',
-                       '--subscription-arn', subscription_arn]
-                AWSCli(sns_region).run(cmd, ignore_error=True)
+            subscription_arn = subscription['SubscriptionArn']
+            cmd = ['sns', 'unsubscribe',
+                   '--subscription-arn', subscription_arn]
+            AWSCli(sns_region).run(cmd, ignore_error=True)
 
     print_message('delete lambda function')
 
@@ -160,34 +183,31 @@ print_session('terminate lambda')
 lambdas_list = env['lambda']
 if len(args) == 2:
     target_lambda_name = args[1]
-    target_lambda_name_exists = False
-    for lambda_env in lambdas_list:
-        if lambda_env['NAME'] == target_lambda_name:
-            target_lambda_name_exists = True
-            if lambda_env['TYPE'] == 'default':
-                run_terminate_default_lambda(lambda_env['NAME'], lambda_env)
-                break
-            if lambda_env['TYPE'] == 'cron':
-                run_terminate_cron_lambda(lambda_env['NAME'], lambda_env)
-                break
-            if lambda_env['TYPE'] == 'sns':
-                run_terminate_sns_lambda(lambda_env['NAME'], lambda_env)
-                break
-            print('"%s" is not supported' % lambda_env['TYPE'])
-            raise Exception()
-    if not target_lambda_name_exists:
+    lambdas_list = [ll for ll in lambdas_list if ll['NAME'] == target_lambda_name]
+    if not lambdas_list:
         print('"%s" is not exists in config.json' % target_lambda_name)
-else:
-    for lambda_env in lambdas_list:
-        if lambda_env['TYPE'] == 'default':
-            run_terminate_default_lambda(lambda_env['NAME'], lambda_env)
-            continue
-        if lambda_env['TYPE'] == 'cron':
-            run_terminate_cron_lambda(lambda_env['NAME'], lambda_env)
-            continue
-        if lambda_env['TYPE'] == 'sns':
-            run_terminate_sns_lambda(lambda_env['NAME'], lambda_env)
-            continue
-        print('"%s" is not supported' % lambda_env['TYPE'])
-        raise Exception()
+
+# one paginated listing; the functions which do not exist are skipped
+function_list = aws_cli.get_lambda_function_list()
+
+job_list = list()
+for lambda_env in lambdas_list:
+    if lambda_env['NAME'] not in function_list:
+        print('skip: lambda "%s" does not exist' % lambda_env['NAME'])
+        continue
+    if lambda_env['TYPE'] == 'default':
+        job_list.append([lambda_env['NAME'], run_terminate_default_lambda, (lambda_env['NAME'], lambda_env)])
+        continue
+    if lambda_env['TYPE'] == 'cron':
+        job_list.append([lambda_env['NAME'], run_terminate_cron_lambda, (lambda_env['NAME'], lambda_env)])
+        continue
+    if lambda_env['TYPE'] == 'sns':
+        job_list.append([lambda_env['NAME'], run_terminate_sns_lambda, (lambda_env['NAME'], lambda_env)])
+        continue
+    print('"%s" is not supported' % lambda_env['TYPE'])
+    raise Exception()
+run_parallel(job_list, 8)
+
+if len(args) != 2:
+    terminate_lambda_layer()
     terminate_iam_for_lambda()
@@ -71,6 +71,21 @@ def main(settings):
             cmd += ['--vpc-peering-connection-id', peering_connection_id]
             aws_cli.run(cmd, ignore_error=True)
 
+    ################################################################################
+    print_message('delete vpc endpoint')
+
+    cmd = ['ec2', 'describe-vpc-endpoints']
+    result = aws_cli.run(cmd, ignore_error=True)
+    for r in result['VpcEndpoints']:
+        if r['VpcId'] != rds_vpc_id and r['VpcId'] != eb_vpc_id:
+            continue
+        if r['State'] in ('deleting', 'deleted'):
+            continue
+        print('delete vpc endpoint (id: %s)' % r['VpcEndpointId'])
+        cmd = ['ec2', 'delete-vpc-endpoints']
+        cmd += ['--vpc-endpoint-ids', r['VpcEndpointId']]
+        aws_cli.run(cmd, ignore_error=True)
+
     ################################################################################
     print_message('revoke security group ingress')
 
@@ -123,7 +138,7 @@ def main(settings):
         if r['VpcId'] != rds_vpc_id and r['VpcId'] != eb_vpc_id:
             continue
         for route in r['Routes']:
-            if route['DestinationCidrBlock'] == '0.0.0.0/0':
+            if route.get('DestinationCidrBlock') == '0.0.0.0/0':
                 print('delete route (route table id: %s)' % r['RouteTableId'])
                 cmd = ['ec2', 'delete-route']
                 cmd += ['--route-table-id', r['RouteTableId']]
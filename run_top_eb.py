@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from run_common import AWSCli
+from run_common import get_live_eb_environment_list
+from run_common import print_session
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    parse_args()
+
+# the worst first
+_health_status_order = ['Severe', 'Degraded', 'Warning', 'Unknown', 'Pending', 'Info', 'NoData', 'Ok',
+                        'Suspended']
+
+_latency_key_list = ['P10', 'P50', 'P75', 'P85', 'P90', 'P95', 'P99', 'P999']
+
+
+def _describe_health(aws_default_region, environment_name):
+    aws_cli = AWSCli(aws_default_region)
+
+    cmd = ['elasticbeanstalk', 'describe-environment-health']
+    cmd += ['--environment-name', environment_name]
+    cmd += ['--attribute-names', 'All']
+    environment_health = aws_cli.run(cmd)
+
+    # one batched call for all instances of the environment
+    instance_list = list()
+    next_token = None
+    while True:
+        cmd = ['elasticbeanstalk', 'describe-instances-health']
+        cmd += ['--environment-name', environment_name]
+        cmd += ['--attribute-names', 'All']
+        if next_token:
+            cmd += ['--next-token', next_token]
+        result = aws_cli.run(cmd)
+
+        instance_list += result['InstanceHealthList']
+        next_token = result.get('NextToken')
+        if not next_token:
+            break
+
+    return environment_health, instance_list
+
+
+def _status_rank(health_status):
+    if health_status in _health_status_order:
+        return _health_status_order.index(health_status)
+    return len(_health_status_order)
+
+
+def _format_instance(ii):
+    metrics = ii.get('ApplicationMetrics', dict())
+    duration = metrics.get('Duration') or 0
+    request_rate = metrics.get('RequestCount', 0) / float(duration) if duration else 0.0
+    latency = metrics.get('Latency', dict())
+    status_codes = metrics.get('StatusCodes', dict())
+    system = ii.get('System', dict())
+    cpu = 100.0 - system.get('CPUUtilization', dict()).get('Idle', 100.0)
+    load = system.get('LoadAverage') or [0.0]
+
+    ll = '%-19s %-9s %7.1f' % (ii['InstanceId'], ii.get('HealthStatus', ''), request_rate)
+    for key in _latency_key_list:
+        ll += ' %6.3f' % latency.get(key, 0.0)
+    for key in ('Status2xx', 'Status3xx', 'Status4xx', 'Status5xx'):
+        ll += ' %6d' % status_codes.get(key, 0)
+    ll += ' %5.1f %5.2f' % (cpu, load[0])
+    return ll
+
+
+def _instance_sort_key(ii):
+    metrics = ii.get('ApplicationMetrics', dict())
+    return (_status_rank(ii.get('HealthStatus')),
+            -metrics.get('StatusCodes', dict()).get('Status5xx', 0),
+            -metrics.get('Latency', dict()).get('P99', 0.0))
+
+
+def _print_screen(health_list, interval):
+    # clear the screen and move the cursor to the top left
+    print('\033[2J\033[H', end='')
+    print('%s (refresh: %ds, ctrl+c to quit)' % (time.strftime('%Y-%m-%d %H:%M:%S'), interval))
+
+    header = '%-19s %-9s %7s' % ('INSTANCE', 'HEALTH', 'REQ/S')
+    for key in _latency_key_list:
+        header += ' %6s' % key
+    header += ' %6s %6s %6s %6s %5s %5s' % ('2XX', '3XX', '4XX', '5XX', 'CPU%', 'LOAD')
+
+    for region, environment_name, environment_health, instance_list in health_list:
+        print('')
+        print('%s [%s] %s %s (%s) %s' % (environment_name, region, environment_health.get('Status'),
+                                         environment_health.get('Color'), environment_health.get('HealthStatus'),
+                                         ' '.join(environment_health.get('Causes', list()))))
+        print(header)
+        for ii in sorted(instance_list, key=_instance_sort_key):
+            print(_format_instance(ii))
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('top eb')
+
+live_list = get_live_eb_environment_list()
+if not live_list:
+    print('no environment is running')
+    raise SystemExit(0)
+
+# enhanced health is refreshed every 10 seconds; the interval backs off while nothing changes
+# and goes back to 10 seconds when the health data changes or an environment is not healthy
+interval = 10
+payload = None
+
+try:
+    while True:
+        # environments are created and swapped while this runs, so the live list is resolved every tick
+        if payload is not None:
+            live_list = get_live_eb_environment_list()
+
+        health_list = list()
+        if live_list:
+            with ThreadPoolExecutor(max_workers=min(len(live_list), 16)) as executor:
+                future_list = list()
+                for region, environment_name in live_list:
+                    future_list.append([region, environment_name,
+                                        executor.submit(_describe_health, region, environment_name)])
+
+                for region, environment_name, ff in future_list:
+                    environment_health, instance_list = ff.result()
+                    health_list.append([region, environment_name, environment_health, instance_list])
+
+        # 'RefreshedAt' changes on every call, so the backoff compares the health and the metrics only
+        payload_new = json.dumps([[hh[0], hh[1], dict([kv for kv in hh[2].items() if kv[0] != 'RefreshedAt']),
+                                   hh[3]] for hh in health_list], sort_keys=True, default=str)
+        healthy = all([hh[2].get('HealthStatus') == 'Ok' and hh[2].get('Status') == 'Ready'
+                       for hh in health_list])
+        if not healthy or payload_new != payload:
+            interval = 10
+        else:
+            interval = min(interval * 2, 60)
+        payload = payload_new
+
+        _print_screen(health_list, interval)
+        time.sleep(interval)
+except KeyboardInterrupt:
+    print('')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from access_log import QuantileSketch
+from access_log import get_endpoint
+from env import env
+from run_common import AWSCli
+from run_common import get_option
+from run_common import print_message
+from run_common import print_session
+
+args = []
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    args = parse_args()
+
+# the time window is read in slices of at least this many seconds, each slice is paginated by one worker;
+# get-trace-summaries is throttled at a few requests per second, so only a few workers run at once
+_min_slice_seconds = 60
+_max_workers = 4
+
+
+class TraceStat:
+    def __init__(self, max_urls=1000):
+        self.max_urls = max_urls
+        self.url = dict()
+        self.service = dict()
+        self.trace_count = 0
+
+    @staticmethod
+    def _new_item():
+        ii = dict()
+        ii['count'] = 0
+        ii['fault'] = 0
+        ii['error'] = 0
+        ii['sketch'] = QuantileSketch()
+        # time of the traces which the service is the root cause of (downstream services only)
+        ii['root_count'] = 0
+        ii['root_sketch'] = QuantileSketch()
+        return ii
+
+    def _item(self, table, key):
+        if key not in table:
+            table[key] = self._new_item()
+        return table[key]
+
+    def add_summary(self, ss):
+        self.trace_count += 1
+
+        response_time = ss.get('ResponseTime') or 0.0
+        http = ss.get('Http', dict())
+        url = urllib.parse.urlparse(http.get('HttpURL', '')).path or '(no url)'
+
+        key = get_endpoint(http.get('HttpMethod', '-'), url)
+        if key not in self.url and len(self.url) >= self.max_urls:
+            key = '(other)'
+
+        item_list = [self._item(self.url, key)]
+        for service in ss.get('ServiceIds', list()):
+            if service.get('Type') == 'client':
+                continue
+            item_list.append(self._item(self.service, '%s %s' % (service.get('Type'), service.get('Name'))))
+
+        for ii in item_list:
+            ii['count'] += 1
+            ii['fault'] += 1 if ss.get('HasFault') else 0
+            ii['error'] += 1 if ss.get('HasError') or ss.get('HasThrottle') else 0
+            ii['sketch'].add(response_time)
+
+        # the last entity of the path is where the response time was spent; its coverage is the share of the trace
+        for cause in ss.get('ResponseTimeRootCauses', list()):
+            for service in cause.get('Services', list()):
+                entity_path = service.get('EntityPath') or [dict()]
+                coverage = min(entity_path[-1].get('Coverage') or 0.0, 1.0)
+                ii = self._item(self.service, '%s %s' % (service.get('Type'), service.get('Name')))
+                ii['root_count'] += 1
+                ii['root_sketch'].add(response_time * coverage)
+
+    def merge(self, other):
+        # the busiest urls of the other stat are merged first; the rest beyond the cap go to '(other)'
+        for table, other_table in ((self.url, other.url), (self.service, other.service)):
+            for key_other in sorted(other_table, key=lambda x: -other_table[x]['count']):
+                key = key_other
+                if table is self.url and key not in table and len(table) >= self.max_urls:
+                    key = '(other)'
+                oo = other_table[key_other]
+                if key not in table:
+                    table[key] = oo
+                    continue
+                ii = table[key]
+                for kk in ('count', 'fault', 'error', 'root_count'):
+                    ii[kk] += oo[kk]
+                ii['sketch'].merge(oo['sketch'])
+                ii['root_sketch'].merge(oo['root_sketch'])
+        self.trace_count += other.trace_count
+
+    def print_report(self, top=30):
+        print('%d traces, %d urls, %d services' % (self.trace_count, len(self.url), len(self.service)))
+
+        print('')
+        print('%8s %6s %6s %8s %8s %8s %8s  %s' % ('COUNT', 'FAULT', 'ERROR', 'P50', 'P90', 'P99', 'MAX', 'URL'))
+        url_list = sorted(self.url.items(), key=lambda x: -x[1]['count'])
+        for key, ii in url_list[:top]:
+            ss = ii['sketch']
+            print('%8d %6d %6d %8.3f %8.3f %8.3f %8.3f  %s' %
+                  (ii['count'], ii['fault'], ii['error'], ss.quantile(0.5), ss.quantile(0.9), ss.quantile(0.99),
+                   ss.max, key))
+
+        # the services are sorted by the time they are blamed for, e.g. RDS, SQS and S3 called by the application
+        print('')
+        print('%8s %6s %8s %8s %8s %6s %8s %8s  %s' %
+              ('TRACES', 'FAULT', 'P50', 'P90', 'P99', 'ROOT', 'ROOT P50', 'ROOT P99', 'SERVICE'))
+        service_list = sorted(self.service.items(),
+                              key=lambda x: (-x[1]['root_count'] * x[1]['root_sketch'].quantile(0.5),
+                                             -x[1]['count']))
+        for key, ii in service_list[:top]:
+            ss = ii['sketch']
+            rr = ii['root_sketch']
+            print('%8d %6d %8.3f %8.3f %8.3f %6d %8.3f %8.3f  %s' %
+                  (ii['count'], ii['fault'], ss.quantile(0.5), ss.quantile(0.9), ss.quantile(0.99),
+                   ii['root_count'], rr.quantile(0.5), rr.quantile(0.99), key))
+
+
+def _get_region_list():
+    region_list = [env['aws']['AWS_DEFAULT_REGION']]
+    for eb_env in env.get('elasticbeanstalk', dict()).get('ENVIRONMENTS', list()):
+        region = eb_env.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])
+        if region not in region_list:
+            region_list.append(region)
+    return region_list
+
+
+def _get_trace_summaries(aws_default_region, start_time, end_time, filter_expression):
+    aws_cli = AWSCli(aws_default_region)
+
+    stat = TraceStat()
+    next_token = None
+    while True:
+        cmd = ['xray', 'get-trace-summaries']
+        cmd += ['--start-time', str(start_time)]
+        cmd += ['--end-time', str(end_time)]
+        cmd += ['--no-paginate']
+        if filter_expression:
+            cmd += ['--filter-expression', filter_expression]
+        if next_token:
+            cmd += ['--next-token', next_token]
+        result = aws_cli.run(cmd, quiet=True)
+
+        for ss in result.get('TraceSummaries', list()):
+            stat.add_summary(ss)
+
+        next_token = result.get('NextToken')
+        if not next_token:
+            return stat
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('trace report')
+
+filter_expression_list = list()
+if len(args) > 1:
+    filter_expression_list.append('service("%s")' % args[1])
+if get_option('filter_expression'):
+    filter_expression_list.append('(%s)' % get_option('filter_expression'))
+filter_expression = ' AND '.join(filter_expression_list)
+
+end_time = int(time.time())
+start_time = end_time - int(float(get_option('since') or 10) * 60)
+slice_seconds = max(_min_slice_seconds, (end_time - start_time) // _max_workers + 1)
+
+job_list = list()
+for region in _get_region_list():
+    for tt in range(start_time, end_time, slice_seconds):
+        job_list.append([region, tt, min(tt + slice_seconds, end_time)])
+
+print_message('get trace summaries (%d slices of %d seconds)' % (len(job_list), slice_seconds))
+
+stat = TraceStat()
+with ThreadPoolExecutor(max_workers=_max_workers) as executor:
+    future_list = list()
+    for region, tt_start, tt_end in job_list:
+        future_list.append(executor.submit(_get_trace_summaries, region, tt_start, tt_end, filter_expression))
+
+    for ff in future_list:
+        stat.merge(ff.result())
+
+print_message('response time by url and by service')
+
+stat.print_report()
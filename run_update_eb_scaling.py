@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import json
+import time
+
+from env import env
+from run_common import AWSCli
+from run_common import get_eb_scaling_option_settings
+from run_common import print_message
+from run_common import print_session
+
+args = []
+
+if __name__ == "__main__":
+    from run_common import parse_args
+
+    args = parse_args()
+
+
+def run_update_eb_scaling(name, settings):
+    aws_default_region = settings.get('AWS_DEFAULT_REGION', env['aws']['AWS_DEFAULT_REGION'])
+    aws_cli = AWSCli(aws_default_region)
+
+    cname = '%s.%s.elasticbeanstalk.com' % (settings['CNAME'], aws_default_region)
+
+    print_message('update scaling of %s' % name)
+
+    cmd = ['elasticbeanstalk', 'describe-environments']
+    cmd += ['--application-name', eb_application_name]
+    result = aws_cli.run(cmd)
+
+    for r in result['Environments']:
+        if r.get('CNAME') != cname or r['Status'] == 'Terminated':
+            continue
+
+        if r['Status'] != 'Ready':
+            print('ERROR!!! %s is not ready (%s)' % (r['EnvironmentName'], r['Status']))
+            raise Exception()
+
+        if settings['TYPE'] == 'openvpn':
+            # a single instance environment has no autoscaling trigger nor rolling update
+            option_settings = get_eb_scaling_option_settings(dict(INSTANCE_TYPE=settings.get('INSTANCE_TYPE')))
+        else:
+            option_settings = get_eb_scaling_option_settings(settings)
+
+        str_timestamp = str(int(time.time()))
+
+        cmd = ['elasticbeanstalk', 'update-environment']
+        cmd += ['--application-name', eb_application_name]
+        cmd += ['--environment-name', r['EnvironmentName']]
+        cmd += ['--option-settings', json.dumps(option_settings)]
+        aws_cli.run(cmd)
+
+        aws_cli.wait_eb_environment_ready(eb_application_name, r['EnvironmentName'], str_timestamp)
+        return
+
+    print('"%s" is not running' % name)
+
+
+################################################################################
+#
+# start
+#
+################################################################################
+print_session('update eb scaling')
+
+eb = env['elasticbeanstalk']
+eb_application_name = eb['APPLICATION_NAME']
+target_eb_name = None
+
+if len(args) > 1:
+    target_eb_name = args[1]
+
+for eb_env in eb['ENVIRONMENTS']:
+    if target_eb_name and eb_env['NAME'] != target_eb_name:
+        continue
+
+    run_update_eb_scaling(eb_env['NAME'], eb_env)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+
+# "GET /path HTTP/1.1" in an access log (combined, common or elb format)
+_access_log_request = re.compile(r'"(GET|HEAD) (\S+) HTTP/[0-9.]+"')
+
+
+def read_request_list(file_path):
+    # one request per line: '/path' or 'GET /path' (only GET and HEAD are replayed)
+    request_list = list()
+    with open(file_path) as f:
+        for ll in f:
+            ll = ll.strip()
+            if not ll or ll.startswith('#'):
+                continue
+            tt = ll.split()
+            if len(tt) == 1:
+                request_list.append(['GET', tt[0]])
+            elif tt[0] in ('GET', 'HEAD'):
+                request_list.append([tt[0], tt[1]])
+    return request_list
+
+
+def read_access_log(file_path, limit=1000):
+    # the most recent 'limit' requests of an access log
+    request_list = deque(maxlen=limit)
+    with open(file_path, errors='replace') as f:
+        for ll in f:
+            m = _access_log_request.search(ll)
+            if not m:
+                continue
+            path = m.group(2)
+            if path.startswith('http://') or path.startswith('https://'):
+                path = '/' + path.split('/', 3)[-1]
+            request_list.append([m.group(1), path])
+    return list(request_list)
+
+
+def percentile(sorted_list, pp):
+    # nearest-rank percentile
+    if not sorted_list:
+        return 0
+    index = max(int(len(sorted_list) * pp / 100.0 + 0.999999) - 1, 0)
+    return sorted_list[min(index, len(sorted_list) - 1)]
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # a redirect (e.g. http to https of HOST) would leave the new environment, so it is returned as it is
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirectHandler)
+
+
+def _request(base_url, method, path, headers, timeout, scheduled_time):
+    # the latency is measured from the scheduled send time, so the time a request waits for a free worker
+    # counts (no coordinated omission)
+    req = urllib.request.Request(base_url + path, method=method, headers=headers)
+    # noinspection PyBroadException
+    try:
+        with _opener.open(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = 0
+    return status, (time.time() - scheduled_time) * 1000
+
+
+def run_warmup(base_url, request_list, rate=10, count=100, headers=None, timeout=10, max_workers=32):
+    # requests are issued on a fixed schedule (open loop), so slow responses do not lower the load
+    if not request_list:
+        print('ERROR!!! no request to replay')
+        raise Exception()
+
+    headers = headers or dict()
+    lock = threading.Lock()
+    latency_list = list()
+    status_count = dict()
+
+    def _job(method, path, scheduled_time):
+        status, latency = _request(base_url, method, path, headers, timeout, scheduled_time)
+        with lock:
+            latency_list.append(latency)
+            status_count[status] = status_count.get(status, 0) + 1
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for ii in range(count):
+            scheduled_time = start_time + ii / float(rate)
+            wait = scheduled_time - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            method, path = request_list[ii % len(request_list)]
+            executor.submit(_job, method, path, scheduled_time)
+
+    latency_list.sort()
+    error_count = sum([status_count[ss] for ss in status_count if ss == 0 or ss >= 500])
+    redirect_count = sum([status_count[ss] for ss in status_count if 300 <= ss < 400])
+
+    result = dict()
+    result['count'] = len(latency_list)
+    result['elapsed'] = time.time() - start_time
+    result['error_rate'] = error_count / float(len(latency_list))
+    result['redirect_rate'] = redirect_count / float(len(latency_list))
+    result['p50'] = percentile(latency_list, 50)
+    result['p95'] = percentile(latency_list, 95)
+    result['p99'] = percentile(latency_list, 99)
+    result['status'] = status_count
+    return result
+
+
+def print_warmup_result(result):
+    print('requests: %d (%.1f seconds)' % (result['count'], result['elapsed']))
+    print('status: %s' % ', '.join(['%s=%d' % (ss, result['status'][ss]) for ss in sorted(result['status'])]))
+    print('p50: %.1f ms, p95: %.1f ms, p99: %.1f ms, error rate: %.2f%%, redirect rate: %.2f%%' %
+          (result['p50'], result['p95'], result['p99'], result['error_rate'] * 100, result['redirect_rate'] * 100))
+
+
+def check_warmup_result(result, warmup):
+    passed = True
+    for key in ('p50', 'p95', 'p99'):
+        threshold = warmup.get('MAX_%s_MS' % key.upper())
+        if threshold is not None and result[key] > float(threshold):
+            print('%s %.1f ms exceeds %s ms' % (key, result[key], threshold))
+            passed = False
+
+    threshold = float(warmup.get('MAX_ERROR_RATE', 0.01))
+    if result['error_rate'] > threshold:
+        print('error rate %.4f exceeds %s' % (result['error_rate'], threshold))
+        passed = False
+
+    # mostly redirects means the requests did not reach the application of the new environment
+    threshold = float(warmup.get('MAX_REDIRECT_RATE', 0.5))
+    if result['redirect_rate'] > threshold:
+        print('redirect rate %.4f exceeds %s' % (result['redirect_rate'], threshold))
+        passed = False
+
+    return passed
+
+
+def warmup_environment(base_url, warmup, host=None):
+    # warmup: the 'WARMUP' dict of an environment in config.json
+    request_list = list()
+    if warmup.get('REQUEST_FILE'):
+        request_list += read_request_list(warmup['REQUEST_FILE'])
+    if warmup.get('ACCESS_LOG'):
+        request_list += read_access_log(warmup['ACCESS_LOG'], int(warmup.get('ACCESS_LOG_LIMIT', 1000)))
+    for path in warmup.get('PATHS', list()):
+        request_list.append(['GET', path])
+
+    headers = dict()
+    headers['User-Agent'] = 'johanna-warmup'
+    if host:
+        headers['Host'] = host
+
+    result = run_warmup(base_url, request_list,
+                        rate=float(warmup.get('RATE', 10)),
+                        count=int(warmup.get('COUNT', 300)),
+                        headers=headers,
+                        timeout=float(warmup.get('TIMEOUT', 10)))
+    print_warmup_result(result)
+    return check_warmup_result(result, warmup)
+
+
+if __name__ == "__main__":
+    # replay against any http server, e.g. a local stand-in started by 'python3 -m http.server 8000':
+    # ./warmup.py http://127.0.0.1:8000 -p / --rate 50 --count 200 --max-p99-ms 100
+    parser = OptionParser(usage='%prog base_url [options]')
+    parser.add_option('-r', '--request-file', dest='request_file')
+    parser.add_option('-l', '--access-log', dest='access_log')
+    parser.add_option('-p', '--path', dest='path_list', action='append', default=list())
+    parser.add_option('--host', dest='host')
+    parser.add_option('--rate', dest='rate', default='10')
+    parser.add_option('--count', dest='count', default='100')
+    parser.add_option('--max-p50-ms', dest='max_p50_ms')
+    parser.add_option('--max-p95-ms', dest='max_p95_ms')
+    parser.add_option('--max-p99-ms', dest='max_p99_ms')
+    parser.add_option('--max-error-rate', dest='max_error_rate', default='0.01')
+    parser.add_option('--max-redirect-rate', dest='max_redirect_rate', default='0.5')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        raise SystemExit(1)
+
+    ww = dict()
+    ww['REQUEST_FILE'] = options.request_file
+    ww['ACCESS_LOG'] = options.access_log
+    ww['PATHS'] = options.path_list
+    ww['RATE'] = options.rate
+    ww['COUNT'] = options.count
+    ww['MAX_P50_MS'] = options.max_p50_ms
+    ww['MAX_P95_MS'] = options.max_p95_ms
+    ww['MAX_P99_MS'] = options.max_p99_ms
+    ww['MAX_ERROR_RATE'] = options.max_error_rate
+    ww['MAX_REDIRECT_RATE'] = options.max_redirect_rate
+
+    if not warmup_environment(args[0].rstrip('/'), ww, options.host):
+        print('ERROR!!! warm-up failed')
+        raise SystemExit(1)